@@ -1,18 +1,34 @@
+import asyncio
+from collections import Counter
 from dataclasses import dataclass
 from enum import Enum
 from functools import cached_property
 import logging
-from typing import List
-
-from this_framework_that_i_made.audio_helpers.volume_helpers import WindowVolumeControllerFactory
-
-from .audio_helpers.pyaudio_helper import PyAudioWrapper, get_pcm_blocks
+import threading
+import time
+from typing import ClassVar, Dict, List, Optional, Tuple
+
+from .audio_helpers import audio_backends
+from .audio_helpers.dsp import DspProcessor
+from .audio_helpers.pyaudio_helper import (
+    DuplexPassthrough,
+    EndpointCapabilities,
+    PortAudioSession,
+    PyAudioWrapper,
+    get_pcm_blocks,
+    pcm_stream,
+    play_pcm_blocks,
+    play_pcm_stream,
+)
+from .audio_helpers.resampling import PcmResampler, ResamplerQuality, resample_pcm_blocks
 from .audio_helpers.audio_standards import (
+    PcmBlock,
     SampleFormat,
     PYAUDIO_SAMPLE_FORMAT,
     NUMPY_SAMPLE_FORMAT,
 )
 from .generics import SavableObject, TftimException, ensure_savable, staticproperty
+from .streams import Stream, TimeStamp, now_ns
 
 
 """
@@ -75,6 +91,10 @@ class AudioEndpoint:
     """
 
     def __init__(self, py_audio_data):
+        self._load(py_audio_data)
+
+    def _load(self, py_audio_data):
+        """ Also how a rescan updates an endpoint it kept (new index, default rate, latencies). """
 
         self.init_data = py_audio_data
 
@@ -106,24 +126,119 @@ class AudioEndpoint:
     def host_api_name(self):
         return PyAudioWrapper.get_host_api_name_by_index(self.host_api_index)
 
+    @property
+    def input_capabilities(self) -> EndpointCapabilities:
+        """ Rates and formats this endpoint captures in, probed once and cached. """
+        return PortAudioSession.capabilities(self.index, is_input=True)
+
+    @property
+    def output_capabilities(self) -> EndpointCapabilities:
+        return PortAudioSession.capabilities(self.index, is_input=False)
+
+    def _capture_rate(self, sample_format: SampleFormat, sample_rate: int = None) -> int:
+        """ The rate to open the device at, `sample_rate` itself when the device takes it natively. """
+        capabilities = self.input_capabilities
+        if not capabilities.supports(sample_format=sample_format):
+            supported = ", ".join(f.name for f in capabilities.sample_formats)
+            raise TftimException(f"{self.name} can't capture {sample_format.name}, it takes {supported}")
+        if sample_rate and capabilities.supports(rate=sample_rate):
+            return sample_rate
+        return int(self.default_sample_rate)
+
     # only for input/duplex types
-    def get_pcm_blocks(self, sample_format: SampleFormat = SampleFormat.INT_16, frames_per_buffer=1024):
-        """Yields PCM blocks for this input endpoint with sensible defaults."""
+    def get_pcm_blocks(
+        self,
+        sample_format: SampleFormat = SampleFormat.INT_16,
+        frames_per_buffer: int = None,
+        sample_rate: int = None,
+        resampler_quality: ResamplerQuality = ResamplerQuality.MEDIUM,
+        latency_ms: float = None,
+    ):
+        """
+        Yields PCM blocks for this input endpoint with sensible defaults.
+
+        Pass `sample_rate` to get blocks at that rate so endpoints with different native rates can
+        share one timeline, the device runs at it when it can and it's resampled in software when
+        it can't. The buffer is sized from `latency_ms` (the device's low latency by default) and
+        grows if the capture can't keep up, unless `frames_per_buffer` is given.
+        """
         params = {
-            "rate": int(self.default_sample_rate),
+            "rate": self._capture_rate(sample_format, sample_rate),
             "channels": self.max_input_channels,
             "input_device_index": self.index,
             "sample_format": sample_format,
             "frames_per_buffer": frames_per_buffer,
+            "latency_ms": latency_ms,
         }
         with get_pcm_blocks(**params) as blocks:
-            for block in blocks:
-                yield block
+            yield from resample_pcm_blocks(
+                blocks,
+                in_rate=params["rate"],
+                out_rate=sample_rate or params["rate"],
+                channels=params["channels"],
+                quality=resampler_quality,
+            )
+
+    # only for input/duplex types
+    def pcm_stream(
+        self,
+        sample_format: SampleFormat = SampleFormat.INT_16,
+        frames_per_buffer: int = None,
+        sample_rate: int = None,
+        resampler_quality: ResamplerQuality = ResamplerQuality.MEDIUM,
+        latency_ms: float = None,
+    ) -> Stream[PcmBlock]:
+        """
+        Async version of get_pcm_blocks, blocks come straight from the PortAudio callback with
+        pts_ns from the device clock.
+        """
+        rate = self._capture_rate(sample_format, sample_rate)
+        stream = pcm_stream(
+            input_device_index=self.index,
+            frames_per_buffer=frames_per_buffer,
+            sample_format=sample_format,
+            rate=rate,
+            channels=self.max_input_channels,
+            latency_ms=latency_ms,
+        )
+        if sample_rate and sample_rate != rate:
+            stream = PcmResampler(rate, sample_rate, self.max_input_channels, resampler_quality).apply_stream(stream)
+        return stream
+
+    # only for output/duplex types
+    def play_pcm_blocks(self, blocks, latency_ms: float = 40.0, **options):
+        """ Plays blocks to the end through a jitter buffer, returns the PlaybackStatsSnapshot. """
+        return play_pcm_blocks(blocks, output_device_index=self.index, latency_ms=latency_ms, **options)
+
+    # only for output/duplex types
+    async def play_pcm_stream(self, stream: Stream[PcmBlock], latency_ms: float = 40.0, **options):
+        """ Plays a live stream (monitoring, routing a mix to a virtual cable) until it ends. """
+        return await play_pcm_stream(stream, output_device_index=self.index, latency_ms=latency_ms, **options)
+
+    # only for input/duplex types
+    def duplex(self, chain: DspProcessor = None, output: "AudioEndpoint" = None, frames_per_buffer: int = 128, **options):
+        """
+        This input played live on `output` (or on this endpoint if it's duplex) through `chain`.
+        Use it as a context manager, or call start()/close().
+        """
+        output = output or self
+        if output.host_api_index != self.host_api_index:
+            raise TftimException(f"duplex needs both endpoints on one host api, got {self.host_api_name} and {output.host_api_name}")
+        return DuplexPassthrough(
+            self.index,
+            output.index,
+            chain,
+            rate=int(self.default_sample_rate),
+            channels=min(self.max_input_channels, output.max_output_channels),
+            frames_per_buffer=frames_per_buffer,
+            **options,
+        )
 
     # only for output types
     @property
     def volume_controller(self):
         # TODO: make cross-platform
+        from this_framework_that_i_made.audio_helpers.volume_helpers import WindowVolumeControllerFactory  # pycaw, Windows only
         return WindowVolumeControllerFactory.get_volume_controller_by_audio_endpoint_name(self.name)
 
     def as_dict(self):
@@ -153,7 +268,7 @@ class AudioDevice(SavableObject):
     a program reads. Regardless of where that data is coming from, the audio data should inherently be 
     the same. All I care about is what exists and how I can route it. This should allow for the creation
     of virtual audio devices that take in true endpoints, process them in whatever way, and then return
-    a virtual device that combines the two.
+    a virtual device that combines the two (audio_helpers.mixing.AudioMixer does the combining).
     
     """
 
@@ -178,6 +293,286 @@ class AudioDevice(SavableObject):
         return f"{self.__class__.__name__}({name=}, {hostapis=})"
 
 
+# MME device names come from a 32 char buffer, so anything longer shows up cut to 31 chars
+MME_NAME_LIMIT = 31
+
+
+def _endpoint_keys(devices: List[dict]) -> List[tuple]:
+    """
+    Identities for a table's endpoints that survive rescans, in table order: host api, name,
+    direction, and which one of that name it is. PortAudio has no native endpoint ID, so two
+    identical devices (the same USB headset twice) are told apart by their order. The index
+    isn't part of it, it shifts when devices before this one come and go.
+    """
+    seen = Counter()
+    keys = []
+    for data in devices:
+        identity = (data["hostApi"], data["name"], data["maxInputChannels"] > 0, data["maxOutputChannels"] > 0)
+        keys.append((*identity, seen[identity]))
+        seen[identity] += 1
+    return keys
+
+
+def _endpoint_fields(data: dict) -> dict:
+    # everything that can change under the same identity
+    return {k: v for k, v in data.items() if k != "index"}
+
+
+def normalize_endpoint_name(name: str) -> str:
+    """ The device part of an endpoint name (WASAPI loopback endpoints get a suffix). """
+    return name.removesuffix(PyAudioWrapper.WASAPI_LOOPBACK_SUFFIX)
+
+
+def _full_names_by_prefix(names) -> Dict[str, Optional[str]]:
+    """ MME_NAME_LIMIT prefix -> the longer name it was cut from, None when two names share it. """
+    prefixes = {}
+    for name in names:
+        if len(name) > MME_NAME_LIMIT:
+            prefix = name[:MME_NAME_LIMIT]
+            prefixes[prefix] = name if prefixes.get(prefix, name) == name else None
+    return prefixes
+
+
+def _group_endpoints(endpoints: List[AudioEndpoint]) -> Dict[str, List[AudioEndpoint]]:
+    """
+    Endpoints of the same device across host apis, keyed by its full name. Names are normalized
+    once, truncated MME names are matched to the full name through a prefix dict, so it's linear
+    in the number of endpoints. A truncated name that could belong to two devices stays on its own.
+    """
+    names = [normalize_endpoint_name(e.name) for e in endpoints]
+    prefixes = _full_names_by_prefix(set(names))
+    groups: Dict[str, List[AudioEndpoint]] = {}
+    for endpoint, name in zip(endpoints, names):
+        if len(name) == MME_NAME_LIMIT:
+            name = prefixes.get(name) or name
+        groups.setdefault(name, []).append(endpoint)
+    return groups
+
+
+class _Enumeration:
+
+    """
+    The HostApiData / AudioEndpoint / AudioDevice objects AudioSystem hands out, shared by every
+    AudioSystem and only rebuilt when PortAudioSession's device table changes (rescan after a
+    hotplug `invalidate`, an explicit refresh, or the TTL running out). Endpoints that are still
+    there (by _endpoint_keys identity) keep their object, updated in place if their settings
+    changed, so the same endpoint is the same object across reads.
+    """
+
+    _lock = threading.RLock()
+    generation: Optional[int] = None
+    checked_at = 0.0
+    host_apis: List[HostApiData] = []
+    endpoints: List[AudioEndpoint] = []
+    devices: List[AudioDevice] = []
+    # lookups, rebuilt with the lists
+    endpoint_by_index: Dict[int, AudioEndpoint] = {}
+    device_by_name: Dict[str, AudioDevice] = {}
+    device_by_prefix: Dict[str, Optional[str]] = {}
+    device_by_endpoint: Dict[int, AudioDevice] = {}  # id(endpoint) -> device
+    key_by_endpoint: Dict[int, tuple] = {}  # id(endpoint) -> _endpoint_keys identity
+    endpoints_by_host_api: Dict[str, List[AudioEndpoint]] = {}
+    endpoints_by_type: Dict[AudioEndpointType, List[AudioEndpoint]] = {}
+
+    @classmethod
+    def current(cls, ttl_s: Optional[float], refresh: bool = False):
+        with cls._lock:
+            expired = ttl_s is not None and time.monotonic() - cls.checked_at > ttl_s
+            if refresh or expired or cls.generation is None:
+                cls.checked_at = time.monotonic()
+            table = PortAudioSession.device_table(refresh=refresh or (expired and cls.generation is not None))
+            if table.generation != cls.generation:
+                cls._rebuild(table)
+            return cls
+
+    @classmethod
+    def _rebuild(cls, table):
+        old_host_apis = {(h.name, h.index): h for h in cls.host_apis}
+        host_apis = []
+        for data in table.host_apis:
+            host_api = old_host_apis.get((data["name"], data["index"]))
+            if host_api is None or host_api.init_data != data:
+                host_api = HostApiData(data)
+            host_apis.append(host_api)
+
+        old_endpoints = {cls.key_by_endpoint[id(e)]: e for e in cls.endpoints}
+        keys = _endpoint_keys(table.devices)
+        endpoints = []
+        for key, data in zip(keys, table.devices):
+            endpoint = old_endpoints.pop(key, None)
+            if endpoint is None:
+                endpoint = AudioEndpoint(data)
+            elif endpoint.init_data != data:
+                endpoint._load(data)
+            endpoints.append(endpoint)
+        key_by_endpoint = {id(e): key for e, key in zip(endpoints, keys)}
+
+        old_devices = {d.name: d for d in cls.devices}
+        devices = []
+        for name, members in _group_endpoints(endpoints).items():
+            device = old_devices.get(name)
+            if device is None:
+                device = AudioDevice(name, members)
+            else:
+                device.audio_endpoints[:] = members
+            devices.append(device)
+
+        cls.host_apis, cls.endpoints, cls.devices = host_apis, endpoints, devices
+        cls.key_by_endpoint = key_by_endpoint
+        cls._index(table)
+        cls.generation = table.generation
+        logger.debug("audio enumeration rebuilt: %d endpoints, %d devices", len(endpoints), len(devices))
+
+    @classmethod
+    def _index(cls, table):
+        cls.endpoint_by_index = {e.index: e for e in cls.endpoints}
+        cls.device_by_name = {d.name: d for d in cls.devices}
+        cls.device_by_prefix = _full_names_by_prefix(cls.device_by_name)
+        cls.device_by_endpoint = {id(e): d for d in cls.devices for e in d.audio_endpoints}
+        by_host_api: Dict[str, List[AudioEndpoint]] = {h["name"]: [] for h in table.host_apis}
+        by_type: Dict[AudioEndpointType, List[AudioEndpoint]] = {t: [] for t in AudioEndpointType}
+        for endpoint in cls.endpoints:
+            by_host_api[table.host_api_name(endpoint.host_api_index)].append(endpoint)
+            by_type[endpoint.audio_endpoint_type].append(endpoint)
+        cls.endpoints_by_host_api, cls.endpoints_by_type = by_host_api, by_type
+
+    @classmethod
+    def snapshot(cls, ttl_s: Optional[float], refresh: bool = False) -> "_DeviceSnapshot":
+        """ What a DeviceWatcher compares, taken under the lock so a rebuild can't land halfway. """
+        with cls._lock:
+            cls.current(ttl_s, refresh)
+            endpoints = {}
+            fields = {}
+            for host_api_name, members in cls.endpoints_by_host_api.items():
+                for endpoint in members:
+                    key = cls.key_by_endpoint[id(endpoint)]
+                    endpoints[key] = (endpoint, cls.device_by_endpoint[id(endpoint)].name, host_api_name)
+                    # copied, the endpoint object itself is updated in place by later rebuilds
+                    fields[key] = _endpoint_fields(endpoint.init_data)
+            defaults = {}
+            for host_api in cls.host_apis:
+                for direction, index in ((AudioEndpointType.INPUT, host_api.default_input_device), (AudioEndpointType.OUTPUT, host_api.default_output_device)):
+                    endpoint = cls.endpoint_by_index.get(index)
+                    if endpoint is not None:
+                        defaults[(host_api.name, direction)] = cls.key_by_endpoint[id(endpoint)]
+            return _DeviceSnapshot(cls.generation, endpoints, fields, defaults)
+
+
+class DeviceChangeKind(Enum):
+    ADDED = "added"
+    REMOVED = "removed"
+    CHANGED = "changed"
+    DEFAULT_CHANGED = "default_changed"
+
+
+@ensure_savable
+@dataclass(slots=True)
+class DeviceChange(SavableObject):
+
+    """
+    One endpoint appearing, going away, changing settings (default rate, latencies, channels) or
+    becoming its host api's default input / output.
+    """
+
+    kind: DeviceChangeKind
+    endpoint: AudioEndpoint
+    device_name: str
+    host_api_name: str
+    # INPUT or OUTPUT for DEFAULT_CHANGED, None otherwise
+    direction: Optional[AudioEndpointType] = None
+    # the PortAudio info keys that differ for CHANGED, None otherwise
+    fields: Optional[List[str]] = None
+
+
+@dataclass(slots=True)
+class _DeviceSnapshot:
+    generation: Optional[int]
+    # stable endpoint key -> (endpoint, device name, host api name)
+    endpoints: Dict[tuple, Tuple[AudioEndpoint, str, str]]
+    # stable endpoint key -> its info dict minus the index, as it was when this was taken
+    fields: Dict[tuple, dict]
+    # (host api name, INPUT / OUTPUT) -> stable key of the default endpoint
+    defaults: Dict[Tuple[str, AudioEndpointType], tuple]
+
+    def changes_since(self, old: "_DeviceSnapshot") -> List[DeviceChange]:
+        """ Removals, additions, setting changes, then default switches. Index shifts alone aren't changes. """
+        changes = [
+            DeviceChange(DeviceChangeKind.REMOVED, *old.endpoints[key])
+            for key in old.endpoints.keys() - self.endpoints.keys()
+        ]
+        changes += [
+            DeviceChange(DeviceChangeKind.ADDED, *self.endpoints[key])
+            for key in self.endpoints.keys() - old.endpoints.keys()
+        ]
+        for key in self.endpoints.keys() & old.endpoints.keys():
+            new_fields, old_fields = self.fields[key], old.fields[key]
+            if new_fields != old_fields:
+                changed = sorted(k for k in new_fields.keys() | old_fields.keys() if new_fields.get(k) != old_fields.get(k))
+                changes.append(DeviceChange(DeviceChangeKind.CHANGED, *self.endpoints[key], fields=changed))
+        for (host_api_name, direction), key in self.defaults.items():
+            if old.defaults.get((host_api_name, direction)) != key:
+                endpoint, device_name, _ = self.endpoints[key]
+                changes.append(DeviceChange(DeviceChangeKind.DEFAULT_CHANGED, endpoint, device_name, host_api_name, direction))
+        return changes
+
+
+class DeviceWatcher:
+
+    """
+    Device hotplug as a Stream[DeviceChange], from diffing successive enumeration snapshots on
+    endpoint identities that survive index shifts (host api, name, direction and occurrence, see
+    _endpoint_keys). Anything else about a kept endpoint that differs comes out as CHANGED.
+
+    When the backend has native notifications (audio_backends.watch_native_devices: MMDevice on
+    Windows, the synthetic backend's add/remove_device) they invalidate the device table and wake
+    the watcher straight away, and `poll_interval_s` only catches rescans that had to wait for an
+    open stream to let go of PortAudio, which costs nothing until one happened. Without them
+    every poll is a full rescan.
+    """
+
+    def __init__(self, poll_interval_s: float = 2.0, ttl_s: Optional[float] = None):
+        self.poll_interval_s = poll_interval_s
+        self.ttl_s = AudioSystem.ttl_s if ttl_s is None else ttl_s
+        self.native = False
+
+    def stream(self) -> Stream[DeviceChange]:
+        async def agen():
+            loop = asyncio.get_running_loop()
+            wake = asyncio.Event()
+
+            def on_native_change():
+                PortAudioSession.invalidate()
+                try:
+                    loop.call_soon_threadsafe(wake.set)
+                except RuntimeError:
+                    pass  # loop closed under us, the finally below unregisters
+
+            stop = audio_backends.watch_native_devices(on_native_change)
+            self.native = stop is not None
+            try:
+                # right after registering, so nothing falls between the two. Usually cached, and
+                # it keeps the first scan (if any) off a worker thread
+                state = _Enumeration.snapshot(self.ttl_s)
+                while True:
+                    try:
+                        await asyncio.wait_for(wake.wait(), self.poll_interval_s)
+                    except asyncio.TimeoutError:
+                        pass
+                    wake.clear()
+                    new_state = await asyncio.to_thread(_Enumeration.snapshot, self.ttl_s, not self.native)
+                    if new_state.generation == state.generation:
+                        continue
+                    for change in new_state.changes_since(state):
+                        logger.debug("device %s: %s on %s", change.kind.value, change.endpoint.name, change.host_api_name)
+                        yield change, TimeStamp(now_ns())
+                    state = new_state
+            finally:
+                if stop is not None:
+                    stop()
+
+        return Stream(agen)
+
+
 @ensure_savable
 @dataclass(slots=True)
 class AudioSystem(SavableObject):
@@ -218,11 +613,21 @@ class AudioSystem(SavableObject):
         abstraction can handle the multiple defaults by just returning every specified default
         in the system. It's up to whatever is next to handle those default endpoints.
 
+    Enumeration is cached: reads are served from the last device table scan, rebuilt after a
+    hotplug invalidation, `refresh()`, or once `ttl_s` has passed (None turns that off), and the
+    same device/endpoint is the same object every time.
+
     """
 
+    ttl_s: ClassVar[Optional[float]] = 60.0
+
     @staticproperty
     def host_apis():
-        return [HostApiData(data) for data in PyAudioWrapper.get_host_api_data()]
+        return list(_Enumeration.current(AudioSystem.ttl_s).host_apis)
+
+    def refresh(self):
+        """ Rescans devices now (once no stream holds PortAudio). """
+        _Enumeration.current(self.ttl_s, refresh=True)
 
     @property
     def name_to_host_api(self):
@@ -232,32 +637,36 @@ class AudioSystem(SavableObject):
     @property
     def audio_endpoints(self):
         # remember data["hostapi"] is the index of the hostapi, stupid
-        return [AudioEndpoint(data) for data in PyAudioWrapper.get_audio_endpoint_data()]
-
-    def _get_audio_endpoint_groups(self):
-        name_to_endpoints = {}
-        for audio_endpoint in self.audio_endpoints:
-            # old windows MME driver names are char limited and can't display the full device name
-            name = audio_endpoint.name.rstrip(PyAudioWrapper.WASAPI_LOOPBACK_SUFFIX)
-            # check if the current name is a superset of any existing audio names
-            if any(n in name for n in name_to_endpoints.keys()):
-                target_name = next(n for n in name_to_endpoints.keys() if n in name)
-                name_to_endpoints[target_name].append(audio_endpoint)
-            else:
-                name_to_endpoints[name] = [audio_endpoint]
-        # I want the better names from the other endpoints, so let's pretty it up
-        rename_to_endpoints = {
-            next(reversed([e.name.rstrip(PyAudioWrapper.WASAPI_LOOPBACK_SUFFIX) for e in endpoints])): endpoints
-            for endpoints in name_to_endpoints.values()
-        }
-        return rename_to_endpoints
+        return list(_Enumeration.current(self.ttl_s).endpoints)
 
     @property
     def audio_devices(self):
-        return [
-            AudioDevice(name, audio_endpoints)
-            for name, audio_endpoints in self._get_audio_endpoint_groups().items()
-        ]
+        return list(_Enumeration.current(self.ttl_s).devices)
+
+    def endpoint_by_index(self, index: int) -> Optional[AudioEndpoint]:
+        return _Enumeration.current(self.ttl_s).endpoint_by_index.get(index)
+
+    def device_by_name(self, name: str) -> Optional[AudioDevice]:
+        """ Takes any endpoint's name for the device too, loopback suffix or MME truncation and all. """
+        enumeration = _Enumeration.current(self.ttl_s)
+        name = normalize_endpoint_name(name)
+        device = enumeration.device_by_name.get(name)
+        if device is None and len(name) == MME_NAME_LIMIT:
+            device = enumeration.device_by_name.get(enumeration.device_by_prefix.get(name))
+        return device
+
+    def device_of(self, endpoint: AudioEndpoint) -> Optional[AudioDevice]:
+        return _Enumeration.current(self.ttl_s).device_by_endpoint.get(id(endpoint))
+
+    def endpoints_by_host_api(self, host_api_name: str) -> List[AudioEndpoint]:
+        return list(_Enumeration.current(self.ttl_s).endpoints_by_host_api.get(host_api_name, ()))
+
+    def endpoints_by_type(self, endpoint_type: AudioEndpointType) -> List[AudioEndpoint]:
+        return list(_Enumeration.current(self.ttl_s).endpoints_by_type[endpoint_type])
+
+    def watch(self, poll_interval_s: float = 2.0) -> Stream[DeviceChange]:
+        """ Added / removed / default changed endpoints, see DeviceWatcher. """
+        return DeviceWatcher(poll_interval_s, self.ttl_s).stream()
 
     # def is_endpoint_default_input(self, endpoint):
     #     return endpoint.index == self.name_to_host_api[endpoint.hostapi_name].default_input_device
@@ -1,4 +1,19 @@
-from .wasapi import read_loopback_blocks, LoopbackStream
+import importlib
 
 
-__all__ = ["read_loopback_blocks", "LoopbackStream"]
+# wasapi needs comtypes and Windows, so it's only imported when one of its names is used. That
+# keeps the rest of audio_helpers importable anywhere (CI, the synthetic backend)
+_LAZY = {
+    "read_loopback_blocks": ".wasapi",
+    "read_loopback_pcm_blocks": ".wasapi",
+    "LoopbackStream": ".wasapi",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module(_LAZY[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["read_loopback_blocks", "read_loopback_pcm_blocks", "LoopbackStream"]
@@ -0,0 +1,128 @@
+import importlib
+import logging
+import os
+import platform
+import threading
+from typing import Callable, Optional
+
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Where PyAudio instances come from. Everything in the audio stack goes through `PyAudio()` here
+instead of importing pyaudio itself, so the real PortAudio bindings (pyaudiowpatch on Windows,
+pyaudio elsewhere) are only imported once someone actually opens audio, and a box without sound
+hardware (or without the bindings at all) can run the same code against synthetic devices.
+
+The backend is picked from TFTIM_AUDIO_BACKEND the first time it's needed:
+- unset / "portaudio": the real bindings
+- "synthetic": virtual devices from synthetic_audio, callbacks paced in real time
+- "synthetic-fast": same devices, callbacks as fast as the consumer takes them
+
+or set in code with `set_backend` (before anything opens audio, PortAudioSession notices the
+switch on its next device table read).
+
+Device change notifications go through `watch_native_devices`: a backend with a
+`watch_devices(callback)` (the synthetic one) handles them itself, real PortAudio on Windows gets
+them from MMDevice's IMMNotificationClient, anything else has none and whoever asked polls.
+
+The pa* constants are PortAudio's C values, pyaudio and pyaudiowpatch just re-export them, so
+they're defined here and nothing needs the bindings to build a format table.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ENV = "TFTIM_AUDIO_BACKEND"
+
+# sample formats
+paFloat32 = 0x00000001
+paInt32 = 0x00000002
+paInt24 = 0x00000004
+paInt16 = 0x00000008
+paInt8 = 0x00000010
+paUInt8 = 0x00000020
+
+# callback return values
+paContinue = 0
+paComplete = 1
+paAbort = 2
+
+# callback status flags
+paInputUnderflow = 0x00000001
+paInputOverflow = 0x00000002
+paOutputUnderflow = 0x00000004
+paOutputOverflow = 0x00000008
+paPrimingOutput = 0x00000010
+
+paFramesPerBufferUnspecified = 0
+
+_lock = threading.Lock()
+_backend = None
+
+
+def _portaudio():
+    module = "pyaudiowpatch" if platform.system() == "Windows" else "pyaudio"
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise TftimException(f"{module} isn't installed, set {BACKEND_ENV}=synthetic to run without sound hardware") from e
+
+
+def _from_environment():
+    name = os.environ.get(BACKEND_ENV, "portaudio").strip().lower()
+    if name in ("", "portaudio", "pyaudio"):
+        return _portaudio()
+    if name in ("synthetic", "synthetic-fast"):
+        from this_framework_that_i_made.audio_helpers.synthetic_audio import SyntheticBackend
+        return SyntheticBackend.default(realtime=name == "synthetic")
+    raise TftimException(f"unknown {BACKEND_ENV} {name!r}, expected portaudio, synthetic or synthetic-fast")
+
+
+def get_backend():
+    """ The pyaudio module, or anything else with a `PyAudio()` that behaves like it. """
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = _from_environment()
+            logger.debug("audio backend: %s", getattr(_backend, "__name__", type(_backend).__name__))
+        return _backend
+
+
+def set_backend(backend):
+    """ Switches backends, None goes back to TFTIM_AUDIO_BACKEND. """
+    global _backend
+    with _lock:
+        _backend = backend
+
+
+def PyAudio():
+    return get_backend().PyAudio()
+
+
+def watch_native_devices(callback: Callable[[], None]) -> Optional[Callable[[], None]]:
+    """
+    Calls `callback()` (from whatever thread the notification comes in on) whenever the OS says
+    devices changed. Returns the function that stops it, None if there's nothing to listen to.
+    """
+    backend = get_backend()
+    watch = getattr(backend, "watch_devices", None)
+    if watch is not None:
+        return watch(callback)
+    if platform.system() != "Windows":
+        return None
+    try:
+        from this_framework_that_i_made.audio_helpers.ms_audio_mappings.IMMDeviceEnumerator import PyMmDeviceEnumerator, PyMmNotificationClient
+    except ImportError:
+        logger.debug("comtypes isn't installed, no device notifications")
+        return None
+
+    enumerator = PyMmDeviceEnumerator.create()
+    client = PyMmNotificationClient(lambda event, device_id: callback())
+    enumerator.register_endpoint_notification_callback(client)
+
+    def stop():
+        enumerator.unregister_endpoint_notification_callback(client)
+
+    return stop
@@ -1,18 +1,15 @@
 
 
+from abc import ABC, abstractmethod
 from enum import Enum, auto
-import platform
+import threading
+from typing import Dict, Iterable, Iterator, Tuple
 
 import numpy as np
 
-
-pyaudio = None
-if platform.system() == "Windows":
-    import pyaudiowpatch
-    pyaudio = pyaudiowpatch
-else:
-    import pyaudio
-    pyaudio = pyaudio
+from this_framework_that_i_made.audio_helpers import audio_backends
+from this_framework_that_i_made.generics import TftimException
+from this_framework_that_i_made.streams import Stream
 
 
 class SampleFormat(Enum):
@@ -24,14 +21,16 @@ class SampleFormat(Enum):
 
 
 PYAUDIO_SAMPLE_FORMAT = {
-    SampleFormat.INT_16: pyaudio.paInt16,      # 16-bit signed integer (most common for PCM audio)
-    SampleFormat.INT_24: pyaudio.paInt24,      # 24-bit signed integer
-    SampleFormat.INT_32: pyaudio.paInt32,      # 32-bit signed integer
-    SampleFormat.FLOAT_32: pyaudio.paFloat32,  # 32-bit float (values between –1.0 and +1.0)
-    SampleFormat.UINT_8: pyaudio.paUInt8,      # 8-bit unsigned integer
+    SampleFormat.INT_16: audio_backends.paInt16,      # 16-bit signed integer (most common for PCM audio)
+    SampleFormat.INT_24: audio_backends.paInt24,      # 24-bit signed integer
+    SampleFormat.INT_32: audio_backends.paInt32,      # 32-bit signed integer
+    SampleFormat.FLOAT_32: audio_backends.paFloat32,  # 32-bit float (values between –1.0 and +1.0)
+    SampleFormat.UINT_8: audio_backends.paUInt8,      # 8-bit unsigned integer
 }
 
 
+# the dtype PcmBlock.array decodes into. 24-bit samples arrive packed (3 bytes each) and are
+# sign-extended into int32 containers by unpack_int24, so their values stay within ±2**23.
 NUMPY_SAMPLE_FORMAT = {
     SampleFormat.INT_16: np.int16,
     SampleFormat.INT_24: np.int32,
@@ -41,27 +40,354 @@ NUMPY_SAMPLE_FORMAT = {
 }
 
 
+# bytes per sample on the wire
+SAMPLE_WIDTH = {
+    SampleFormat.INT_16: 2,
+    SampleFormat.INT_24: 3,
+    SampleFormat.INT_32: 4,
+    SampleFormat.FLOAT_32: 4,
+    SampleFormat.UINT_8: 1,
+}
+
+
+def unpack_int24(data, out: np.ndarray = None) -> np.ndarray:
+    """
+    Decodes packed little-endian 24-bit samples into sign-extended int32 values.
+
+    Each sample is scattered into the upper three bytes of a four-byte word through a uint8 view,
+    then one arithmetic right shift over the whole array does the sign extension. `out` can be a
+    preallocated, C-contiguous int32 array with one element per sample.
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if raw.size % 3:
+        raise TftimException(f"packed 24-bit data must be a multiple of 3 bytes, got {raw.size}")
+    count = raw.size // 3
+    if out is None:
+        out = np.empty(count, dtype=np.int32)
+    flat = out.reshape(-1)  # must stay a view, so `out` has to be contiguous
+    if flat.size != count or flat.dtype != np.int32:
+        raise TftimException(f"out must hold {count} int32 samples, got {flat.size} {flat.dtype}")
+    quads = flat.view(np.uint8).reshape(count, 4)
+    quads[:, 0] = 0
+    quads[:, 1:] = raw.reshape(count, 3)
+    np.right_shift(flat, 8, out=flat)
+    return out
+
+
+def pack_int24(samples: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Packs int32 samples holding 24-bit values into little-endian 3-byte samples (uint8 array).
+
+    Values are not clipped, anything outside ±2**23 wraps. Use the sample converter to get there.
+    """
+    flat = np.ascontiguousarray(samples, dtype=np.int32).reshape(-1)
+    if out is None:
+        out = np.empty(flat.size * 3, dtype=np.uint8)
+    out.reshape(-1, 3)[:] = flat.view(np.uint8).reshape(-1, 4)[:, :3]
+    return out
+
+
+# magnitude of full scale once decoded (see NUMPY_SAMPLE_FORMAT), uint8 is offset binary around 128
+FULL_SCALE = {
+    SampleFormat.INT_16: 2**15,
+    SampleFormat.INT_24: 2**23,
+    SampleFormat.INT_32: 2**31,
+    SampleFormat.FLOAT_32: 1.0,
+    SampleFormat.UINT_8: 2**7,
+}
+
+_INT_BITS = {
+    SampleFormat.INT_16: 16,
+    SampleFormat.INT_24: 24,
+    SampleFormat.INT_32: 32,
+    SampleFormat.UINT_8: 8,
+}
+
+
+class SampleConverter:
+
+    """
+    Converts decoded samples (PcmBlock.array) from one SampleFormat to another.
+
+    Every step is an `out=` ufunc, so results land directly in the caller's buffer. Integer to
+    integer conversions are plain shifts, everything else goes through a float scratch buffer
+    that only ever grows, so a converter reused across packets stops allocating after the first
+    one. Float to integer rounds and clips, optionally with ±1 LSB TPDF dither.
+    Not thread-safe, give every thread its own converter.
+    """
+
+    def __init__(self, src_format: SampleFormat, dst_format: SampleFormat, dither: bool = False, rng=None):
+        self.src_format = src_format
+        self.dst_format = dst_format
+        # dither only matters when resolution is lost
+        self.dither = dither and dst_format != SampleFormat.FLOAT_32 and (
+            src_format == SampleFormat.FLOAT_32 or _INT_BITS[dst_format] < _INT_BITS[src_format]
+        )
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self._scratch = {}
+
+    def _get_scratch(self, name, shape, dtype) -> np.ndarray:
+        # flat buffers only ever grow, so varying packet sizes reuse the same memory
+        size = int(np.prod(shape))
+        buf = self._scratch.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = self._scratch[name] = np.empty(size, dtype=dtype)
+        return buf[:size].reshape(shape)
+
+    def convert(self, samples: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(samples.shape, dtype=NUMPY_SAMPLE_FORMAT[self.dst_format])
+        if self.src_format == self.dst_format:
+            np.copyto(out, samples)
+        elif self.dst_format == SampleFormat.FLOAT_32:
+            self._to_float(samples, out)
+        elif self.src_format == SampleFormat.FLOAT_32 or self.dither:
+            self._from_float(samples, out)
+        else:
+            self._int_to_int(samples, out)
+        return out
+
+    def _to_float(self, samples, out):
+        if self.src_format == SampleFormat.UINT_8:
+            np.subtract(samples, 128, out=out, dtype=np.float32)
+            np.multiply(out, np.float32(1 / 128), out=out)
+        else:
+            np.multiply(samples, 1 / FULL_SCALE[self.src_format], out=out, dtype=np.float32)
+
+    def _from_float(self, samples, out):
+        # float32 can't hold int32 full scale exactly, so that one path works in float64
+        work_dtype = np.float64 if self.dst_format == SampleFormat.INT_32 else np.float32
+        work = self._get_scratch("work", samples.shape, work_dtype)
+        scale = FULL_SCALE[self.dst_format]
+        if self.src_format == SampleFormat.UINT_8:
+            np.subtract(samples, 128, out=work, dtype=work_dtype)
+            np.multiply(work, scale / 128, out=work)
+        else:
+            np.multiply(samples, scale / FULL_SCALE[self.src_format], out=work, dtype=work_dtype)
+        if self.dither:
+            # triangular noise spanning ±1 LSB is the difference of two uniform draws
+            noise = self._get_scratch("noise", samples.shape, work_dtype)
+            self.rng.random(dtype=work_dtype, out=noise)
+            np.add(work, noise, out=work)
+            self.rng.random(dtype=work_dtype, out=noise)
+            np.subtract(work, noise, out=work)
+        np.rint(work, out=work)
+        np.clip(work, -scale, scale - 1, out=work)
+        if self.dst_format == SampleFormat.UINT_8:
+            np.add(work, 128, out=work)
+        np.copyto(out, work, casting="unsafe")
+
+    def _int_to_int(self, samples, out):
+        work = out if out.dtype == np.int32 else self._get_scratch("work", samples.shape, np.int32)
+        if self.src_format == SampleFormat.UINT_8:
+            np.subtract(samples, 128, out=work, dtype=np.int32)
+        else:
+            np.copyto(work, samples)
+        shift = _INT_BITS[self.dst_format] - _INT_BITS[self.src_format]
+        if shift > 0:
+            np.left_shift(work, shift, out=work)
+        elif shift < 0:
+            # round to nearest, a bare shift floors and biases everything by -1/2 LSB. Adding
+            # 1 << (-shift - 1) would overflow int32 near full scale, so it's done as a shift
+            # short of the target, +1, and the last shift
+            scale = FULL_SCALE[self.dst_format]
+            np.right_shift(work, -shift - 1, out=work)
+            np.add(work, 1, out=work)
+            np.right_shift(work, 1, out=work)
+            np.clip(work, -scale, scale - 1, out=work)
+        if self.dst_format == SampleFormat.UINT_8:
+            np.add(work, 128, out=work)
+        if work is not out:
+            np.copyto(out, work, casting="unsafe")
+
+
+_local = threading.local()
+
+
+def shared_converter(src_format: SampleFormat, dst_format: SampleFormat, dither: bool = False) -> SampleConverter:
+    """ One converter per format pair and thread, so the scratch buffers outlive a single call. """
+    converters: Dict[Tuple[SampleFormat, SampleFormat, bool], SampleConverter] = getattr(_local, "converters", None)
+    if converters is None:
+        converters = _local.converters = {}
+    key = (src_format, dst_format, dither)
+    converter = converters.get(key)
+    if converter is None:
+        converter = converters[key] = SampleConverter(src_format, dst_format, dither=dither)
+    return converter
+
+
+def convert_samples(
+    samples: np.ndarray,
+    src_format: SampleFormat,
+    dst_format: SampleFormat,
+    out: np.ndarray = None,
+    dither: bool = False,
+) -> np.ndarray:
+    """ Conversion through the calling thread's shared converter for the pair. """
+    return shared_converter(src_format, dst_format, dither).convert(samples, out=out)
+
+
 class PcmBlock:
 
     """ Pulse Code Modulation Blocks """
 
-    __slots__ = ("_bytes", "_dtype", "_channels", "_array")
+    __slots__ = ("_bytes", "_sample_format", "_channels", "_array", "rate", "pts_ns")
 
-    def __init__(self, data: bytes, dtype, channels: int):
+    def __init__(
+        self,
+        data: bytes,
+        sample_format: SampleFormat,
+        channels: int,
+        rate: int = None,
+        pts_ns: int = None,
+    ):
         self._bytes = data                # wire format
-        self._dtype = dtype
+        self._sample_format = sample_format
         self._channels = channels
         self._array = None                # created lazily
+        self.rate = rate                  # frames per second, None if the producer doesn't know
+        self.pts_ns = pts_ns              # presentation time of the first frame
+
+    @classmethod
+    def from_array(
+        cls,
+        array: np.ndarray,
+        sample_format: SampleFormat,
+        channels: int = None,
+        rate: int = None,
+        pts_ns: int = None,
+    ):
+        """ Wraps already decoded samples, the wire bytes are then encoded lazily. """
+        channels = channels or (array.shape[1] if array.ndim > 1 else 1)
+        block = cls(None, sample_format, channels, rate=rate, pts_ns=pts_ns)
+        block._array = array
+        return block
+
+    @property
+    def sample_format(self) -> SampleFormat:
+        return self._sample_format
+
+    @property
+    def dtype(self):
+        return NUMPY_SAMPLE_FORMAT[self._sample_format]
+
+    @property
+    def channels(self) -> int:
+        return self._channels
+
+    @property
+    def frames(self) -> int:
+        if self._bytes is None:
+            return self._array.shape[0] if self._array.ndim > 1 else self._array.size // self._channels
+        return len(self._bytes) // (SAMPLE_WIDTH[self._sample_format] * self._channels)
 
     @property
     def bytes(self) -> bytes:
+        if self._bytes is None:
+            if self._sample_format == SampleFormat.INT_24:
+                self._bytes = pack_int24(self._array).tobytes()
+            else:
+                self._bytes = np.ascontiguousarray(self._array, dtype=self.dtype).tobytes()
         return self._bytes                # send over network
 
+    @property
+    def buffer(self):
+        """ Wire format as any bytes-like object, skips the copy `bytes` makes for decoded blocks. """
+        if self._bytes is None and self._sample_format != SampleFormat.INT_24:
+            return np.ascontiguousarray(self._array, dtype=self.dtype)
+        return self.bytes
+
+    def convert(self, to: SampleFormat, out: np.ndarray = None, dither: bool = False) -> "PcmBlock":
+        """ Returns this block in another sample format, `out` is an optional preallocated destination. """
+        samples = convert_samples(self.array, self._sample_format, to, out=out, dither=dither)
+        return PcmBlock.from_array(samples, to, self._channels, rate=self.rate, pts_ns=self.pts_ns)
+
     @property
     def array(self) -> np.ndarray:
         if self._array is None:
-            arr = np.frombuffer(self._bytes, dtype=self._dtype)   # zero-copy view
+            if self._sample_format == SampleFormat.INT_24:
+                arr = unpack_int24(self._bytes)                   # one vectorized decode pass
+            else:
+                arr = np.frombuffer(self._bytes, dtype=self.dtype)  # zero-copy view
             if self._channels > 1:
                 arr = arr.reshape(-1, self._channels)             # still a view
             self._array = arr
         return self._array
+
+
+class PcmSilence(PcmBlock):
+
+    """
+    Marker for `frames` frames of digital silence, a few bytes instead of a block's worth of
+    zeros. Stages that check for it (mixer, archive, transports) skip the work, everything else
+    sees an ordinary block of zeros through `array` / `bytes`, which are only built on demand.
+    """
+
+    __slots__ = ("_frames",)
+
+    def __init__(self, frames: int, sample_format: SampleFormat, channels: int, rate: int = None, pts_ns: int = None):
+        super().__init__(None, sample_format, channels, rate=rate, pts_ns=pts_ns)
+        self._frames = frames
+
+    @property
+    def frames(self) -> int:
+        return self._frames
+
+    @property
+    def bytes(self) -> bytes:
+        if self._bytes is None:
+            size = self._frames * self._channels * SAMPLE_WIDTH[self._sample_format]
+            self._bytes = b"\x80" * size if self._sample_format == SampleFormat.UINT_8 else bytes(size)
+        return self._bytes
+
+    @property
+    def buffer(self):
+        return self.bytes
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            shape = (self._frames, self._channels) if self._channels > 1 else (self._frames,)
+            fill = 128 if self._sample_format == SampleFormat.UINT_8 else 0
+            self._array = np.full(shape, fill, dtype=self.dtype)
+        return self._array
+
+    def convert(self, to: SampleFormat, out: np.ndarray = None, dither: bool = False) -> "PcmSilence":
+        silence = PcmSilence(self._frames, to, self._channels, rate=self.rate, pts_ns=self.pts_ns)
+        if out is not None:
+            # the caller reads `out`, so it has to hold the silence too
+            out.fill(128 if to == SampleFormat.UINT_8 else 0)
+            silence._array = out
+        return silence
+
+    def __repr__(self):
+        return f"PcmSilence({self._frames} frames, {self._channels}ch {self._sample_format.name}, pts_ns={self.pts_ns})"
+
+
+class PcmStage(ABC):
+
+    """ A stateful step in a PcmBlock pipeline. Each block in can produce zero or more blocks out. """
+
+    @abstractmethod
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        ...
+
+    def flush(self) -> Iterator[PcmBlock]:
+        """ Emits whatever is still buffered once the input has ended. """
+        return iter(())
+
+    def apply(self, blocks: Iterable[PcmBlock]) -> Iterator[PcmBlock]:
+        for block in blocks:
+            yield from self.process(block)
+        yield from self.flush()
+
+    def apply_stream(self, stream: Stream[PcmBlock]) -> Stream[PcmBlock]:
+        async def agen():
+            ts = None
+            async for block, ts in stream:
+                for out in self.process(block):
+                    yield (out, ts)
+            for out in self.flush():
+                yield (out, ts)
+
+        return Stream(agen)
@@ -0,0 +1,335 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+IIR filters are recursive, so the usual numpy trick of "one ufunc over the whole array" doesn't
+apply, and a per-sample python loop is far too slow for audio. Over a segment of n samples any
+IIR is still linear though:
+
+    y = H @ x + Z @ state
+
+where H is the (n, n) lower triangular matrix of the impulse response and Z maps the filter's
+past inputs/outputs onto the segment. Both only depend on the coefficients and n, so they are
+built once, and filtering becomes a couple of matmuls per segment, over as many rows (channels,
+streams) as you stack together.
+
+DspProcessors are the real-time side: steps that work in place on (channels, frames) float32,
+allocate everything in `prepare` and then only run `out=` ufuncs and matmuls, so a DspChain can
+run inside an audio callback (see pyaudio_helper.DuplexPassthrough).
+
+"""
+
+
+def _simulate(b, a, x, x_hist, y_hist):
+    """ Direct form I reference loop, only used to build the segment matrices. """
+    x_hist, y_hist = list(x_hist), list(y_hist)
+    y = []
+    for sample in x:
+        out = b[0] * sample
+        out += sum(bk * xk for bk, xk in zip(b[1:], x_hist))
+        out -= sum(ak * yk for ak, yk in zip(a[1:], y_hist))
+        x_hist = ([sample] + x_hist)[:len(b) - 1]
+        y_hist = ([out] + y_hist)[:len(a) - 1]
+        y.append(out)
+    return y
+
+
+class BlockIir:
+
+    """
+    Stateful IIR filter applied to (rows, samples) arrays, one row per independent signal.
+
+    State layout per row is [x[-1], x[-2], ..., y[-1], y[-2], ...] (direct form I). Blocks of any
+    length are split into `segment`-sized matmuls, the matrices for each length are cached.
+    """
+
+    def __init__(self, b: Sequence[float], a: Sequence[float], segment: int = 128):
+        b = np.asarray(b, dtype=np.float64)
+        a = np.asarray(a, dtype=np.float64)
+        self.b = b / a[0]
+        self.a = a / a[0]
+        self.nb = len(b) - 1
+        self.na = len(a) - 1
+        self.segment = segment
+        self._matrices = {}
+
+    @property
+    def state_size(self) -> int:
+        return self.nb + self.na
+
+    def initial_state(self, rows: int) -> np.ndarray:
+        return np.zeros((rows, self.state_size), dtype=np.float32)
+
+    def _get_matrices(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        matrices = self._matrices.get(n)
+        if matrices is None:
+            b, a = self.b.tolist(), self.a.tolist()
+            impulse = _simulate(b, a, [1.0] + [0.0] * (n - 1), [0.0] * self.nb, [0.0] * self.na)
+            h_t = np.zeros((n, n))
+            for i in range(n):
+                h_t[i, i:] = impulse[:n - i]  # transposed, rows are input samples
+            z_t = np.zeros((self.state_size, n))
+            for j in range(self.state_size):
+                unit = [0.0] * self.state_size
+                unit[j] = 1.0
+                z_t[j] = _simulate(b, a, [0.0] * n, unit[:self.nb], unit[self.nb:])
+            matrices = self._matrices[n] = (h_t.astype(np.float32), z_t.astype(np.float32))
+        return matrices
+
+    def filter(self, x: np.ndarray, state: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """ Filters `x` (rows, samples) into `out`, advancing `state` (rows, state_size) in place. """
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float32)
+        total = x.shape[1]
+        for start in range(0, total, self.segment):
+            end = min(total, start + self.segment)
+            h_t, z_t = self._get_matrices(end - start)
+            seg_out = out[:, start:end]
+            np.matmul(x[:, start:end], h_t, out=seg_out)
+            seg_out += state @ z_t
+            self._advance(state, x[:, start:end], seg_out)
+        return out
+
+    def _advance(self, state, x_seg, y_seg):
+        for history, offset, size in ((x_seg, 0, self.nb), (y_seg, self.nb, self.na)):
+            if not size:
+                continue
+            n = history.shape[1]
+            if n >= size:
+                # the common case, the whole state comes from this segment (newest first)
+                state[:, offset:offset + size] = history[:, n - 1:n - size - 1 if n > size else None:-1]
+                continue
+            old = state[:, offset:offset + size][:, ::-1]  # chronological order
+            merged = np.concatenate([old, history], axis=1)[:, -size:]
+            state[:, offset:offset + size] = merged[:, ::-1]
+
+
+@lru_cache(maxsize=8)
+def k_weighting(rate: float) -> Tuple[BlockIir, BlockIir]:
+    """
+    ITU-R BS.1770 K-weighting (head shelf, then RLB high pass) at any sample rate.
+
+    Uses the bilinear-transform derivation (same as libebur128), which reproduces the spec's
+    48 kHz coefficients exactly, unlike the cookbook shelf. Cached per rate, the filters only
+    hold coefficients and segment matrices so every meter at that rate can share them.
+    """
+    k = np.tan(np.pi * 1681.974450955533 / rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    k = np.tan(np.pi * 38.13547087602444 / rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    rlb_b = [1.0, -2.0, 1.0]
+    rlb_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return BlockIir(shelf_b, shelf_a), BlockIir(rlb_b, rlb_a)
+
+
+class DspProcessor(ABC):
+
+    """ One in-place step on (channels, frames) float32. Allocate in `prepare`, not in `process`. """
+
+    def prepare(self, rate: int, channels: int, max_frames: int):
+        """ Called before audio flows, and again whenever the stream format changes. """
+
+    @abstractmethod
+    def process(self, x: np.ndarray) -> None:
+        ...
+
+
+class DspChain(DspProcessor):
+
+    def __init__(self, processors: Sequence[DspProcessor] = ()):
+        self.processors: List[DspProcessor] = list(processors)
+
+    def prepare(self, rate: int, channels: int, max_frames: int):
+        for processor in self.processors:
+            processor.prepare(rate, channels, max_frames)
+
+    def process(self, x: np.ndarray) -> None:
+        for processor in self.processors:
+            processor.process(x)
+
+
+class Gain(DspProcessor):
+
+    """ Gain in dB. Changes ramp linearly over one block so they don't click. """
+
+    def __init__(self, db: float = 0.0):
+        self._gain = self._target = float(10 ** (db / 20))
+        self._ramp = None
+        self._work = None
+
+    @property
+    def db(self) -> float:
+        return 20 * np.log10(self._target) if self._target > 0 else -np.inf
+
+    def set_db(self, db: float):
+        self._target = float(10 ** (db / 20))
+
+    def prepare(self, rate: int, channels: int, max_frames: int):
+        self._ramp = (np.arange(1, max_frames + 1) / max_frames).astype(np.float32)
+        self._work = np.empty(max_frames, dtype=np.float32)
+
+    def process(self, x: np.ndarray) -> None:
+        target = self._target
+        if target == self._gain:
+            if target != 1.0:
+                np.multiply(x, np.float32(target), out=x)
+            return
+        n = x.shape[1]
+        ramp = self._work[:n]
+        # from the current gain to the target across this block
+        np.multiply(self._ramp[:n], np.float32((target - self._gain) * len(self._ramp) / n), out=ramp)
+        np.add(ramp, np.float32(self._gain), out=ramp)
+        np.multiply(x, ramp, out=x)
+        self._gain = target
+
+
+class BiquadType(Enum):
+    PEAKING = "peaking"
+    LOW_SHELF = "low_shelf"
+    HIGH_SHELF = "high_shelf"
+    LOW_PASS = "low_pass"
+    HIGH_PASS = "high_pass"
+    NOTCH = "notch"
+
+
+@lru_cache(maxsize=64)
+def biquad_coefficients(kind: BiquadType, rate: float, freq: float, q: float = 0.7071, gain_db: float = 0.0):
+    """ (b, a) from the RBJ audio EQ cookbook. """
+    w0 = 2 * np.pi * freq / rate
+    cos, alpha = np.cos(w0), np.sin(w0) / (2 * q)
+    amp = 10 ** (gain_db / 40)
+    root = 2 * np.sqrt(amp) * alpha
+    if kind == BiquadType.PEAKING:
+        b = [1 + alpha * amp, -2 * cos, 1 - alpha * amp]
+        a = [1 + alpha / amp, -2 * cos, 1 - alpha / amp]
+    elif kind == BiquadType.LOW_SHELF:
+        b = [amp * ((amp + 1) - (amp - 1) * cos + root), 2 * amp * ((amp - 1) - (amp + 1) * cos), amp * ((amp + 1) - (amp - 1) * cos - root)]
+        a = [(amp + 1) + (amp - 1) * cos + root, -2 * ((amp - 1) + (amp + 1) * cos), (amp + 1) + (amp - 1) * cos - root]
+    elif kind == BiquadType.HIGH_SHELF:
+        b = [amp * ((amp + 1) + (amp - 1) * cos + root), -2 * amp * ((amp - 1) + (amp + 1) * cos), amp * ((amp + 1) + (amp - 1) * cos - root)]
+        a = [(amp + 1) - (amp - 1) * cos + root, 2 * ((amp - 1) - (amp + 1) * cos), (amp + 1) - (amp - 1) * cos - root]
+    elif kind == BiquadType.LOW_PASS:
+        b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == BiquadType.HIGH_PASS:
+        b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == BiquadType.NOTCH:
+        b = [1.0, -2 * cos, 1.0]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+    else:
+        raise TftimException(f"unknown biquad type {kind}")
+    return tuple(float(v) for v in b), tuple(float(v) for v in a)
+
+
+class Biquad(DspProcessor):
+
+    """
+    EQ band through BlockIir, all channels in one matmul per segment. `set` swaps in a new filter
+    (built on the calling thread) and keeps the state, so bands can be moved while audio runs.
+    """
+
+    def __init__(self, kind: BiquadType, freq: float, q: float = 0.7071, gain_db: float = 0.0):
+        self.kind = kind
+        self.freq = freq
+        self.q = q
+        self.gain_db = gain_db
+        self._rate = None
+        self._filter = None
+        self._state = None
+        self._work = None
+
+    def _build(self) -> BlockIir:
+        b, a = biquad_coefficients(self.kind, self._rate, self.freq, self.q, self.gain_db)
+        iir = BlockIir(b, a, segment=min(128, self._work.shape[1]))
+        for n in {iir.segment, self._work.shape[1] % iir.segment} - {0}:
+            iir._get_matrices(n)  # build them here, not in the callback
+        return iir
+
+    def set(self, freq: float = None, q: float = None, gain_db: float = None):
+        self.freq = self.freq if freq is None else freq
+        self.q = self.q if q is None else q
+        self.gain_db = self.gain_db if gain_db is None else gain_db
+        if self._rate is not None:
+            self._filter = self._build()
+
+    def prepare(self, rate: int, channels: int, max_frames: int):
+        self._rate = rate
+        self._work = np.empty((channels, max_frames), dtype=np.float32)
+        self._filter = self._build()
+        self._state = self._filter.initial_state(channels)
+
+    def process(self, x: np.ndarray) -> None:
+        out = self._work[:, :x.shape[1]]
+        self._filter.filter(x, self._state, out=out)
+        np.copyto(x, out)
+
+
+class Limiter(DspProcessor):
+
+    """
+    Peak limiter with instant attack, so no sample ever leaves above `threshold_db`, and a release
+    of `release_db_per_s`. The envelope recursion e[n] = min(required[n], e[n-1] + step) is a
+    running minimum of required[k] - k * step, so the whole block is one np.minimum.accumulate.
+    Channels are linked (one gain for all of them).
+    """
+
+    def __init__(self, threshold_db: float = -1.0, release_db_per_s: float = 60.0):
+        self.threshold_db = threshold_db
+        self.release_db_per_s = release_db_per_s
+        self._envelope_db = 0.0
+        self._steps = None
+        self._step = None
+        self._magnitude = None
+        self._peak = None
+        self._gain = None
+
+    @property
+    def gain_reduction_db(self) -> float:
+        return -self._envelope_db
+
+    def prepare(self, rate: int, channels: int, max_frames: int):
+        step = self.release_db_per_s / rate
+        self._steps = (np.arange(max_frames, dtype=np.float64) * step).astype(np.float32)
+        self._step = np.float32(step)
+        self._magnitude = np.empty((channels, max_frames), dtype=np.float32)
+        self._peak = np.empty(max_frames, dtype=np.float32)
+        self._gain = np.empty(max_frames, dtype=np.float32)
+
+    def process(self, x: np.ndarray) -> None:
+        n = x.shape[1]
+        peak, gain, steps = self._peak[:n], self._gain[:n], self._steps[:n]
+        magnitude = self._magnitude[:, :n]
+        np.abs(x, out=magnitude)
+        np.max(magnitude, axis=0, out=peak)
+        np.maximum(peak, np.float32(1e-12), out=peak)
+        # required gain in dB, 0 where the signal is under the threshold
+        np.log10(peak, out=peak)
+        np.multiply(peak, np.float32(-20), out=peak)
+        np.add(peak, np.float32(self.threshold_db), out=peak)
+        np.minimum(peak, 0, out=peak)
+        # e[k] = min(e[-1] + (k + 1) * step, min over j <= k of required[j] + (k - j) * step)
+        np.subtract(peak, steps, out=gain)
+        gain[0] = min(gain[0], self._envelope_db + self._step)
+        np.minimum.accumulate(gain, out=gain)
+        np.add(gain, steps, out=gain)
+        np.minimum(gain, 0, out=gain)
+        self._envelope_db = float(gain[-1])
+        np.multiply(gain, np.float32(1 / 20), out=gain)
+        np.power(np.float32(10), gain, out=gain)
+        np.multiply(x, gain, out=x)
@@ -0,0 +1,317 @@
+import bz2
+import lzma
+import struct
+import zlib
+from enum import Enum
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import (
+    NUMPY_SAMPLE_FORMAT,
+    SAMPLE_WIDTH,
+    PcmBlock,
+    PcmSilence,
+    PcmStage,
+    SampleFormat,
+)
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Lossless block codec for PcmBlocks, for recording lots of streams or sending them over a socket.
+
+Per block:
+- samples become integers: int formats as they are, float32 either as the int16/int24 grid it
+  came from (most float mix formats carry 16 or 24 bit sources) or as its bit pattern, remapped
+  so that nearby floats are nearby integers
+- stereo can be stored as left + (left - right) when that's smaller
+- each channel picks the fixed polynomial predictor (orders 0-3, FLAC style) with the smallest
+  residual, all orders are scored in one vectorized pass
+- residuals are byte-shuffled (high bytes of small residuals are nearly all 0x00 / 0xff) and
+  handed to zlib, bz2 or lzma
+
+All integer work wraps around in the sample width, so prediction and reconstruction (cumsum)
+are exact without any headroom bits.
+
+Every encoded block is one self-delimiting frame: a fixed header followed by `payload_size`
+bytes, so frames can be concatenated into a file or written straight onto a socket.
+
+"""
+
+
+class Compressor(Enum):
+    NONE = 0
+    ZLIB = 1
+    BZ2 = 2
+    LZMA = 3
+
+
+MAGIC = b"PCMZ"
+# magic, flags, sample format, channels, compressor, rate, frames, pts_ns, payload size
+_HEADER = struct.Struct("<4sBBBBIIqI")
+HEADER_SIZE = _HEADER.size
+
+_SILENCE = 0x01
+_HAS_PTS = 0x02
+_SIDE = 0x04          # channel 1 holds channel 0 minus channel 1
+_FLOAT_BITS = 0x08    # float32 bit patterns, remapped to ordered integers
+_FLOAT_GRID16 = 0x10  # float32 that are all multiples of 2**-15
+_FLOAT_GRID24 = 0x20  # float32 that are all multiples of 2**-23
+
+# wire codes, independent from the enum's own values
+_FORMAT_CODES = {
+    SampleFormat.INT_16: 1,
+    SampleFormat.INT_24: 2,
+    SampleFormat.INT_32: 3,
+    SampleFormat.FLOAT_32: 4,
+    SampleFormat.UINT_8: 5,
+}
+_FORMATS = {code: sample_format for sample_format, code in _FORMAT_CODES.items()}
+
+MAX_ORDER = 3
+
+
+def _compress(data: bytes, compressor: Compressor, level: int) -> bytes:
+    if compressor == Compressor.ZLIB:
+        return zlib.compress(data, level)
+    if compressor == Compressor.BZ2:
+        return bz2.compress(data, level)
+    if compressor == Compressor.LZMA:
+        return lzma.compress(data, preset=level)
+    return bytes(data)
+
+
+def _decompress(data, compressor: Compressor) -> bytes:
+    if compressor == Compressor.ZLIB:
+        return zlib.decompress(data)
+    if compressor == Compressor.BZ2:
+        return bz2.decompress(data)
+    if compressor == Compressor.LZMA:
+        return lzma.decompress(data)
+    return bytes(data)
+
+
+def _flip_float_bits(ints: np.ndarray) -> np.ndarray:
+    # sign-magnitude -> two's complement ordering (and back, it's its own inverse)
+    return ints ^ ((ints >> 31) & 0x7FFFFFFF)
+
+
+def _to_ints(block: PcmBlock) -> Tuple[np.ndarray, int]:
+    """ Samples as (frames, channels) integers in the dtype the residuals will wrap in, plus flags. """
+    samples = block.array.reshape(-1, block.channels)
+    sample_format = block.sample_format
+    if sample_format == SampleFormat.UINT_8:
+        return (samples ^ np.uint8(0x80)).view(np.int8), 0
+    if sample_format != SampleFormat.FLOAT_32:
+        return samples, 0
+    if np.isfinite(samples).all():
+        for flag, scale in ((_FLOAT_GRID16, 2.0 ** 15), (_FLOAT_GRID24, 2.0 ** 23)):
+            scaled = samples * np.float32(scale)
+            if np.abs(scaled).max(initial=0) <= scale and np.array_equal(scaled, np.rint(scaled)):
+                ints = scaled.astype(np.int32)
+                # -0.0 would come back as 0.0
+                if np.array_equal(np.signbit(samples), ints < 0):
+                    return ints, flag
+    return _flip_float_bits(np.ascontiguousarray(samples).view(np.int32)), _FLOAT_BITS
+
+
+def _from_ints(ints: np.ndarray, sample_format: SampleFormat, flags: int) -> np.ndarray:
+    if sample_format == SampleFormat.UINT_8:
+        return ints.view(np.uint8) ^ np.uint8(0x80)
+    if flags & _FLOAT_BITS:
+        return _flip_float_bits(ints).view(np.float32)
+    if flags & _FLOAT_GRID16:
+        return ints.astype(np.float32) * np.float32(2.0 ** -15)
+    if flags & _FLOAT_GRID24:
+        return ints.astype(np.float32) * np.float32(2.0 ** -23)
+    return ints.astype(NUMPY_SAMPLE_FORMAT[sample_format], copy=False)
+
+
+def _residuals(wide: np.ndarray, max_order: int) -> List[np.ndarray]:
+    """ (channels, frames) int64 -> residuals of every predictor order, history before the block is 0. """
+    orders = [wide]
+    for _ in range(max_order):
+        orders.append(np.diff(orders[-1], axis=1, prepend=0))
+    return orders
+
+
+class PcmCodec:
+
+    """
+    Encodes PcmBlocks into frames and back. `level` is the compressor's level (1-9), lower is
+    faster. Stateless between blocks, so frames decode independently and in any order, and a
+    lost frame only loses itself.
+    """
+
+    def __init__(self, compressor: Compressor = Compressor.ZLIB, level: int = 6, max_order: int = MAX_ORDER):
+        if not 0 <= max_order <= MAX_ORDER:
+            raise TftimException(f"max_order must be between 0 and {MAX_ORDER}, got {max_order}")
+        self.compressor = compressor
+        self.level = level
+        self.max_order = max_order
+
+    def encode(self, block: PcmBlock) -> bytes:
+        flags = _HAS_PTS if block.pts_ns is not None else 0
+        if isinstance(block, PcmSilence) or not block.frames:
+            return self._header(block, flags | _SILENCE, 0)
+
+        ints, value_flags = _to_ints(block)
+        flags |= value_flags
+        dtype = ints.dtype
+        # planar, one channel after the other, so every reduction below runs over contiguous rows
+        wide = np.array(ints.T, dtype=np.int64, order="C")
+        if block.channels == 2:
+            side = wide[0] - wide[1]
+            if np.abs(np.diff(side)).sum() < np.abs(np.diff(wide[1])).sum():
+                wide[1] = side
+                flags |= _SIDE
+
+        residuals = _residuals(wide, self.max_order)
+        costs = np.stack([np.abs(r).sum(axis=1) for r in residuals])
+        orders = costs.argmin(axis=0)
+        # back to the sample width, wrapping around where needed
+        planar = np.empty((block.channels, block.frames), dtype=dtype)
+        for channel, order in enumerate(orders):
+            planar[channel] = residuals[order][channel]
+        shuffled = planar.reshape(-1).view(np.uint8).reshape(-1, dtype.itemsize).T
+        payload = _compress(np.ascontiguousarray(shuffled).data, self.compressor, self.level)
+        return self._header(block, flags, block.channels + len(payload)) + orders.astype(np.uint8).tobytes() + payload
+
+    def _header(self, block: PcmBlock, flags: int, payload_size: int) -> bytes:
+        return _HEADER.pack(
+            MAGIC,
+            flags,
+            _FORMAT_CODES[block.sample_format],
+            block.channels,
+            self.compressor.value,
+            block.rate or 0,
+            block.frames,
+            block.pts_ns if block.pts_ns is not None else 0,
+            payload_size,
+        )
+
+    @staticmethod
+    def decode(frame) -> PcmBlock:
+        block, end = PcmCodec.decode_from(frame)
+        if end != len(frame):
+            raise TftimException(f"{len(frame) - end} trailing bytes after the frame")
+        return block
+
+    @staticmethod
+    def decode_from(buffer, offset: int = 0) -> Tuple[PcmBlock, int]:
+        """ Decodes the frame starting at `offset`, returns the block and where the next frame starts. """
+        header = read_header(buffer, offset)
+        flags, sample_format, channels, compressor, rate, frames, pts_ns, payload_size = header
+        start = offset + HEADER_SIZE
+        end = start + payload_size
+        if len(buffer) < end:
+            raise TftimException(f"truncated frame, need {end - offset} bytes, got {len(buffer) - offset}")
+        if flags & _SILENCE:
+            return PcmSilence(frames, sample_format, channels, rate=rate, pts_ns=pts_ns), end
+
+        orders = bytes(buffer[start:start + channels])
+        raw = _decompress(buffer[start + channels:end], compressor)
+        if sample_format == SampleFormat.UINT_8:
+            dtype = np.dtype(np.int8)
+        elif sample_format == SampleFormat.INT_16:
+            dtype = np.dtype(np.int16)
+        else:
+            dtype = np.dtype(np.int32)
+        planes = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, -1)
+        planar = planes.T.copy().view(dtype).reshape(channels, frames)
+        for channel, order in enumerate(orders):
+            for _ in range(order):
+                np.cumsum(planar[channel], dtype=dtype, out=planar[channel])  # wraps in the sample width
+        ints = np.ascontiguousarray(planar.T)
+        if flags & _SIDE:
+            ints[:, 1] = ints[:, 0] - ints[:, 1]
+        samples = _from_ints(ints, sample_format, flags)
+        if channels == 1:
+            samples = samples.reshape(-1)
+        return PcmBlock.from_array(samples, sample_format, channels, rate=rate, pts_ns=pts_ns), end
+
+
+def read_header(buffer, offset: int = 0) -> tuple:
+    """ (flags, sample format, channels, compressor, rate, frames, pts_ns, payload size) of a frame. """
+    if len(buffer) - offset < HEADER_SIZE:
+        raise TftimException(f"truncated frame header at {offset}")
+    magic, flags, format_code, channels, compressor, rate, frames, pts_ns, payload_size = _HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC:
+        raise TftimException(f"not a PCM frame at offset {offset}")
+    return (
+        flags,
+        _FORMATS[format_code],
+        channels,
+        Compressor(compressor),
+        rate or None,
+        frames,
+        pts_ns if flags & _HAS_PTS else None,
+        payload_size,
+    )
+
+
+class FrameDecoder:
+
+    """ Incremental decoder for byte streams (sockets), `feed` whatever arrived and get whole blocks back. """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[PcmBlock]:
+        self._buffer += data
+        blocks = []
+        offset = 0
+        while len(self._buffer) - offset >= HEADER_SIZE:
+            payload_size = read_header(self._buffer, offset)[-1]
+            if len(self._buffer) - offset < HEADER_SIZE + payload_size:
+                break
+            block, offset = PcmCodec.decode_from(self._buffer, offset)
+            blocks.append(block)
+        del self._buffer[:offset]
+        return blocks
+
+
+class CompressedPcmWriter(PcmStage):
+
+    """ Pass-through stage appending every block as a frame to a binary file object (or socket.makefile). """
+
+    def __init__(self, fileobj: BinaryIO, codec: PcmCodec = None):
+        self.fileobj = fileobj
+        self.codec = codec or PcmCodec()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        frame = self.codec.encode(block)
+        self.fileobj.write(frame)
+        self.bytes_in += block.frames * block.channels * SAMPLE_WIDTH[block.sample_format]
+        self.bytes_out += len(frame)
+        yield block
+
+    def flush(self) -> Iterator[PcmBlock]:
+        self.fileobj.flush()
+        return iter(())
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+def read_compressed(fileobj: BinaryIO) -> Iterator[PcmBlock]:
+    """ Decodes frames from a file object until it runs out. """
+    while True:
+        header = fileobj.read(HEADER_SIZE)
+        if not header:
+            return
+        payload_size = read_header(header)[-1]
+        frame = header + fileobj.read(payload_size)
+        yield PcmCodec.decode(frame)
+
+
+def compress_pcm_blocks(blocks: Iterable[PcmBlock], codec: Optional[PcmCodec] = None) -> Iterator[bytes]:
+    """ Convenience wrapper for plain iterators. """
+    codec = codec or PcmCodec()
+    for block in blocks:
+        yield codec.encode(block)
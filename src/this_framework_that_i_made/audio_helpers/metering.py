@@ -0,0 +1,273 @@
+from dataclasses import dataclass
+from typing import Dict, Hashable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, PcmStage, SampleConverter, SampleFormat
+from this_framework_that_i_made.audio_helpers.dsp import k_weighting
+from this_framework_that_i_made.audio_helpers.resampling import ResamplerQuality, get_polyphase_bank
+from this_framework_that_i_made.generics import SavableObject, TftimException, ensure_savable
+
+
+"""
+
+Level metering (peak, RMS, true peak, BS.1770 loudness) for PcmBlock streams.
+
+- the heavy part (K-weighting, 4x oversampled true peak) runs on (rows, samples) float32 arrays,
+  one row per channel, so MeterBank can stack the channels of dozens of streams and meter them
+  all with one call per (rate, block size)
+- loudness is tracked in 100 ms sub-blocks: momentary is the last 4, short-term the last 30 and
+  integrated comes from a 0.1 LU histogram of the 400 ms gating blocks, so memory is constant no
+  matter how long a stream runs
+
+"""
+
+LUFS_OFFSET = -0.691
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+_HIST_BINS = 1000           # 0.1 LU bins from the absolute gate up to +30 LUFS
+_SHORT_TERM_SUB_BLOCKS = 30
+_MOMENTARY_SUB_BLOCKS = 4
+
+
+def _power_db(values) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10(values)
+
+
+def _default_channel_weights(channels: int) -> np.ndarray:
+    if channels == 6:
+        # L, R, C, LFE, Ls, Rs. surrounds get +1.5 dB and the LFE is ignored
+        return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    return np.ones(channels)
+
+
+def _true_peak_bank() -> np.ndarray:
+    return get_polyphase_bank(4, 1, ResamplerQuality.FAST)
+
+
+@ensure_savable
+@dataclass(slots=True)
+class LevelReading(SavableObject):
+    # per channel, in dBFS (dBTP for true peak) for the last block
+    peak_db: np.ndarray
+    rms_db: np.ndarray
+    true_peak_db: np.ndarray
+    # whole stream, in LUFS. -inf until there's enough audio
+    momentary_lufs: float
+    short_term_lufs: float
+    integrated_lufs: float
+    pts_ns: Optional[int] = None
+
+
+def _measure_rows(x, shelf, rlb, shelf_state, rlb_state, tp_history, tp_bank):
+    """
+    The batched kernel. `x` is (rows, samples) float32, states are per row and advanced in place.
+    Returns per row peak, RMS and true peak in dB, plus the squared K-weighted signal.
+    """
+    peak = np.abs(x).max(axis=1)
+    mean_square = np.einsum("rn,rn->r", x, x) / x.shape[1]
+
+    taps = tp_bank.shape[1]
+    buf = np.concatenate([tp_history, x], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(buf, taps, axis=1)
+    oversampled = windows @ tp_bank.T  # (rows, samples, 4)
+    true_peak = np.maximum(oversampled.max(axis=(1, 2)), -oversampled.min(axis=(1, 2)))
+    np.maximum(true_peak, peak, out=true_peak)
+    tp_history[:] = buf[:, buf.shape[1] - (taps - 1):]
+
+    weighted = rlb.filter(shelf.filter(x, shelf_state), rlb_state)
+    np.square(weighted, out=weighted)
+    levels = _power_db(np.stack([np.square(peak), mean_square, np.square(true_peak)]))
+    return levels[0], levels[1], levels[2], weighted
+
+
+class LevelMeter(PcmStage):
+
+    """
+    Pass-through stage that meters every block going by, the latest result is in `reading`.
+
+    Loudness follows ITU-R BS.1770 / EBU R128 with the integrated gates applied to 0.1 LU
+    histogram bins, which is well within what any meter displays. `channel_weights` defaults to
+    the BS.1770 5.1 weights for 6 channels and 1.0 for everything else.
+    """
+
+    def __init__(self, rate: int, channels: int, channel_weights: Sequence[float] = None):
+        if rate < 10:
+            raise TftimException(f"can't meter at {rate} Hz")
+        self.rate = rate
+        self.channels = channels
+        weights = _default_channel_weights(channels) if channel_weights is None else np.asarray(channel_weights, float)
+        if weights.shape != (channels,):
+            raise TftimException(f"expected {channels} channel weights, got {len(weights)}")
+        self.channel_weights = weights
+
+        self.shelf, self.rlb = k_weighting(rate)
+        self.shelf_state = self.shelf.initial_state(channels)
+        self.rlb_state = self.rlb.initial_state(channels)
+        self.tp_history = np.zeros((channels, _true_peak_bank().shape[1] - 1), dtype=np.float32)
+        self._converter = None
+
+        self._step = rate // 10
+        self._sub_sum = np.zeros(channels)
+        self._sub_count = 0
+        self._recent = np.zeros(0)  # channel-weighted mean squares of the last 30 sub-blocks
+        self._hist_count = np.zeros(_HIST_BINS, dtype=np.int64)
+        self._hist_energy = np.zeros(_HIST_BINS)
+        self._momentary = self._short_term = self._integrated = float("-inf")
+        self.reading: Optional[LevelReading] = None
+
+    def reset_integrated(self):
+        self._hist_count[:] = 0
+        self._hist_energy[:] = 0
+        self._integrated = float("-inf")
+
+    def _rows_into(self, block: PcmBlock, out: np.ndarray):
+        """ Writes the block as (channels, frames) float32 into `out`. """
+        if block.channels != self.channels:
+            raise TftimException(f"meter expects {self.channels} channels, got {block.channels}")
+        if block.rate is not None and block.rate != self.rate:
+            raise TftimException(f"meter expects {self.rate} Hz blocks, got {block.rate} Hz")
+        samples = block.array.reshape(-1, self.channels)
+        if block.sample_format != SampleFormat.FLOAT_32:
+            if self._converter is None or self._converter.src_format != block.sample_format:
+                self._converter = SampleConverter(block.sample_format, SampleFormat.FLOAT_32)
+            samples = self._converter.convert(samples)
+        out[:] = samples.T
+
+    def measure(self, block: PcmBlock) -> LevelReading:
+        if not block.frames:
+            return self.reading
+        x = np.empty((self.channels, block.frames), dtype=np.float32)
+        self._rows_into(block, x)
+        results = _measure_rows(
+            x, self.shelf, self.rlb, self.shelf_state, self.rlb_state, self.tp_history, _true_peak_bank()
+        )
+        return self._update(block.pts_ns, *results)
+
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        self.measure(block)
+        yield block
+
+    # ---- loudness bookkeeping --------------------------------------------------
+
+    def _update(self, pts_ns, peak_db, rms_db, true_peak_db, weighted) -> LevelReading:
+        self._accumulate(weighted)
+        self.reading = LevelReading(
+            peak_db=peak_db,
+            rms_db=rms_db,
+            true_peak_db=true_peak_db,
+            momentary_lufs=self._momentary,
+            short_term_lufs=self._short_term,
+            integrated_lufs=self._integrated,
+            pts_ns=pts_ns,
+        )
+        return self.reading
+
+    def _accumulate(self, weighted: np.ndarray):
+        n = weighted.shape[1]
+        first = self._step - self._sub_count  # samples left to finish the current sub-block
+        if n < first:
+            self._sub_sum += weighted.sum(axis=1, dtype=np.float64)
+            self._sub_count += n
+            return
+        sums = np.zeros((self.channels, n + 1))
+        np.cumsum(weighted, axis=1, dtype=np.float64, out=sums[:, 1:])
+        ends = np.arange(first, n + 1, self._step)
+        starts = np.concatenate([[0], ends[:-1]])
+        finished = sums[:, ends] - sums[:, starts]
+        finished[:, 0] += self._sub_sum
+        self._sub_sum = sums[:, n] - sums[:, ends[-1]]
+        self._sub_count = n - ends[-1]
+        self._add_sub_blocks(self.channel_weights @ finished / self._step)
+
+    def _add_sub_blocks(self, energies: np.ndarray):
+        combined = np.concatenate([self._recent[max(0, len(self._recent) - _MOMENTARY_SUB_BLOCKS + 1):], energies])
+        self._recent = np.concatenate([self._recent, energies])[-_SHORT_TERM_SUB_BLOCKS:]
+        self._short_term = float(LUFS_OFFSET + _power_db(self._recent.mean()))
+        if len(self._recent) >= _MOMENTARY_SUB_BLOCKS:
+            self._momentary = float(LUFS_OFFSET + _power_db(self._recent[-_MOMENTARY_SUB_BLOCKS:].mean()))
+        if len(combined) < _MOMENTARY_SUB_BLOCKS:
+            return
+        # every finished sub-block closes a 400 ms gating block (75% overlap)
+        gating = np.lib.stride_tricks.sliding_window_view(combined, _MOMENTARY_SUB_BLOCKS).mean(axis=1)
+        loudness = LUFS_OFFSET + _power_db(gating)
+        keep = loudness >= ABSOLUTE_GATE_LUFS
+        if not keep.any():
+            return
+        bins = np.minimum(((loudness[keep] - ABSOLUTE_GATE_LUFS) * 10).astype(np.int64), _HIST_BINS - 1)
+        np.add.at(self._hist_count, bins, 1)
+        np.add.at(self._hist_energy, bins, gating[keep])
+        self._integrated = self._gated_loudness()
+
+    def _gated_loudness(self) -> float:
+        count = self._hist_count.sum()
+        if not count:
+            return float("-inf")
+        gate = LUFS_OFFSET + _power_db(self._hist_energy.sum() / count) + RELATIVE_GATE_LU
+        start = max(0, int(np.floor((gate - ABSOLUTE_GATE_LUFS) * 10)))
+        count = self._hist_count[start:].sum()
+        if not count:
+            return float("-inf")
+        return float(LUFS_OFFSET + _power_db(self._hist_energy[start:].sum() / count))
+
+
+class MeterBank:
+
+    """
+    Meters many streams at once. Blocks handed to `measure` together are grouped by rate and
+    block size, and each group's channels are stacked into one array so the filters and the
+    true-peak oversampling run as a single batched call instead of one per stream.
+    """
+
+    def __init__(self):
+        self._meters: Dict[Hashable, LevelMeter] = {}
+
+    def add(self, key: Hashable, rate: int, channels: int, channel_weights: Sequence[float] = None) -> LevelMeter:
+        if key in self._meters:
+            raise TftimException(f"meter {key!r} already exists")
+        meter = self._meters[key] = LevelMeter(rate, channels, channel_weights)
+        return meter
+
+    def remove(self, key: Hashable):
+        self._meters.pop(key)
+
+    def __getitem__(self, key: Hashable) -> LevelMeter:
+        return self._meters[key]
+
+    @property
+    def keys(self) -> List[Hashable]:
+        return list(self._meters)
+
+    def readings(self) -> Dict[Hashable, Optional[LevelReading]]:
+        return {key: meter.reading for key, meter in self._meters.items()}
+
+    def measure(self, blocks: Dict[Hashable, PcmBlock]) -> Dict[Hashable, LevelReading]:
+        groups: Dict[tuple, list] = {}
+        for key, block in blocks.items():
+            if block.frames:
+                meter = self._meters[key]
+                groups.setdefault((meter.rate, block.frames), []).append((key, meter, block))
+
+        readings = {}
+        tp_bank = _true_peak_bank()
+        for (rate, frames), members in groups.items():
+            meters = [meter for _, meter, _ in members]
+            rows = np.cumsum([0] + [meter.channels for meter in meters])
+            x = np.empty((rows[-1], frames), dtype=np.float32)
+            for (_, meter, block), start, end in zip(members, rows[:-1], rows[1:]):
+                meter._rows_into(block, x[start:end])
+            shelf_state = np.concatenate([meter.shelf_state for meter in meters])
+            rlb_state = np.concatenate([meter.rlb_state for meter in meters])
+            tp_history = np.concatenate([meter.tp_history for meter in meters])
+            shelf, rlb = k_weighting(rate)
+
+            results = _measure_rows(x, shelf, rlb, shelf_state, rlb_state, tp_history, tp_bank)
+
+            for (key, meter, block), start, end in zip(members, rows[:-1], rows[1:]):
+                meter.shelf_state[:] = shelf_state[start:end]
+                meter.rlb_state[:] = rlb_state[start:end]
+                meter.tp_history[:] = tp_history[start:end]
+                readings[key] = meter._update(block.pts_ns, *(result[start:end] for result in results))
+        return readings
@@ -0,0 +1,288 @@
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, PcmSilence, SampleConverter, SampleFormat
+from this_framework_that_i_made.audio_helpers.rechunking import FrameRing
+from this_framework_that_i_made.audio_helpers.resampling import PcmResampler, ResamplerQuality
+from this_framework_that_i_made.generic.mux import Source, yield_from_sources
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+The mixer is the "virtual audio device" from AudioDevice's docstring: any number of PCM streams
+(mics, loopbacks, per-app loopbacks) in, one PcmBlock stream out.
+
+- every input owns a float32 FrameRing whose first frame always sits at the mixer's output cursor,
+  so lining inputs up on the media clock is just inserting silence or trimming overlap on push
+- gains and channel maps are folded into one (inputs * channels, out_channels) matrix, so mixing
+  a block is a single matmul over a preallocated (frames, inputs * channels) stack
+- nothing is allocated per block except the outgoing PcmBlock itself
+
+"""
+
+
+def _default_channel_map(in_channels: int, out_channels: int) -> np.ndarray:
+    matrix = np.zeros((in_channels, out_channels), dtype=np.float32)
+    if in_channels == 1:
+        matrix[0, :] = 1.0  # mono goes everywhere
+    else:
+        for c in range(in_channels):
+            matrix[c, c % out_channels] = 1.0
+    return matrix
+
+
+class _MixerInput:
+
+    def __init__(self, key, channels, gain, channel_map, out_channels, capacity):
+        self.key = key
+        self.channels = channels
+        self.gain = gain
+        if channel_map is None:
+            channel_map = _default_channel_map(channels, out_channels)
+        elif not isinstance(channel_map, np.ndarray):
+            # list of output channels, one per input channel
+            indexes = list(channel_map)
+            channel_map = np.zeros((channels, out_channels), dtype=np.float32)
+            channel_map[np.arange(channels), indexes] = 1.0
+        if channel_map.shape != (channels, out_channels):
+            raise TftimException(f"channel map for {key!r} must be {(channels, out_channels)}, got {channel_map.shape}")
+        self.channel_map = channel_map.astype(np.float32)
+        self.ring = FrameRing(capacity, channels, np.float32)
+        self.converter = None
+        self.resampler = None
+        self.silence_remainder = 0.0  # fractional frames left over from rate-scaled silence
+        self.scratch = np.empty(0, dtype=np.float32)
+        self.underruns = 0
+        self.dropped_frames = 0
+
+
+class AudioMixer:
+
+    """
+    Sums N PCM inputs into one float32 output stream at a fixed rate, channel count and block size.
+
+    Inputs are pushed as they arrive and placed on the timeline by pts_ns (blocks without a pts
+    are simply appended). Gaps beyond `tolerance_ms` become silence and late overlapping frames
+    are dropped. A block is ready once every input has caught up, or once any input is
+    `max_latency_ms` ahead, in which case stalled inputs are zero-filled for that block.
+    `limiter` smoothly pulls peaks under `ceiling`, otherwise the sum is hard clipped. Not
+    thread-safe, push and pull from one thread (mix_pcm_blocks does that for you).
+    """
+
+    def __init__(
+        self,
+        rate: int = 48_000,
+        channels: int = 2,
+        block_frames: int = 480,
+        max_latency_ms: float = 100.0,
+        tolerance_ms: float = 2.0,
+        limiter: bool = True,
+        ceiling: float = 0.99,
+        release_ms: float = 250.0,
+        output_format: SampleFormat = SampleFormat.FLOAT_32,
+        resampler_quality: ResamplerQuality = ResamplerQuality.MEDIUM,
+    ):
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = block_frames
+        self.latency_frames = int(rate * max_latency_ms / 1000)
+        self.tolerance_frames = int(rate * tolerance_ms / 1000)
+        self.limiter = limiter
+        self.ceiling = ceiling
+        self.release = 1.0 - np.exp(-block_frames / (rate * release_ms / 1000))
+        self.output_format = output_format
+        self.resampler_quality = resampler_quality
+
+        self._inputs: Dict[Hashable, _MixerInput] = {}
+        self._capacity = block_frames + self.latency_frames + block_frames
+        self._frame = 0             # timeline index of the next output frame
+        self._epoch_ns = None       # pts of timeline frame 0
+        self._gain = 1.0            # current limiter gain
+        self._out = np.zeros((block_frames, channels), dtype=np.float32)
+        self._ramp_base = np.arange(1, block_frames + 1, dtype=np.float32) / block_frames
+        self._ramp = np.empty(block_frames, dtype=np.float32)
+        self._from_float = SampleConverter(SampleFormat.FLOAT_32, output_format)
+        self._rebuild()
+
+    # ---- inputs --------------------------------------------------------------
+
+    def add_input(self, key: Hashable, channels: int, gain: float = 1.0, channel_map=None):
+        """
+        `channel_map` is either a list with one output channel per input channel or a full
+        (in_channels, out_channels) matrix. Mono inputs go to every output by default.
+        """
+        if key in self._inputs:
+            raise TftimException(f"mixer input {key!r} already exists")
+        self._inputs[key] = _MixerInput(key, channels, gain, channel_map, self.channels, self._capacity)
+        self._rebuild()
+
+    def remove_input(self, key: Hashable):
+        self._inputs.pop(key)
+        self._rebuild()
+
+    def set_gain(self, key: Hashable, gain: float):
+        self._inputs[key].gain = gain
+        self._rebuild()
+
+    @property
+    def input_keys(self) -> List[Hashable]:
+        return list(self._inputs)
+
+    def _rebuild(self):
+        # stack every input's channels side by side, with gain folded into its rows of the matrix
+        width = sum(i.channels for i in self._inputs.values())
+        self._stack = np.zeros((self.block_frames, width), dtype=np.float32)
+        self._matrix = np.zeros((width, self.channels), dtype=np.float32)
+        self._columns = {}
+        col = 0
+        for key, mixer_input in self._inputs.items():
+            self._columns[key] = slice(col, col + mixer_input.channels)
+            self._matrix[col:col + mixer_input.channels] = mixer_input.channel_map * mixer_input.gain
+            col += mixer_input.channels
+
+    # ---- timeline ------------------------------------------------------------
+
+    def _to_float(self, mixer_input: _MixerInput, block: PcmBlock) -> np.ndarray:
+        if mixer_input.converter is None or mixer_input.converter.src_format != block.sample_format:
+            mixer_input.converter = SampleConverter(block.sample_format, SampleFormat.FLOAT_32)
+        samples = block.array.reshape(-1, block.channels)
+        if block.sample_format == SampleFormat.FLOAT_32:
+            return samples
+        size = samples.size
+        if mixer_input.scratch.size < size:
+            mixer_input.scratch = np.empty(size, dtype=np.float32)
+        return mixer_input.converter.convert(samples, out=mixer_input.scratch[:size].reshape(samples.shape))
+
+    def push(self, key: Hashable, block: PcmBlock):
+        mixer_input = self._inputs[key]
+        if block.channels != mixer_input.channels:
+            raise TftimException(f"mixer input {key!r} expects {mixer_input.channels} channels, got {block.channels}")
+        if isinstance(block, PcmSilence) and (mixer_input.resampler is None or block.rate in (None, self.rate)):
+            # nothing to resample, just the frame count in the mixer's rate. Once the input has a
+            # resampler, silence goes through it as zeros: its pts and filter history run on the
+            # frames it has seen, skipping them would put every later block behind by the silence
+            frames = block.frames
+            if block.rate is not None and block.rate != self.rate:
+                exact = block.frames * self.rate / block.rate + mixer_input.silence_remainder
+                frames = round(exact)
+                mixer_input.silence_remainder = exact - frames
+            self._place(mixer_input, None, block.pts_ns, frames=frames)
+            return
+        if block.rate is not None and block.rate != self.rate:
+            if mixer_input.resampler is None:
+                mixer_input.resampler = PcmResampler(
+                    block.rate, self.rate, block.channels,
+                    quality=self.resampler_quality, output_format=SampleFormat.FLOAT_32,
+                )
+            for resampled in mixer_input.resampler.process(block):
+                self._place(mixer_input, resampled.array.reshape(-1, block.channels), resampled.pts_ns)
+            return
+        self._place(mixer_input, self._to_float(mixer_input, block), block.pts_ns)
+
+    def _place(self, mixer_input: _MixerInput, samples: Optional[np.ndarray], pts_ns: Optional[int], frames: int = None):
+        """ Puts samples (or `frames` of silence when `samples` is None) on the input's timeline. """
+        ring = mixer_input.ring
+        frames = samples.shape[0] if samples is not None else frames
+        skip = 0
+        if pts_ns is not None:
+            if self._epoch_ns is None:
+                self._epoch_ns = pts_ns - self._frame * 1_000_000_000 // self.rate
+            start = round((pts_ns - self._epoch_ns) * self.rate / 1_000_000_000)
+            gap = start - (self._frame + ring.available)
+            if gap > self.tolerance_frames:
+                ring.write_silence(min(gap, ring.free))
+            elif gap < -self.tolerance_frames:
+                skip = min(-gap, frames)
+                mixer_input.dropped_frames += skip
+                frames -= skip
+        if frames > ring.free:
+            # the mixer isn't being pulled, dropping the tail keeps the ring aligned with the cursor
+            mixer_input.dropped_frames += frames - ring.free
+            frames = ring.free
+        if samples is None:
+            ring.write_silence(frames)
+        else:
+            ring.write(samples[skip:skip + frames])
+
+    # ---- output --------------------------------------------------------------
+
+    def ready(self) -> bool:
+        if not self._inputs:
+            return False
+        available = [i.ring.available for i in self._inputs.values()]
+        return min(available) >= self.block_frames or max(available) >= self.block_frames + self.latency_frames
+
+    def pull(self) -> PcmBlock:
+        """ Mixes the next block, zero-filling inputs that have nothing buffered for it. """
+        n = self.block_frames
+        for key, mixer_input in self._inputs.items():
+            columns = self._stack[:, self._columns[key]]
+            got = min(n, mixer_input.ring.available)
+            mixer_input.ring.read(got, out=columns[:got])
+            if got < n:
+                columns[got:] = 0
+                mixer_input.underruns += 1
+        np.matmul(self._stack, self._matrix, out=self._out)
+        self._apply_limiter()
+
+        pts_ns = None
+        if self._epoch_ns is not None:
+            pts_ns = self._epoch_ns + self._frame * 1_000_000_000 // self.rate
+        self._frame += n
+        out = self._out if self.channels > 1 else self._out.reshape(-1)
+        samples = out.copy() if self.output_format == SampleFormat.FLOAT_32 else self._from_float.convert(out)
+        return PcmBlock.from_array(samples, self.output_format, self.channels, rate=self.rate, pts_ns=pts_ns)
+
+    def _apply_limiter(self):
+        out = self._out
+        if self.limiter:
+            peak = float(np.abs(out).max())
+            target = min(1.0, self.ceiling / peak) if peak > 0 else 1.0
+            # attack within the block, release slowly over following blocks
+            new_gain = target if target < self._gain else self._gain + (target - self._gain) * self.release
+            if new_gain != 1.0 or self._gain != 1.0:
+                np.multiply(self._ramp_base, new_gain - self._gain, out=self._ramp)
+                np.add(self._ramp, self._gain, out=self._ramp)
+                np.multiply(out, self._ramp[:, None], out=out)
+            self._gain = new_gain
+        # the limiter ramps into its gain, so anything left over the ceiling gets clipped
+        np.clip(out, -1.0, 1.0, out=out)
+
+    def stats(self) -> Dict[Hashable, dict]:
+        return {
+            key: {
+                "buffered_frames": i.ring.available,
+                "underruns": i.underruns,
+                "dropped_frames": i.dropped_frames,
+                "gain": i.gain,
+            }
+            for key, i in self._inputs.items()
+        }
+
+
+def mix_pcm_blocks(
+    sources: Dict[str, Iterable[PcmBlock]],
+    mixer: AudioMixer = None,
+    gains: Dict[str, float] = None,
+) -> Iterator[PcmBlock]:
+    """
+    Pumps every source on its own thread (see generic.mux) and yields mixed blocks as they
+    become ready. Inputs join the mixer with their first block. Errors raised by a source are
+    re-raised here.
+    """
+    mixer = mixer or AudioMixer()
+    gains = gains or {}
+    events = yield_from_sources(*(Source(name, lambda it=it: iter(it)) for name, it in sources.items()))
+    try:
+        for name, event in events:
+            if name.endswith(".__error__"):
+                raise event
+            if name not in mixer.input_keys:
+                mixer.add_input(name, event.channels, gain=gains.get(name, 1.0))
+            mixer.push(name, event)
+            while mixer.ready():
+                yield mixer.pull()
+    finally:
+        events.close()
@@ -1,17 +1,46 @@
 from enum import Enum
-from typing import List
-from comtypes import GUID, IUnknown, COMMETHOD, HRESULT
+from typing import Callable, List
+from comtypes import GUID, IUnknown, COMMETHOD, COMObject, HRESULT
 import ctypes
 from comtypes.client import CreateObject
-from ctypes import POINTER, c_void_p, c_ulong, c_wchar_p
+from ctypes import POINTER, c_ulong, c_wchar_p
 
 from .IMMDevice import IMMDevice, PyMmDevice
 from .IMMDeviceCollection import IMMDeviceCollection, PyMmDeviceCollection
+from .ms_audio_common import PROPERTYKEY
 
 
 # Core Audio GUIDs
 IID_IMMDeviceEnumerator = GUID("{A95664D2-9614-4F35-A746-DE8DB63617E6}")
 CLSID_MMDeviceEnumerator = GUID("{BCDE0395-E52F-467C-8E3D-C4579291692E}")
+IID_IMMNotificationClient = GUID("{7991EEC9-7E89-4D85-8390-6C703CEC60C0}")
+
+
+class IMMNotificationClient(IUnknown):
+
+    """
+
+    callbacks for endpoint added / removed / state and default changes, implemented on our side
+    https://learn.microsoft.com/en-us/windows/win32/api/mmdeviceapi/nn-mmdeviceapi-immnotificationclient
+
+    """
+    _iid_ = IID_IMMNotificationClient
+    _methods_ = [
+        COMMETHOD([], HRESULT, "OnDeviceStateChanged",
+                  (["in"], c_wchar_p, "pwstrDeviceId"),
+                  (["in"], c_ulong, "dwNewState")),            # DEVICE_STATE_*
+        COMMETHOD([], HRESULT, "OnDeviceAdded",
+                  (["in"], c_wchar_p, "pwstrDeviceId")),
+        COMMETHOD([], HRESULT, "OnDeviceRemoved",
+                  (["in"], c_wchar_p, "pwstrDeviceId")),
+        COMMETHOD([], HRESULT, "OnDefaultDeviceChanged",
+                  (["in"], ctypes.c_int, "flow"),              # EDataFlow
+                  (["in"], ctypes.c_int, "role"),              # ERole
+                  (["in"], c_wchar_p, "pwstrDefaultDeviceId")),
+        COMMETHOD([], HRESULT, "OnPropertyValueChanged",
+                  (["in"], c_wchar_p, "pwstrDeviceId"),
+                  (["in"], PROPERTYKEY, "key")),               # by value
+    ]
 
 
 class IMMDeviceEnumerator(IUnknown):
@@ -36,9 +65,9 @@ class IMMDeviceEnumerator(IUnknown):
                   (["in"], c_wchar_p, "pwstrId"),
                   (["out"], POINTER(POINTER(IMMDevice)), "ppDevice")),
         COMMETHOD([], HRESULT, "RegisterEndpointNotificationCallback",
-                  (["in"], c_void_p, "pClient")),  # IM: IIMMNotificationClient*
+                  (["in"], POINTER(IMMNotificationClient), "pClient")),
         COMMETHOD([], HRESULT, "UnregisterEndpointNotificationCallback",
-                  (["in"], c_void_p, "pClient")),
+                  (["in"], POINTER(IMMNotificationClient), "pClient")),
     ]
 
 
@@ -67,17 +96,42 @@ class DeviceRole(Enum):
     E_COMMUNICATIONS: int = 2  # eCommunications
 
 
-class IMMNotificationClient:
-    ...
+class PyMmNotificationClient(COMObject):
 
+    """
+    Calls `on_change(event, device_id)` for every notification, event being "added", "removed",
+    "state" or "default". Windows calls in on its own threads and the callback mustn't block, so
+    keep it to setting a flag / waking a loop. Property changes are ignored, they're constant noise
+    (levels, jack info) and never change what's enumerated.
+    """
+    _com_interfaces_ = [IMMNotificationClient]
 
-class PyMmNotificationClient:
+    def __init__(self, on_change: Callable[[str, str], None]):
+        super().__init__()
+        self.on_change = on_change
 
-    def __init__(self, iface):
-        self.iface = iface
+    def _notify(self, event: str, device_id: str):
+        try:
+            self.on_change(event, device_id)
+        except Exception:
+            # an exception here would go back into the audio service, not to anyone who cares
+            pass
+        return 0  # S_OK
+
+    def OnDeviceStateChanged(self, device_id, new_state):
+        return self._notify("state", device_id)
+
+    def OnDeviceAdded(self, device_id):
+        return self._notify("added", device_id)
+
+    def OnDeviceRemoved(self, device_id):
+        return self._notify("removed", device_id)
+
+    def OnDefaultDeviceChanged(self, flow, role, device_id):
+        return self._notify("default", device_id)
 
-    def __init__(self):
-        raise NotImplemented
+    def OnPropertyValueChanged(self, device_id, key):
+        return 0
 
 
 class PyMmDeviceEnumerator:
@@ -120,12 +174,12 @@ class PyMmDeviceEnumerator:
     def get_device(self, device_id: str) -> PyMmDevice:
         return PyMmDevice(self.iface.GetDevice(device_id))
 
-    def register_endpoint_notification_callback(self, client: PyMmNotificationClient) -> int:
-        # Returns HRESULT (0 on success). You can check or let COMError bubble up.
-        return PyMmNotificationClient(self.iface.RegisterEndpointNotificationCallback(client))
+    def register_endpoint_notification_callback(self, client: PyMmNotificationClient):
+        # failures come back as COMError
+        self.iface.RegisterEndpointNotificationCallback(client.QueryInterface(IMMNotificationClient))
 
-    def unregister_endpoint_notification_callback(self, client: PyMmNotificationClient) -> int:
-        return PyMmNotificationClient(self.iface.UnregisterEndpointNotificationCallback(client))
+    def unregister_endpoint_notification_callback(self, client: PyMmNotificationClient):
+        self.iface.UnregisterEndpointNotificationCallback(client.QueryInterface(IMMNotificationClient))
 
     # Delegate unknown attributes/methods straight to the COM object
     def __getattr__(self, name):
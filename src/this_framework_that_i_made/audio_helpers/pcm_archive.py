@@ -0,0 +1,387 @@
+import logging
+import os
+import struct
+from typing import Iterator, Optional, Union
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import (
+    NUMPY_SAMPLE_FORMAT,
+    SAMPLE_WIDTH,
+    PcmBlock,
+    PcmSilence,
+    PcmStage,
+    SampleFormat,
+)
+from this_framework_that_i_made.audio_helpers.waveform_overview import WaveformOverview
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Recording PcmBlock streams to disk and slicing them back out.
+
+File layout is a plain WAV with a 28 byte JUNK chunk right after the RIFF header. If the
+recording ends up over 4 GB the header is rewritten as RF64 and the JUNK chunk becomes the ds64
+chunk holding the real sizes, so short files open anywhere and long ones in anything that reads
+RF64 (ffmpeg, sox, most DAWs).
+
+Next to it, `<file>.idx` holds int64 rows of (pts_ns, frame_offset, frames). A row covers a run of
+frames whose timestamps follow on from each other, a new row starts whenever the capture clock
+jumps (dropouts, device restarts), so a continuous capture has a single row no matter how long.
+In sparse mode PcmSilence markers aren't written out at all, they become rows with a frame
+offset of -1, so a mostly idle capture costs disk only for the parts where something happened.
+
+`<file>.overview.npz`, if the writer was asked for one, is the WaveformOverview of the stored
+frames, for drawing the recording without reading it.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+OVERVIEW_SUFFIX = ".overview.npz"
+INDEX_DTYPE = np.dtype("<i8")
+SILENCE_OFFSET = -1
+
+_JUNK_SIZE = 28                     # exactly the size of a ds64 chunk without a table
+_UNKNOWN_SIZE = 0xFFFFFFFF
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _wave_format(sample_format: SampleFormat) -> int:
+    return _WAVE_FORMAT_IEEE_FLOAT if sample_format == SampleFormat.FLOAT_32 else _WAVE_FORMAT_PCM
+
+
+def _sample_format_from_wave(tag: int, bits: int) -> SampleFormat:
+    if tag == _WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+        return SampleFormat.FLOAT_32
+    if tag == _WAVE_FORMAT_PCM:
+        formats = {8: SampleFormat.UINT_8, 16: SampleFormat.INT_16, 24: SampleFormat.INT_24, 32: SampleFormat.INT_32}
+        if bits in formats:
+            return formats[bits]
+    raise TftimException(f"unsupported wave format {tag:#06x} with {bits} bits per sample")
+
+
+def _header(sample_format: SampleFormat, channels: int, rate: int) -> bytes:
+    width = SAMPLE_WIDTH[sample_format]
+    fmt = struct.pack(
+        "<HHIIHH", _wave_format(sample_format), channels, rate, rate * width * channels, width * channels, width * 8
+    )
+    if sample_format == SampleFormat.FLOAT_32:
+        fmt += struct.pack("<H", 0)  # cbSize, required for non PCM tags
+    return b"".join([
+        b"RIFF", struct.pack("<I", _UNKNOWN_SIZE), b"WAVE",
+        b"JUNK", struct.pack("<I", _JUNK_SIZE), bytes(_JUNK_SIZE),
+        b"fmt ", struct.pack("<I", len(fmt)), fmt,
+        b"data", struct.pack("<I", _UNKNOWN_SIZE),
+    ])
+
+
+class PcmArchiveWriter(PcmStage):
+
+    """
+    Pass-through stage that appends every block to a WAV/RF64 file and its pts index.
+
+    Format, channels and rate are taken from the first block (`rate` is only needed if blocks
+    don't carry one). Samples go straight from the block's buffer into a `buffer_size` write
+    buffer, so the disk sees few large writes. The header holds "unknown" sizes until `close`
+    (or `flush` at the end of a pipeline) patches them, readers fall back to the file size, so
+    a capture that gets killed is still readable. Timestamps within `tolerance_ms` of where the
+    previous block ended extend the current index row instead of starting a new one. With
+    `sparse`, PcmSilence only goes into the index, otherwise it's written out as zeros. With
+    `overview`, a WaveformOverview of the stored frames is kept up to date and saved on close.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        rate: int = None,
+        buffer_size: int = 4 * 1024 * 1024,
+        tolerance_ms: float = 2.0,
+        sparse: bool = False,
+        overview: bool = False,
+    ):
+        self.path = os.fspath(path)
+        self.rate = rate
+        self.buffer_size = buffer_size
+        self.tolerance_ns = int(tolerance_ms * 1_000_000)
+        self.sparse = sparse
+        self.overview: Optional[WaveformOverview] = None
+        self._keep_overview = overview
+        self.frames = 0             # frames actually stored in the file
+        self.silent_frames = 0      # frames only recorded in the index
+        self._file = None
+        self._index_file = None
+        self._sample_format = None
+        self._channels = None
+        self._data_offset = None
+        self._row = None            # [pts_ns, frame_offset, frames] of the run being written
+        self._closed = False
+
+    @property
+    def index_path(self) -> str:
+        return self.path + INDEX_SUFFIX
+
+    @property
+    def overview_path(self) -> str:
+        return self.path + OVERVIEW_SUFFIX
+
+    def _open(self, block: PcmBlock):
+        self.rate = self.rate or block.rate
+        if not self.rate:
+            raise TftimException("can't record blocks without a sample rate, pass `rate`")
+        self._sample_format = block.sample_format
+        self._channels = block.channels
+        header = _header(block.sample_format, block.channels, self.rate)
+        self._data_offset = len(header)
+        self._file = open(self.path, "wb", buffering=self.buffer_size)
+        self._file.write(header)
+        self._index_file = open(self.index_path, "wb")
+        if self._keep_overview:
+            self.overview = WaveformOverview(block.channels, self.rate)
+
+    def write(self, block: PcmBlock):
+        if self._closed:
+            raise TftimException(f"{self.path} is already closed")
+        if self._file is None:
+            self._open(block)
+        elif block.sample_format != self._sample_format or block.channels != self._channels:
+            raise TftimException(
+                f"archive is {self._channels}ch {self._sample_format.name}, "
+                f"got {block.channels}ch {block.sample_format.name}"
+            )
+        frames = block.frames
+        if not frames:
+            return
+        if self.sparse and isinstance(block, PcmSilence):
+            self._add_to_index(block.pts_ns, frames, silent=True)
+            self.silent_frames += frames
+            return
+        self._file.write(block.buffer)
+        if self.overview is not None:
+            self.overview.feed(block)
+        self._add_to_index(block.pts_ns, frames, silent=False)
+        self.frames += frames
+
+    def _add_to_index(self, pts_ns: Optional[int], frames: int, silent: bool):
+        row = self._row
+        if row is not None:
+            expected = row[0] + row[2] * 1_000_000_000 // self.rate
+            same_kind = (row[1] == SILENCE_OFFSET) == silent
+            if same_kind and (pts_ns is None or abs(pts_ns - expected) <= self.tolerance_ns):
+                row[2] += frames
+                return
+            self._index_file.write(np.array(row, dtype=INDEX_DTYPE).tobytes())
+            if pts_ns is None:
+                pts_ns = expected
+        offset = SILENCE_OFFSET if silent else self.frames
+        self._row = [0 if pts_ns is None else pts_ns, offset, frames]
+
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        self.write(block)
+        yield block
+
+    def flush(self) -> Iterator[PcmBlock]:
+        self.close()
+        return iter(())
+
+    def close(self):
+        if self._closed or self._file is None:
+            self._closed = True
+            return
+        self._closed = True
+        if self._row is not None:
+            self._index_file.write(np.array(self._row, dtype=INDEX_DTYPE).tobytes())
+        self._index_file.close()
+        self._file.flush()
+        self._patch_header()
+        self._file.close()
+        if self.overview is not None:
+            self.overview.save(self.overview_path)
+
+    def _patch_header(self):
+        data_size = self.frames * SAMPLE_WIDTH[self._sample_format] * self._channels
+        riff_size = self._data_offset + data_size - 8
+        f = self._file
+        if riff_size <= _UNKNOWN_SIZE - 1:
+            f.seek(4)
+            f.write(struct.pack("<I", riff_size))
+            f.seek(self._data_offset - 4)
+            f.write(struct.pack("<I", data_size))
+        else:
+            # RF64, sizes live in ds64 which takes the place of the JUNK chunk
+            f.seek(0)
+            f.write(b"RF64" + struct.pack("<I", _UNKNOWN_SIZE) + b"WAVE")
+            f.write(b"ds64" + struct.pack("<IQQQI", _JUNK_SIZE, riff_size, data_size, self.frames, 0))
+            f.seek(self._data_offset - 4)
+            f.write(struct.pack("<I", _UNKNOWN_SIZE))
+        f.flush()
+        logger.debug("closed %s, %d frames in %d bytes", self.path, self.frames, data_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PcmArchive:
+
+    """
+    Read side of an archive (or any PCM/float WAV or RF64 file). `samples` is a read-only
+    np.memmap of the whole recording, (frames, channels), and every slicing method returns views
+    into it, so nothing is read from disk until the samples are actually touched. INT_24 has no
+    numpy dtype, it comes back as raw (frames, channels, 3) uint8, PcmBlocks from `blocks` decode it.
+    Silence rows of sparse archives have no samples, `slice` skips them and `blocks` replays them
+    as PcmSilence.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = os.fspath(path)
+        self._parse_header()
+        if self.frames:
+            dtype = np.uint8 if self.sample_format == SampleFormat.INT_24 else NUMPY_SAMPLE_FORMAT[self.sample_format]
+            shape = (self.frames, self.channels, 3) if self.sample_format == SampleFormat.INT_24 else (self.frames, self.channels)
+            self.samples = np.memmap(self.path, dtype=dtype, mode="r", offset=self._data_offset, shape=shape)
+        else:
+            self.samples = np.zeros((0, self.channels), dtype=np.uint8)
+        self.index = self._load_index()
+        self._audio_index = self.index[self.index[:, 1] != SILENCE_OFFSET]
+        if not len(self._audio_index):
+            self._audio_index = np.array([[self.start_pts_ns, 0, 0]], dtype=INDEX_DTYPE)
+
+    def _parse_header(self):
+        file_size = os.path.getsize(self.path)
+        with open(self.path, "rb") as f:
+            riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+                raise TftimException(f"{self.path} is not a wave file")
+            ds64_data_size = None
+            fmt = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    raise TftimException(f"{self.path} has no data chunk")
+                chunk_id, size = struct.unpack("<4sI", chunk)
+                if chunk_id == b"ds64":
+                    _, ds64_data_size, _ = struct.unpack("<QQQ", f.read(24))
+                    f.seek(size - 24 + (size & 1), os.SEEK_CUR)
+                elif chunk_id == b"fmt ":
+                    fmt = f.read(size)
+                    f.seek(size & 1, os.SEEK_CUR)
+                elif chunk_id == b"data":
+                    self._data_offset = f.tell()
+                    break
+                else:
+                    f.seek(size + (size & 1), os.SEEK_CUR)
+        if fmt is None:
+            raise TftimException(f"{self.path} has no fmt chunk")
+
+        tag, self.channels, self.rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+        if tag == _WAVE_FORMAT_EXTENSIBLE:
+            tag = struct.unpack("<H", fmt[24:26])[0]  # first two bytes of the subformat guid
+        self.sample_format = _sample_format_from_wave(tag, bits)
+
+        data_size = ds64_data_size if riff == b"RF64" and ds64_data_size is not None else size
+        available = file_size - self._data_offset
+        if data_size in (0, _UNKNOWN_SIZE) or data_size > available:
+            data_size = available  # still being written, or the writer never closed
+        self.frames = data_size // block_align
+
+    def _load_index(self) -> np.ndarray:
+        index_path = self.path + INDEX_SUFFIX
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype=INDEX_DTYPE).reshape(-1, 3)
+            if len(index):
+                indexed = int(index[index[:, 1] != SILENCE_OFFSET, 2].sum())
+                if indexed < self.frames:
+                    # the writer never got to write its last row
+                    pts, _, frames = index[-1]
+                    tail = [pts + frames * 1_000_000_000 // self.rate, indexed, self.frames - indexed]
+                    index = np.vstack([index, np.array([tail], dtype=INDEX_DTYPE)])
+                return index
+        return np.array([[0, 0, self.frames]], dtype=INDEX_DTYPE)
+
+    @property
+    def start_pts_ns(self) -> int:
+        return int(self.index[0, 0])
+
+    @property
+    def end_pts_ns(self) -> int:
+        pts, _, frames = self.index[-1]
+        return int(pts + frames * 1_000_000_000 // self.rate)
+
+    @property
+    def duration_ns(self) -> int:
+        """ Recorded time, silence included. """
+        return int(self.index[:, 2].sum()) * 1_000_000_000 // self.rate
+
+    def frame_at(self, pts_ns: int) -> int:
+        """ Stored frame showing at `pts_ns`, times in gaps or silence snap to the next stored run. """
+        index = self._audio_index
+        row = max(0, int(np.searchsorted(index[:, 0], pts_ns, side="right")) - 1)
+        pts, offset, frames = (int(v) for v in index[row])
+        frame = offset + (pts_ns - pts) * self.rate // 1_000_000_000
+        return int(min(max(frame, offset), offset + frames, self.frames))
+
+    def pts_at(self, frame: int) -> int:
+        """ Timestamp of a stored frame. """
+        index = self._audio_index
+        row = max(0, int(np.searchsorted(index[:, 1], frame, side="right")) - 1)
+        pts, offset, _ = (int(v) for v in index[row])
+        return pts + (frame - offset) * 1_000_000_000 // self.rate
+
+    def slice(self, start_ns: int = None, end_ns: int = None) -> np.ndarray:
+        """ Zero-copy view of the frames between two timestamps, the whole file by default. """
+        start = 0 if start_ns is None else self.frame_at(start_ns)
+        stop = self.frames if end_ns is None else self.frame_at(end_ns)
+        return self.samples[start:max(start, stop)]
+
+    def blocks(self, start_ns: int = None, end_ns: int = None, frames_per_block: int = 4800) -> Iterator[PcmBlock]:
+        """ Replays a time range as timestamped PcmBlocks backed by the memmap. """
+        for pts, offset, frames in self.index.tolist():
+            first = 0 if start_ns is None else max(0, (start_ns - pts) * self.rate // 1_000_000_000)
+            last = frames if end_ns is None else min(frames, (end_ns - pts) * self.rate // 1_000_000_000)
+            if first >= last:
+                continue
+            if offset == SILENCE_OFFSET:
+                pts_ns = pts + first * 1_000_000_000 // self.rate
+                yield PcmSilence(last - first, self.sample_format, self.channels, rate=self.rate, pts_ns=pts_ns)
+                continue
+            for start in range(first, last, frames_per_block):
+                stop = min(last, start + frames_per_block)
+                yield self._block(offset + start, offset + stop, pts + start * 1_000_000_000 // self.rate)
+
+    def _block(self, start: int, stop: int, pts_ns: int) -> PcmBlock:
+        view = self.samples[start:min(stop, self.frames)]
+        if self.sample_format == SampleFormat.INT_24:
+            return PcmBlock(view.reshape(-1), self.sample_format, self.channels, rate=self.rate, pts_ns=pts_ns)
+        if self.channels == 1:
+            view = view.reshape(-1)
+        return PcmBlock.from_array(view, self.sample_format, self.channels, rate=self.rate, pts_ns=pts_ns)
+
+    def overview(self, base_frames: int = 512) -> WaveformOverview:
+        """ The saved overview of the stored frames, or one built from the samples if there's none. """
+        path = self.path + OVERVIEW_SUFFIX
+        if os.path.exists(path):
+            overview = WaveformOverview.load(path)
+            if overview.frames == self.frames:
+                return overview
+            logger.warning("%s doesn't match %s, rebuilding it", path, self.path)
+        overview = WaveformOverview(self.channels, self.rate, base_frames)
+        for start in range(0, self.frames, 1 << 16):
+            overview.feed(self._block(start, start + (1 << 16), 0))
+        return overview
+
+    def close(self):
+        # the mapping goes away with the last view into it
+        self.samples = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,15 +1,21 @@
-import platform
-import sys
-import contextlib, queue, threading
-import traceback
-from typing import Callable, Iterator, Optional, Any
+import asyncio, collections, contextlib, logging, queue, threading, time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Any
 
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers import audio_backends
 from this_framework_that_i_made.audio_helpers.audio_standards import (
     PcmBlock,
     PYAUDIO_SAMPLE_FORMAT,
-    NUMPY_SAMPLE_FORMAT,
+    SAMPLE_WIDTH,
     SampleFormat,
 )
+from this_framework_that_i_made.audio_helpers.dsp import DspProcessor
+from this_framework_that_i_made.audio_helpers.rechunking import FrameRing
+from this_framework_that_i_made.generics import SavableObject, TftimException, ensure_savable
+from this_framework_that_i_made.streams import Stream, TimeStamp, now_ns
 
 
 try:
@@ -19,13 +25,33 @@ except Exception:
     _HAS_PYCOM = False
 
 
-pyaudio = None
-if platform.system() == "Windows":
-    import pyaudiowpatch
-    pyaudio = pyaudiowpatch
-else:
-    import pyaudio
-    pyaudio = pyaudio
+"""
+
+PortAudio scans every device when it initializes, which takes anywhere from a few ms to most of
+a second with lots of endpoints (and MME/DirectSound/WASAPI each list every one of them), so:
+- there's one PyAudio instance per process, refcounted by PortAudioSession, shared by every
+  stream and enumeration and terminated when the last user lets go
+- the host api / device lists are read once into a DeviceTable and served from there until
+  someone calls `invalidate` (hotplug) or asks for a refresh
+
+PortAudio only sees device changes after a full terminate + initialize, which can't happen while
+a stream is open. An invalidated table is rescanned as soon as nothing holds the session, until
+then the old one keeps being served.
+
+What rates and formats an endpoint takes is probed once with `is_format_supported` (some host
+apis open the device to answer) and cached with the table. Buffer sizes come from a latency
+target, by default the device's own low latency, instead of a fixed 1024 frames.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+_HEALTH_CHECK_S = 1.0  # how often idle capture threads look for streams that died
+
+# buffers python callbacks keep up with, smaller ones burn CPU for nothing, bigger ones are latency
+_MIN_BUFFER_FRAMES = 256
+_MAX_BUFFER_FRAMES = 8192
+_PROBE_RATES = (8000, 11025, 16000, 22050, 32000, 44100, 48000, 88200, 96000, 176400, 192000)
 
 
 # @ensure_savable
@@ -50,11 +76,264 @@ else:
 #     stream_callback: Any = None  # Specifies a callback function for non-blocking (callback) operation. Default is None, which indicates blocking operation (i.e., PyAudio.Stream.read() and PyAudio.Stream.write()). To use non-blocking operation, specify a callback that conforms to the following signature:
 
 
+@dataclass(slots=True)
+class DeviceTable:
+
+    """ One scan of PortAudio's host apis and devices, as the info dicts PyAudio returns. """
+
+    host_apis: List[dict]
+    devices: List[dict]
+    generation: int  # bumped whenever a rescan finds something different
+    _by_index: Dict[int, dict] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # a table never changes once built, so the lookup is indexed once
+        self._by_index = {device["index"]: device for device in self.devices}
+
+    def host_api_name(self, index: int) -> str:
+        return self.host_apis[index]["name"]
+
+    def device(self, index: int) -> dict:
+        return self._by_index[index]
+
+    def devices_by_index(self) -> Dict[int, dict]:
+        return dict(self._by_index)
+
+
+def frames_for_latency(rate: int, latency_s: float, min_frames: int = _MIN_BUFFER_FRAMES, max_frames: int = _MAX_BUFFER_FRAMES) -> int:
+    """ Largest power of two buffer that fits in `latency_s`, clamped to [min_frames, max_frames]. """
+    frames = max(1, int(rate * latency_s))
+    return min(max_frames, max(min_frames, 1 << (frames.bit_length() - 1)))
+
+
+@ensure_savable
+@dataclass(slots=True)
+class EndpointCapabilities(SavableObject):
+
+    """ What one direction of a device accepts, from PortAudioSession.capabilities. """
+
+    device_index: int
+    is_input: bool
+    channels: int
+    default_rate: int
+    rates: List[int]
+    sample_formats: List[SampleFormat]
+    low_latency_s: float
+    high_latency_s: float
+
+    def supports(self, rate: int = None, sample_format: SampleFormat = None) -> bool:
+        return (rate is None or rate in self.rates) and (sample_format is None or sample_format in self.sample_formats)
+
+    def frames_per_buffer(self, latency_s: float = None, rate: int = None) -> int:
+        """ Buffer size for a latency target, the device's low latency by default. """
+        return frames_for_latency(rate or self.default_rate, self.low_latency_s if latency_s is None else latency_s)
+
+
+class PortAudioSession:
+
+    """
+    The process-wide PyAudio instance. `acquire`/`release` (or `with PortAudioSession.session()
+    as pa`) share it, the first acquire initializes PortAudio and the last release terminates it.
+    """
+
+    _lock = threading.RLock()
+    _pa = None
+    _refs = 0
+    _table: Optional[DeviceTable] = None
+    _stale = False
+    _generation = 0
+    _table_backend = None  # which audio_backends backend the table came from
+    _capabilities: Dict[tuple, EndpointCapabilities] = {}
+
+    @classmethod
+    def acquire(cls):
+        with cls._lock:
+            if cls._pa is None:
+                cls._pa = audio_backends.PyAudio()
+                logger.debug("PortAudio initialized")
+            cls._refs += 1
+            return cls._pa
+
+    @classmethod
+    def release(cls):
+        with cls._lock:
+            if cls._refs <= 0:
+                logger.warning("PortAudio session released more often than acquired")
+                return
+            cls._refs -= 1
+            if cls._refs == 0:
+                pa, cls._pa = cls._pa, None
+                try:
+                    pa.terminate()
+                except Exception:
+                    logger.exception("PortAudio terminate failed")
+                logger.debug("PortAudio terminated")
+
+    @classmethod
+    @contextlib.contextmanager
+    def session(cls):
+        pa = cls.acquire()
+        try:
+            yield pa
+        finally:
+            cls.release()
+
+    @classmethod
+    def in_use(cls) -> bool:
+        return cls._refs > 0
+
+    @classmethod
+    def invalidate(cls):
+        """ Devices changed (hotplug, default switch), the next `device_table` call rescans. """
+        with cls._lock:
+            cls._stale = True
+
+    @classmethod
+    def device_table(cls, refresh: bool = False) -> DeviceTable:
+        with cls._lock:
+            if refresh or cls._table_backend is not audio_backends.get_backend():
+                cls._stale = True
+            if cls._table is not None and cls._stale and cls._refs:
+                # can't rescan under an open stream, PortAudio wouldn't see anything new anyway
+                logger.debug("device table is stale but PortAudio is in use, serving the old one")
+                return cls._table
+            if cls._table is None or cls._stale:
+                backend = audio_backends.get_backend()
+                cls._install(*cls._scan(), backend)
+            return cls._table
+
+    @classmethod
+    def _install(cls, host_apis: List[dict], devices: List[dict], backend) -> bool:
+        """ Takes a scan (under the lock), a new generation only if it differs from what's there. """
+        changed = cls._table is None or (host_apis, devices) != (cls._table.host_apis, cls._table.devices)
+        if changed:
+            cls._generation += 1
+            cls._table = DeviceTable(host_apis, devices, cls._generation)
+            cls._capabilities = {}
+        cls._table_backend = backend
+        cls._stale = False
+        return changed
+
+    @classmethod
+    def seed(cls, host_apis: List[dict], devices: List[dict]) -> bool:
+        """
+        Serves a table from elsewhere (a previous run's snapshot) until the first real scan, so
+        startup doesn't wait on initializing PortAudio. Ignored once there is a table.
+        """
+        with cls._lock:
+            if cls._table is not None:
+                return False
+            cls._install(host_apis, devices, audio_backends.get_backend())
+            return True
+
+    @classmethod
+    def revalidate(cls) -> bool:
+        """
+        Rescans now without holding up readers, they get the current table until the scan is in.
+        True if anything changed. Like a refresh, it's deferred while a stream has PortAudio open.
+        """
+        with cls._lock:
+            if cls._table is not None and cls._refs:
+                cls._stale = True
+                return False
+            backend = audio_backends.get_backend()
+        scan = cls._scan()
+        with cls._lock:
+            return cls._install(*scan, backend)
+
+    @classmethod
+    def capabilities(cls, device_index: int, is_input: bool = True) -> EndpointCapabilities:
+        """ Probed once per device and direction, forgotten when the table is rescanned. """
+        table = cls.device_table()
+        key = (device_index, is_input)
+        with cls._lock:
+            capabilities = cls._capabilities.get(key)
+        if capabilities is not None:
+            return capabilities
+        # the probe is a few dozen PortAudio calls, nobody else should wait on the lock for it.
+        # Two threads may both probe, the first one in is what everyone gets
+        capabilities = cls._probe(table.device(device_index), is_input)
+        with cls._lock:
+            if cls._table is not table:
+                # rescanned meanwhile, the index may mean another device now
+                return capabilities
+            return cls._capabilities.setdefault(key, capabilities)
+
+    @classmethod
+    def _probe(cls, device: dict, is_input: bool) -> EndpointCapabilities:
+        direction = "Input" if is_input else "Output"
+        channels = device[f"max{direction}Channels"]
+        if not channels:
+            raise TftimException(f"device {device['index']} ({device['name']}) has no {direction.lower()} channels")
+        default_rate = int(device["defaultSampleRate"])
+        prefix = direction.lower()
+
+        def supported(pa, rate: int, sample_format: SampleFormat) -> bool:
+            try:
+                return pa.is_format_supported(
+                    rate,
+                    **{f"{prefix}_device": device["index"], f"{prefix}_channels": channels, f"{prefix}_format": PYAUDIO_SAMPLE_FORMAT[sample_format]},
+                )
+            except ValueError:
+                return False
+
+        # formats at the default rate, then rates in the first format that works. Hosts that take
+        # a format at one rate take it at all of them, and that keeps it to ~16 probes, not 55
+        with cls.session() as pa:
+            sample_formats = [sample_format for sample_format in SampleFormat if supported(pa, default_rate, sample_format)]
+            probe_format = SampleFormat.INT_16 if SampleFormat.INT_16 in sample_formats else (sample_formats or [SampleFormat.INT_16])[0]
+            rates = [rate for rate in sorted({*_PROBE_RATES, default_rate}) if supported(pa, rate, probe_format)]
+        logger.debug("device %s %s: %s at %s", device["index"], prefix, [f.name for f in sample_formats], rates)
+        return EndpointCapabilities(
+            device_index=device["index"],
+            is_input=is_input,
+            channels=channels,
+            default_rate=default_rate,
+            rates=rates,
+            sample_formats=sample_formats,
+            low_latency_s=device[f"defaultLow{direction}Latency"],
+            high_latency_s=device[f"defaultHigh{direction}Latency"],
+        )
+
+    @classmethod
+    def _scan(cls) -> Tuple[List[dict], List[dict]]:
+        with cls.session() as pa:
+            host_apis = [pa.get_host_api_info_by_index(i) for i in range(pa.get_host_api_count())]
+            devices = [
+                pa.get_device_info_by_host_api_device_index(host_api["index"], i)
+                for host_api in host_apis
+                for i in range(host_api["deviceCount"])
+            ]
+        logger.debug("scanned %d host apis and %d devices", len(host_apis), len(devices))
+        return host_apis, devices
+
+
+@contextlib.contextmanager
+def _com_apartment():
+    """ MTA COM for the current thread where pythoncom is around (WASAPI wants one per audio thread). """
+    com_inited = False
+    if _HAS_PYCOM:
+        try:
+            pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+            com_inited = True
+        except Exception:
+            pass
+    try:
+        yield
+    finally:
+        if com_inited:
+            try:
+                pythoncom.CoUninitialize()
+            except Exception:
+                pass
+
+
 class PyAudioWrapper:
 
     """
     PyAudioWPatch is a fork of PyAudio, so I need to only use the base implemented methods in PyAudio to achieve what I'd like here
     
+    Everything is answered from PortAudioSession's cached device table.
     """
 
     WASAPI_LOOPBACK_SUFFIX = " [Loopback]"
@@ -63,30 +342,212 @@ class PyAudioWrapper:
     @contextlib.contextmanager
     def _with_pa(cls):
         # Use the globally-selected `pyaudio` (or `pyaudiowpatch` on Windows)
-        pa = pyaudio.PyAudio()
-        try:
+        with PortAudioSession.session() as pa:
             yield pa
-        finally:
-            pa.terminate()
+
+    @classmethod
+    def refresh(cls):
+        PortAudioSession.device_table(refresh=True)
 
     @classmethod
     def get_host_api_data(cls):
-        with cls._with_pa() as pa:
-            return [pa.get_host_api_info_by_index(i) for i in range(0, pa.get_host_api_count())]
+        return list(PortAudioSession.device_table().host_apis)
 
     @classmethod
     def get_host_api_name_by_index(cls, index):
-        with cls._with_pa() as pa:
-            return pa.get_host_api_info_by_index(index)["name"]
+        return PortAudioSession.device_table().host_api_name(index)
 
     @classmethod
     def get_audio_endpoint_data(cls):
-        with cls._with_pa() as pa:
-            return [
-                pa.get_device_info_by_host_api_device_index(host_api["index"], i)
-                for host_api in cls.get_host_api_data()
-                for i in range(host_api["deviceCount"])
-            ]
+        return list(PortAudioSession.device_table().devices)
+
+
+_HISTOGRAM_BUCKETS = 24  # log2 microsecond buckets, the last one also holds everything slower
+
+
+@ensure_savable
+@dataclass(slots=True)
+class CaptureStatsSnapshot(SavableObject):
+
+    """ CaptureStats at one point in time. """
+
+    callbacks: int
+    frames: int
+    bytes: int
+    input_overflows: int        # callbacks PortAudio flagged with paInputOverflow (audio lost in the driver)
+    input_underflows: int
+    dropped_blocks: int         # blocks thrown away because the consumer fell behind
+    errors: int
+    queue_high_water: int       # most blocks ever waiting for the consumer
+    callback_max_us: float
+    # callbacks per execution time, bucket i is [2**(i-1), 2**i) us, bucket 0 is under 1 us
+    callback_histogram_us: List[int]
+    slow_callbacks: int = 0     # callbacks that took more than half a buffer
+    frames_per_buffer: int = 0
+
+    def callback_percentile_us(self, q: float) -> float:
+        """ Upper edge of the histogram bucket holding the q-th (0-1) fastest callback. """
+        return _histogram_percentile(self.callback_histogram_us, self.callback_max_us, q)
+
+
+def _histogram_percentile(histogram: List[int], max_us: float, q: float) -> float:
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= q * total:
+            return min(float(1 << i), max_us)
+    return max_us
+
+
+class _CallbackTiming:
+
+    """ Max and log2 histogram of how long audio callbacks take, and how many ran over budget. """
+
+    def __init__(self):
+        self.callback_max_ns = 0
+        self.callback_histogram = [0] * _HISTOGRAM_BUCKETS
+        self.slow_callbacks = 0
+        self.slow_callback_ns = 0  # set with set_buffer, 0 never counts
+
+    def set_buffer(self, frames: int, rate: int):
+        self.slow_callback_ns = frames * 1_000_000_000 // (2 * rate)
+
+    def record_time(self, elapsed_ns: int):
+        self.callback_histogram[min((elapsed_ns // 1000).bit_length(), _HISTOGRAM_BUCKETS - 1)] += 1
+        if elapsed_ns > self.callback_max_ns:
+            self.callback_max_ns = elapsed_ns
+        if self.slow_callback_ns and elapsed_ns > self.slow_callback_ns:
+            self.slow_callbacks += 1
+
+
+class CaptureStats(_CallbackTiming):
+
+    """
+    Health counters for one capture, updated from the audio callback. Only plain int increments
+    happen there, no locks, so a snapshot taken mid callback can be a block behind, never wrong
+    by more than that.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks = 0
+        self.frames = 0
+        self.bytes = 0
+        self.input_overflows = 0
+        self.input_underflows = 0
+        self.dropped_blocks = 0
+        self.errors = 0
+        self.last_error: Optional[BaseException] = None
+        self.queue_high_water = 0
+        self.frames_per_buffer = 0
+
+    def set_buffer(self, frames: int, rate: int):
+        super().set_buffer(frames, rate)
+        self.frames_per_buffer = frames
+
+    @property
+    def trouble(self) -> int:
+        """ Overflows plus slow callbacks, what makes a capture want a bigger buffer. """
+        return self.input_overflows + self.slow_callbacks
+
+    def record_callback(self, frame_count: int, nbytes: int, status: int):
+        self.callbacks += 1
+        self.frames += frame_count
+        self.bytes += nbytes
+        if status & audio_backends.paInputOverflow:
+            self.input_overflows += 1
+        if status & audio_backends.paInputUnderflow:
+            self.input_underflows += 1
+
+    def record_queue(self, depth: int):
+        if depth > self.queue_high_water:
+            self.queue_high_water = depth
+
+    def record_error(self, error: BaseException):
+        self.errors += 1
+        self.last_error = error
+
+    def snapshot(self) -> CaptureStatsSnapshot:
+        return CaptureStatsSnapshot(
+            callbacks=self.callbacks,
+            frames=self.frames,
+            bytes=self.bytes,
+            input_overflows=self.input_overflows,
+            input_underflows=self.input_underflows,
+            dropped_blocks=self.dropped_blocks,
+            errors=self.errors,
+            queue_high_water=self.queue_high_water,
+            callback_max_us=self.callback_max_ns / 1000,
+            callback_histogram_us=list(self.callback_histogram),
+            slow_callbacks=self.slow_callbacks,
+            frames_per_buffer=self.frames_per_buffer,
+        )
+
+    def stream(self, interval: float = 1.0) -> Stream[CaptureStatsSnapshot]:
+        """ A snapshot every `interval` seconds. """
+        return Stream.from_poll(self.snapshot, interval)
+
+
+def _capture_buffer_frames(device_index: int, rate: int, latency_ms: Optional[float], max_frames: int) -> int:
+    """ Starting buffer for a capture that wasn't given one, from the device's (cached) capabilities. """
+    capabilities = PortAudioSession.capabilities(device_index, is_input=True)
+    return min(max_frames, capabilities.frames_per_buffer(None if latency_ms is None else latency_ms / 1000, rate))
+
+
+class _BufferGrowth:
+
+    """
+    The capture health check: overflows or slow callbacks since the last check mean the stream
+    should be reopened with twice the buffer, up to `max_frames`. That loses a few ms of audio
+    once, instead of losing some on every overflow. Never grows a buffer the caller picked.
+    """
+
+    def __init__(self, stats: CaptureStats, frames: int, max_frames: int, adaptive: bool = True):
+        self.stats = stats
+        self.frames = frames
+        self.max_frames = max_frames
+        self.adaptive = adaptive
+        self._seen = stats.trouble
+
+    def check(self) -> Optional[int]:
+        """ The buffer to reopen with, None to carry on. """
+        trouble = self.stats.trouble
+        grow = self.adaptive and trouble > self._seen and self.frames < self.max_frames
+        self._seen = trouble
+        if not grow:
+            return None
+        self.frames = min(self.max_frames, 2 * self.frames)
+        return self.frames
+
+
+class PcmBlockIterator:
+
+    """ What get_pcm_blocks hands out: iterate it for the blocks, ask it how the capture is doing. """
+
+    _SENTINEL = None
+
+    def __init__(self, blocks: "queue.Queue[Optional[PcmBlock]]", stats: CaptureStats, worker_exc: List[BaseException]):
+        self._blocks = blocks
+        self._stats = stats
+        self._worker_exc = worker_exc
+
+    def __iter__(self) -> Iterator[PcmBlock]:
+        while True:
+            blk = self._blocks.get()
+            if blk is self._SENTINEL:
+                if self._worker_exc:
+                    raise self._worker_exc[-1]
+                break
+            yield blk
+
+    def stats(self) -> CaptureStatsSnapshot:
+        return self._stats.snapshot()
+
+    def stats_stream(self, interval: float = 1.0) -> Stream[CaptureStatsSnapshot]:
+        return self._stats.stream(interval)
 
 
 @contextlib.contextmanager
@@ -94,53 +555,67 @@ def get_pcm_blocks(
     *,
     # For PyAudio open kwargs for input
     input_device_index: int = None,
-    frames_per_buffer: int = 1024,
+    frames_per_buffer: int = None,
     sample_format: SampleFormat = SampleFormat.INT_16,
     rate: int = None,
     channels: int = None,
     input_host_api_specific_stream_info: Any = None,
+    # Buffer sizing, only used when frames_per_buffer isn't given
+    latency_ms: float = None,
+    max_frames_per_buffer: int = _MAX_BUFFER_FRAMES,
     # Streaming behavior
     queue_size: int = 64,
     drop_oldest_on_full: bool = True,
     transform: Optional[Callable[[bytes, int, dict, int], Optional[bytes]]] = None,
-) -> Iterator[Iterator[PcmBlock]]:
+) -> Iterator[PcmBlockIterator]:
     """
     Generic PCM input stream helper for an AudioEndpoint.
 
-    Yields an iterator of PcmBlock objects. Defaults are inferred from the
-    provided `endpoint` when omitted (assumes input streaming).
+    Yields a PcmBlockIterator of PcmBlock objects. Rate and channels default to the device's.
+
+    Without `frames_per_buffer` the buffer is sized for `latency_ms` (the device's probed low
+    input latency if that's not given either), and whenever a health check sees overflows or
+    callbacks taking more than half a buffer, the stream is reopened with twice the buffer, up to
+    `max_frames_per_buffer`. An explicit `frames_per_buffer` is always kept as is.
     """
 
     pyaudio_format = PYAUDIO_SAMPLE_FORMAT[sample_format]
-    dtype = NUMPY_SAMPLE_FORMAT[sample_format]
 
     q: "queue.Queue[Optional[PcmBlock]]" = queue.Queue(maxsize=max(1, queue_size))
     stop_evt = threading.Event()
     worker_exc: list[BaseException] = []
-    SENTINEL = None
+    stats = CaptureStats()
+    SENTINEL = PcmBlockIterator._SENTINEL
 
     def _worker():
-        com_inited = False
-        if _HAS_PYCOM:
-            try:
-                pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
-                com_inited = True
-            except Exception:
-                pass
-
         pa = None
         stream = None
         try:
-            pa = pyaudio.PyAudio()
+            pa = PortAudioSession.acquire()
+            if input_device_index is None:
+                device = pa.get_default_input_device_info()
+            else:
+                device = pa.get_device_info_by_index(input_device_index)
+            stream_rate = rate or int(device["defaultSampleRate"])
+            stream_channels = channels or device["maxInputChannels"]
+            adaptive = frames_per_buffer is None
+            if adaptive:
+                buffer_frames = _capture_buffer_frames(device["index"], stream_rate, latency_ms, max_frames_per_buffer)
+            else:
+                buffer_frames = frames_per_buffer
+            growth = _BufferGrowth(stats, buffer_frames, max_frames_per_buffer, adaptive)
 
             def _cb(in_data, frame_count, time_info, status):
+                started = time.perf_counter_ns()
+                stats.record_callback(frame_count, len(in_data), status)
                 try:
                     payload = transform(in_data, frame_count, time_info, status) if transform else None
                     payload = payload if payload is not None else in_data
-                    blk = PcmBlock(payload, dtype=dtype, channels=channels)
+                    blk = PcmBlock(payload, sample_format=sample_format, channels=stream_channels, rate=stream_rate)
                     try:
                         q.put_nowait(blk)
                     except queue.Full:
+                        stats.dropped_blocks += 1
                         if drop_oldest_on_full:
                             try:
                                 _ = q.get_nowait()
@@ -150,75 +625,70 @@ def get_pcm_blocks(
                                 q.put_nowait(blk)
                             except queue.Full:
                                 pass  # drop newest
+                    stats.record_queue(q.qsize())
                 except Exception as e:
+                    stats.record_error(e)
                     worker_exc.append(e)
-                return (None, pyaudio.paContinue)
+                stats.record_time(time.perf_counter_ns() - started)
+                return (None, audio_backends.paContinue)
 
-            start_immediately = True
+            def _open(frames: int):
+                stats.set_buffer(frames, stream_rate)
+                opened = pa.open(
+                    format=pyaudio_format,
+                    channels=stream_channels,
+                    rate=stream_rate,
+                    input=True,
+                    input_device_index=input_device_index,
+                    frames_per_buffer=frames,
+                    stream_callback=_cb,
+                    start=True,
+                    input_host_api_specific_stream_info=input_host_api_specific_stream_info,
+                )
+                if not opened.is_active():
+                    opened.start_stream()
+                return opened
 
-            stream = pa.open(
-                format=pyaudio_format,
-                channels=channels,
-                rate=rate,
-                input=True,
-                input_device_index=input_device_index,
-                frames_per_buffer=frames_per_buffer,
-                stream_callback=_cb,
-                start=start_immediately,
-                input_host_api_specific_stream_info=input_host_api_specific_stream_info,
-            )
-
-            if not stream.is_active() and start_immediately:
-                stream.start_stream()
+            stream = _open(buffer_frames)
 
+            # stop_evt wakes this right away, the timeout catches streams that died and overflows
             while not stop_evt.is_set() and stream.is_active():
-                stop_evt.wait(0.05)
+                stop_evt.wait(_HEALTH_CHECK_S)
+                buffer_frames = growth.check()
+                if buffer_frames is not None and not stop_evt.is_set():
+                    logger.info("capture from device %s is struggling, reopening with %d frames per buffer", input_device_index, buffer_frames)
+                    old, stream = stream, None
+                    _close_stream(old)
+                    stream = _open(buffer_frames)
 
         except Exception as e:
+            stats.record_error(e)
             worker_exc.append(e)
         finally:
-            try:
-                if stream and stream.is_active():
-                    stream.stop_stream()
-            except Exception:
-                pass
-            try:
-                if stream:
-                    stream.close()
-            except Exception:
-                pass
+            if stream:
+                _close_stream(stream)
             try:
                 if pa:
-                    pa.terminate()
+                    PortAudioSession.release()
             except Exception:
                 pass
-            if _HAS_PYCOM and com_inited:
-                try:
-                    pythoncom.CoUninitialize()
-                except Exception:
-                    pass
             try:
                 q.put_nowait(SENTINEL)
             except Exception:
                 pass
 
             if worker_exc:
-                traceback.print_exception(worker_exc[-1], file=sys.stderr)
+                logger.error("capture from device %s failed", input_device_index, exc_info=worker_exc[-1])
 
-    t = threading.Thread(target=_worker, name="PcmWorker", daemon=True)
-    t.start()
+    def _run():
+        with _com_apartment():
+            _worker()
 
-    def _iter() -> Iterator[PcmBlock]:
-        while True:
-            blk = q.get()
-            if blk is SENTINEL:
-                if worker_exc:
-                    raise worker_exc[-1]
-                break
-            yield blk
+    t = threading.Thread(target=_run, name="PcmWorker", daemon=True)
+    t.start()
 
     try:
-        yield _iter()
+        yield PcmBlockIterator(q, stats, worker_exc)
     finally:
         stop_evt.set()
         try:
@@ -226,3 +696,942 @@ def get_pcm_blocks(
         except Exception:
             pass
         t.join(timeout=2.0)
+
+
+def _close_stream(stream):
+    """ Stops and closes, never raises (the stream may already be dead). """
+    try:
+        if stream.is_active():
+            stream.stop_stream()
+    except Exception:
+        pass
+    try:
+        stream.close()
+    except Exception:
+        pass
+
+
+def _block_clock(rate: int) -> Callable[[int, dict], int]:
+    """
+    pts_ns for every callback. PortAudio's `input_buffer_adc_time` is on the stream clock, it's
+    moved onto now_ns() once at the first callback so the device clock's spacing is kept. Host apis
+    that report no times at all (all 0) get frames counted from the first callback instead.
+    """
+    offset_ns = None
+    device_clock = None
+    frames = 0
+
+    def pts_ns(frame_count: int, time_info: dict) -> int:
+        nonlocal offset_ns, device_clock, frames
+        time_info = time_info or {}
+        adc_time = time_info.get("input_buffer_adc_time", 0.0)
+        if device_clock is None:
+            current_time = time_info.get("current_time", 0.0)
+            device_clock = bool(adc_time or current_time)
+            offset_ns = now_ns() - int((current_time if device_clock else 0.0) * 1e9)
+        if device_clock:
+            pts = offset_ns + int(adc_time * 1e9)
+        else:
+            pts = offset_ns + frames * 1_000_000_000 // rate
+        frames += frame_count
+        return pts
+
+    return pts_ns
+
+
+def pcm_stream(
+    *,
+    input_device_index: int,
+    frames_per_buffer: int = None,
+    sample_format: SampleFormat = SampleFormat.INT_16,
+    rate: int = None,
+    channels: int = None,
+    input_host_api_specific_stream_info: Any = None,
+    latency_ms: float = None,
+    max_frames_per_buffer: int = _MAX_BUFFER_FRAMES,
+    max_pending_blocks: int = 256,
+    stats: CaptureStats = None,
+) -> Stream[PcmBlock]:
+    """
+    Input stream as a Stream[PcmBlock], fed straight from the PortAudio callback.
+
+    The callback appends to a deque and schedules one wakeup on the event loop per batch
+    (call_soon_threadsafe only when none is pending), no worker thread or queue in between.
+    Blocks carry pts_ns from PortAudio's time_info, which is also the stream timestamp. If the
+    consumer falls `max_pending_blocks` behind, the oldest blocks are dropped. The stream is
+    opened when iteration starts and closed when it stops. Pass a CaptureStats to watch it.
+    Without `frames_per_buffer` the buffer is sized and grown like in get_pcm_blocks, the audio
+    lost while reopening shows up as a gap in the pts.
+    """
+    stats = stats if stats is not None else CaptureStats()
+
+    async def agen():
+        loop = asyncio.get_running_loop()
+        device = PortAudioSession.device_table().device(input_device_index)
+        stream_rate = rate or int(device["defaultSampleRate"])
+        stream_channels = channels or device["maxInputChannels"]
+        adaptive = frames_per_buffer is None
+        buffer_frames = frames_per_buffer or _capture_buffer_frames(input_device_index, stream_rate, latency_ms, max_frames_per_buffer)
+        growth = _BufferGrowth(stats, buffer_frames, max_frames_per_buffer, adaptive)
+        pending: "collections.deque[PcmBlock]" = collections.deque(maxlen=max_pending_blocks)
+        ready = asyncio.Event()
+        wakeup_scheduled = threading.Event()
+        clock = None  # a new one per opened stream, its time_info starts over
+
+        def callback(in_data, frame_count, time_info, status):
+            started = time.perf_counter_ns()
+            stats.record_callback(frame_count, len(in_data), status)
+            block = PcmBlock(
+                in_data,
+                sample_format=sample_format,
+                channels=stream_channels,
+                rate=stream_rate,
+                pts_ns=clock(frame_count, time_info),
+            )
+            if len(pending) == max_pending_blocks:
+                stats.dropped_blocks += 1
+            pending.append(block)
+            stats.record_queue(len(pending))
+            flag = audio_backends.paContinue
+            if not wakeup_scheduled.is_set():
+                wakeup_scheduled.set()
+                try:
+                    loop.call_soon_threadsafe(ready.set)
+                except RuntimeError:
+                    flag = audio_backends.paComplete  # loop is gone
+            stats.record_time(time.perf_counter_ns() - started)
+            return (None, flag)
+
+        def open_stream(frames: int):
+            nonlocal clock
+            clock = _block_clock(stream_rate)
+            stats.set_buffer(frames, stream_rate)
+            pa = PortAudioSession.acquire()
+            try:
+                return pa.open(
+                    format=PYAUDIO_SAMPLE_FORMAT[sample_format],
+                    channels=stream_channels,
+                    rate=stream_rate,
+                    input=True,
+                    input_device_index=input_device_index,
+                    frames_per_buffer=frames,
+                    stream_callback=callback,
+                    start=True,
+                    input_host_api_specific_stream_info=input_host_api_specific_stream_info,
+                )
+            except BaseException:
+                PortAudioSession.release()
+                raise
+
+        def reopen_stream(old, frames: int):
+            # held across the swap, so PortAudio isn't terminated and rescanned in between
+            with PortAudioSession.session():
+                _close_stream(old)
+                PortAudioSession.release()
+                return open_stream(frames)
+
+        stream = await asyncio.to_thread(open_stream, buffer_frames)
+        next_check = loop.time() + CaptureSession.HEALTH_CHECK_S
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), CaptureSession.HEALTH_CHECK_S)
+                except asyncio.TimeoutError:
+                    if not stream.is_active():
+                        raise TftimException(f"input stream for device {input_device_index} stopped")
+                else:
+                    ready.clear()
+                    wakeup_scheduled.clear()
+                    for _ in range(len(pending)):
+                        block = pending.popleft()
+                        yield (block, TimeStamp(block.pts_ns))
+                if loop.time() >= next_check:
+                    next_check = loop.time() + CaptureSession.HEALTH_CHECK_S
+                    frames = growth.check()
+                    if frames is not None:
+                        logger.info("capture from device %s is struggling, reopening with %d frames per buffer", input_device_index, frames)
+                        old, stream = stream, None
+                        stream = await asyncio.to_thread(reopen_stream, old, frames)
+        finally:
+            if stream is not None:
+                try:
+                    _close_stream(stream)
+                finally:
+                    PortAudioSession.release()
+
+    return Stream(agen)
+
+
+TransformCallback = Callable[[bytes, int, dict, int], Optional[bytes]]
+
+
+class CaptureSession:
+
+    """
+    Captures any number of input endpoints on the shared PortAudio instance with a single
+    supervisor thread, which owns the COM apartment and opens/closes streams, so endpoints can
+    come and go without touching the others.
+
+    Every stream callback appends (key, block) to one bounded deque, `read` hands out everything
+    that piled up since the last call grouped per key, so the consumer wakes once per batch
+    instead of once per block per endpoint. When the consumer falls behind by
+    `max_pending_blocks`, the oldest blocks go first (counted in `dropped_blocks`).
+
+        with CaptureSession() as capture:
+            capture.add("mic", mic.index)
+            capture.add("loopback", loopback.index)
+            for batch in capture.batches():
+                ...
+
+    Blocks carry pts_ns from their stream's time_info (see _block_clock), so endpoints coming
+    and going never shift the others' timelines.
+
+    Streams that stop on their own (device unplugged, driver error) are closed by the
+    supervisor and show up in `errors`. Streams that overflow or run slow callbacks are reopened
+    with twice the buffer, like in get_pcm_blocks, unless `add` was given a `frames_per_buffer`. `stats()` has CaptureStats per endpoint, blocks dropped
+    from the shared deque count against the endpoint they came from.
+    """
+
+    HEALTH_CHECK_S = _HEALTH_CHECK_S
+
+    def __init__(self, max_pending_blocks: int = 1024):
+        self.dropped_blocks = 0
+        self.errors: Dict[Hashable, BaseException] = {}
+        self._stats: Dict[Hashable, CaptureStats] = {}
+        self._pending: "collections.deque[tuple]" = collections.deque(maxlen=max_pending_blocks)
+        self._ready = threading.Event()
+        self._commands: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._streams: Dict[Hashable, Any] = {}
+        self._options: Dict[Hashable, dict] = {}
+        self._growth: Dict[Hashable, _BufferGrowth] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    @property
+    def keys(self) -> List[Hashable]:
+        return list(self._streams)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="CaptureSession", daemon=True)
+            self._thread.start()
+        return self
+
+    def add(
+        self,
+        key: Hashable,
+        input_device_index: int,
+        *,
+        sample_format: SampleFormat = SampleFormat.INT_16,
+        frames_per_buffer: int = None,
+        rate: int = None,
+        channels: int = None,
+        input_host_api_specific_stream_info: Any = None,
+        transform: Optional[TransformCallback] = None,
+        latency_ms: float = None,
+        max_frames_per_buffer: int = _MAX_BUFFER_FRAMES,
+    ):
+        """
+        Opens a stream for the device, rate and channels default to the device's and the buffer
+        to `latency_ms` (its low latency by default). Blocks until it's running.
+        """
+        if key in self._streams:
+            raise TftimException(f"already capturing {key!r}")
+        device = PortAudioSession.device_table().device(input_device_index)
+        rate = rate or int(device["defaultSampleRate"])
+        options = {
+            "input_device_index": input_device_index,
+            "sample_format": sample_format,
+            "frames_per_buffer": frames_per_buffer or _capture_buffer_frames(input_device_index, rate, latency_ms, max_frames_per_buffer),
+            "adaptive": frames_per_buffer is None,
+            "max_frames_per_buffer": max_frames_per_buffer,
+            "rate": rate,
+            "channels": channels or device["maxInputChannels"],
+            "input_host_api_specific_stream_info": input_host_api_specific_stream_info,
+            "transform": transform,
+        }
+        self._call("_open", key, options)
+
+    def remove(self, key: Hashable):
+        """ Stops and closes one stream, blocks already captured from it are still delivered. """
+        self._call("_close", key, None)
+
+    def _call(self, action: str, key: Hashable, options: Optional[dict]):
+        if self._closed:
+            raise TftimException("capture session is closed")
+        self.start()
+        done = Future()
+        self._commands.put((action, key, options, done))
+        return done.result()
+
+    def read(self, timeout: float = None) -> Dict[Hashable, List[PcmBlock]]:
+        """ Everything captured since the last read, per key in arrival order. Waits up to `timeout` for the first block. """
+        if not self._pending and not self._ready.wait(timeout):
+            return {}
+        self._ready.clear()
+        pending = self._pending
+        batch: Dict[Hashable, List[PcmBlock]] = {}
+        # blocks appended after the clear set the event again, so they're never missed
+        for _ in range(len(pending)):
+            key, block = pending.popleft()
+            batch.setdefault(key, []).append(block)
+        return batch
+
+    def stats(self, key: Hashable = None):
+        """ Snapshot for one endpoint, or a dict of all of them. """
+        if key is not None:
+            return self._stats[key].snapshot()
+        return {key: stats.snapshot() for key, stats in list(self._stats.items())}
+
+    def stats_stream(self, interval: float = 1.0) -> Stream[Dict[Hashable, CaptureStatsSnapshot]]:
+        return Stream.from_poll(self.stats, interval)
+
+    def batches(self) -> Iterator[Dict[Hashable, List[PcmBlock]]]:
+        """ Batches until the session is closed. """
+        while not self._closed or self._pending:
+            batch = self.read()
+            if batch:
+                yield batch
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._commands.put(None)
+            self._thread.join()
+        self._ready.set()  # wakes a reader blocked in `read`
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _callback(self, key: Hashable, options: dict, stats: CaptureStats):
+        pending, ready, all_stats = self._pending, self._ready, self._stats
+        sample_format, channels, rate = options["sample_format"], options["channels"], options["rate"]
+        transform = options["transform"]
+        clock = _block_clock(rate)
+
+        def callback(in_data, frame_count, time_info, status):
+            started = time.perf_counter_ns()
+            stats.record_callback(frame_count, len(in_data), status)
+            try:
+                payload = transform(in_data, frame_count, time_info, status) if transform else None
+                block = PcmBlock(
+                    in_data if payload is None else payload,
+                    sample_format=sample_format,
+                    channels=channels,
+                    rate=rate,
+                    pts_ns=clock(frame_count, time_info),
+                )
+            except Exception as e:
+                stats.record_error(e)
+                self.errors[key] = e
+                return (None, audio_backends.paAbort)
+            if len(pending) == pending.maxlen:
+                self.dropped_blocks += 1
+                oldest = all_stats.get(pending[0][0])
+                if oldest is not None:
+                    oldest.dropped_blocks += 1
+            pending.append((key, block))
+            stats.record_queue(len(pending))
+            ready.set()
+            stats.record_time(time.perf_counter_ns() - started)
+            return (None, audio_backends.paContinue)
+
+        return callback
+
+    def _open(self, pa, key: Hashable, options: dict):
+        if key in self._streams:
+            raise TftimException(f"already capturing {key!r}")
+        self.errors.pop(key, None)
+        stats = self._stats[key] = CaptureStats()
+        self._streams[key] = self._open_stream(pa, key, options, stats)
+        self._options[key] = options
+        self._growth[key] = _BufferGrowth(stats, options["frames_per_buffer"], options["max_frames_per_buffer"], options["adaptive"])
+        logger.debug("capturing %r from device %d", key, options["input_device_index"])
+
+    def _open_stream(self, pa, key: Hashable, options: dict, stats: CaptureStats):
+        stats.set_buffer(options["frames_per_buffer"], options["rate"])
+        return pa.open(
+            format=PYAUDIO_SAMPLE_FORMAT[options["sample_format"]],
+            channels=options["channels"],
+            rate=options["rate"],
+            input=True,
+            input_device_index=options["input_device_index"],
+            frames_per_buffer=options["frames_per_buffer"],
+            stream_callback=self._callback(key, options, stats),
+            start=True,
+            input_host_api_specific_stream_info=options["input_host_api_specific_stream_info"],
+        )
+
+    def _reopen(self, pa, key: Hashable, frames: int):
+        """ Same endpoint with another buffer size, the stats carry on. """
+        _close_stream(self._streams.pop(key))
+        options = self._options[key] = {**self._options[key], "frames_per_buffer": frames}
+        try:
+            self._streams[key] = self._open_stream(pa, key, options, self._stats[key])
+        except Exception as e:
+            logger.exception("reopening the stream for %r failed", key)
+            self.errors[key] = e
+            self._options.pop(key)
+            self._growth.pop(key)
+
+    def _close(self, pa, key: Hashable, options=None):
+        stream = self._streams.pop(key, None)
+        self._options.pop(key, None)
+        self._growth.pop(key, None)
+        if stream is None:
+            raise TftimException(f"not capturing {key!r}")
+        try:
+            if stream.is_active():
+                stream.stop_stream()
+            stream.close()
+        except Exception:
+            logger.exception("closing the stream for %r failed", key)
+
+    def _check_streams(self, pa):
+        for key, stream in list(self._streams.items()):
+            if not stream.is_active():
+                logger.warning("stream %r stopped on its own, closing it", key)
+                self.errors.setdefault(key, TftimException(f"stream {key!r} stopped"))
+                self._close(pa, key)
+                continue
+            frames = self._growth[key].check()
+            if frames is not None:
+                logger.info("capture %r is struggling, reopening with %d frames per buffer", key, frames)
+                self._reopen(pa, key, frames)
+
+    def _run(self):
+        with _com_apartment(), PortAudioSession.session() as pa:
+            try:
+                while True:
+                    try:
+                        command = self._commands.get(timeout=self.HEALTH_CHECK_S)
+                    except queue.Empty:
+                        self._check_streams(pa)
+                        continue
+                    if command is None:
+                        break
+                    action, key, options, done = command
+                    try:
+                        done.set_result(getattr(self, action)(pa, key, options))
+                    except BaseException as e:
+                        done.set_exception(e)
+            finally:
+                for key in list(self._streams):
+                    self._close(pa, key)
+                # commands that raced with close
+                while True:
+                    try:
+                        command = self._commands.get_nowait()
+                    except queue.Empty:
+                        break
+                    if command is not None:
+                        command[3].set_exception(TftimException("capture session is closed"))
+
+
+@ensure_savable
+@dataclass(slots=True)
+class PlaybackStatsSnapshot(SavableObject):
+
+    """ PlaybackStats at one point in time. """
+
+    callbacks: int
+    frames: int
+    underruns: int              # callbacks that ran the jitter buffer dry
+    underrun_frames: int        # silence played because of them
+    output_underflows: int      # callbacks PortAudio flagged with paOutputUnderflow
+    dropped_frames: int         # frames thrown away because the producer ran ahead
+    buffered_ms: float
+    target_latency_ms: float
+    callback_max_us: float
+    callback_histogram_us: List[int]
+
+    def callback_percentile_us(self, q: float) -> float:
+        return _histogram_percentile(self.callback_histogram_us, self.callback_max_us, q)
+
+
+class PlaybackStats(_CallbackTiming):
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks = 0
+        self.frames = 0
+        self.underruns = 0
+        self.underrun_frames = 0
+        self.output_underflows = 0
+        self.dropped_frames = 0
+
+
+class PcmPlayer:
+
+    """
+    Plays PcmBlocks on an output device through a jitter buffer.
+
+    Blocks are written into a preallocated FrameRing of raw frame bytes (any sample format, no
+    conversion), the PortAudio callback copies the next `frames_per_buffer` frames into a
+    preallocated buffer and hands PortAudio a read-only memoryview of it, so the callback doesn't
+    allocate sample memory.
+
+    Playback starts once `latency_ms` of audio is buffered. When the buffer runs dry the gap is
+    filled with silence, counted as an underrun, and the player buffers up to the target again
+    before resuming. With `adaptive`, every underrun raises the target by half (up to
+    `max_latency_ms`) and each `recovery_s` without one lowers it a buffer at a time back towards
+    `latency_ms`, so a flaky source gets more slack and a steady one stays tight.
+
+    `write(block)` waits for room by default, which paces file playback. Live sources should pass
+    `wait=False`, then a producer running ahead (clock drift, bursts) has the oldest frames
+    dropped down to the target instead of adding latency.
+    """
+
+    def __init__(
+        self,
+        output_device_index: int,
+        sample_format: SampleFormat,
+        channels: int,
+        rate: int,
+        *,
+        latency_ms: float = 40.0,
+        max_latency_ms: float = 400.0,
+        frames_per_buffer: int = None,
+        adaptive: bool = True,
+        recovery_s: float = 5.0,
+        output_host_api_specific_stream_info: Any = None,
+    ):
+        self.output_device_index = output_device_index
+        self.sample_format = sample_format
+        self.channels = channels
+        self.rate = rate
+        self.adaptive = adaptive
+        self.frames_per_buffer = frames_per_buffer or max(64, int(rate * latency_ms / 4000))
+        self._min_target = max(self.frames_per_buffer, int(rate * latency_ms / 1000))
+        self._max_target = max(self._min_target, int(rate * max_latency_ms / 1000))
+        self._target = self._min_target
+        self._recovery_frames = int(rate * recovery_s)
+        self._frames_since_underrun = 0
+        self._primed = False
+        self._draining = False
+        self._stats = PlaybackStats()
+        self._output_host_api_specific_stream_info = output_host_api_specific_stream_info
+
+        frame_bytes = channels * SAMPLE_WIDTH[sample_format]
+        self._silence = 0x80 if sample_format == SampleFormat.UINT_8 else 0
+        self._ring = FrameRing(2 * self._max_target + self.frames_per_buffer, frame_bytes, np.uint8)
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._allocate_output(self.frames_per_buffer)
+        self._stream = None
+        self._pa = None
+
+    def _allocate_output(self, frames: int):
+        # only grows when the host hands us bigger buffers than asked for, never in steady state
+        self._out = np.full((frames, self._ring.channels), self._silence, dtype=np.uint8)
+        self._views = {}
+
+    @property
+    def target_latency_ms(self) -> float:
+        return 1000 * self._target / self.rate
+
+    @property
+    def buffered_ms(self) -> float:
+        return 1000 * self._ring.available / self.rate
+
+    def stats(self) -> PlaybackStatsSnapshot:
+        stats = self._stats
+        return PlaybackStatsSnapshot(
+            callbacks=stats.callbacks,
+            frames=stats.frames,
+            underruns=stats.underruns,
+            underrun_frames=stats.underrun_frames,
+            output_underflows=stats.output_underflows,
+            dropped_frames=stats.dropped_frames,
+            buffered_ms=self.buffered_ms,
+            target_latency_ms=self.target_latency_ms,
+            callback_max_us=stats.callback_max_ns / 1000,
+            callback_histogram_us=list(stats.callback_histogram),
+        )
+
+    def stats_stream(self, interval: float = 1.0) -> Stream[PlaybackStatsSnapshot]:
+        return Stream.from_poll(self.stats, interval)
+
+    def start(self):
+        if self._stream is not None:
+            return self
+        self._pa = PortAudioSession.acquire()
+        try:
+            self._stream = self._pa.open(
+                format=PYAUDIO_SAMPLE_FORMAT[self.sample_format],
+                channels=self.channels,
+                rate=self.rate,
+                output=True,
+                output_device_index=self.output_device_index,
+                frames_per_buffer=self.frames_per_buffer,
+                stream_callback=self._callback,
+                start=True,
+                output_host_api_specific_stream_info=self._output_host_api_specific_stream_info,
+            )
+        except BaseException:
+            self._pa = None
+            PortAudioSession.release()
+            raise
+        return self
+
+    def write(self, block: PcmBlock, wait: bool = True, timeout: float = None):
+        if self._stream is None:
+            raise TftimException("player isn't running, call start() first")
+        if block.channels != self.channels:
+            raise TftimException(f"player is {self.channels}ch, can't play a {block.channels}ch block")
+        if block.rate and block.rate != self.rate:
+            raise TftimException(f"player runs at {self.rate} Hz, got a {block.rate} Hz block, resample it first")
+        if block.sample_format != self.sample_format:
+            block = block.convert(self.sample_format)
+        frames = np.frombuffer(block.bytes, dtype=np.uint8).reshape(-1, self._ring.channels)
+        ring = self._ring
+        with self._room:
+            self._draining = False
+            while len(frames):
+                if wait:
+                    # keep up to twice the target buffered (the ring always has room for that)
+                    high_water = 2 * self._target
+                    if not self._room.wait_for(lambda: ring.available < high_water or self._stream is None, timeout):
+                        raise TftimException("timed out waiting for the output device")
+                    if self._stream is None:
+                        raise TftimException("player was closed")
+                    n = min(len(frames), high_water - ring.available)
+                else:
+                    n = min(len(frames), ring.capacity)
+                    overflow = ring.available + n - ring.capacity
+                    if overflow > 0:
+                        ring.discard(overflow)
+                        self._stats.dropped_frames += overflow
+                ring.write(frames[:n])
+                frames = frames[n:]
+            if not wait:
+                excess = ring.available - 2 * self._target
+                if excess > 0:
+                    ring.discard(excess)
+                    self._stats.dropped_frames += excess
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        started = time.perf_counter_ns()
+        stats = self._stats
+        stats.callbacks += 1
+        stats.frames += frame_count
+        if status & audio_backends.paOutputUnderflow:
+            stats.output_underflows += 1
+        if frame_count > len(self._out):
+            self._allocate_output(frame_count)
+        out = self._out
+        ring = self._ring
+        with self._lock:
+            if not self._primed and ring.available >= self._target:
+                self._primed = True
+            played = min(frame_count, ring.available) if self._primed else 0
+            if played:
+                ring.read(played, out=out[:played])
+            if played < frame_count:
+                out[played:frame_count] = self._silence
+                if self._primed and not self._draining:
+                    self._underrun(frame_count - played)
+            else:
+                self._recover(frame_count)
+            self._room.notify()
+        view = self._views.get(frame_count)
+        if view is None:
+            view = self._views[frame_count] = memoryview(out[:frame_count].reshape(-1)).toreadonly()
+        stats.record_time(time.perf_counter_ns() - started)
+        return (view, audio_backends.paContinue)
+
+    def _underrun(self, frames: int):
+        self._primed = False
+        self._stats.underruns += 1
+        self._stats.underrun_frames += frames
+        self._frames_since_underrun = 0
+        if self.adaptive:
+            self._target = min(self._max_target, self._target + max(self.frames_per_buffer, self._target // 2))
+
+    def _recover(self, frames: int):
+        self._frames_since_underrun += frames
+        if self.adaptive and self._frames_since_underrun >= self._recovery_frames and self._target > self._min_target:
+            self._target = max(self._min_target, self._target - self.frames_per_buffer)
+            self._frames_since_underrun = 0
+
+    def drain(self, timeout: float = None) -> bool:
+        """ Waits until everything written has been played. """
+        with self._room:
+            # the tail may be shorter than the target, play it anyway and don't call running dry an underrun
+            self._draining = True
+            self._primed = True
+            return self._room.wait_for(lambda: self._ring.available == 0 or self._stream is None, timeout)
+
+    def close(self):
+        stream, self._stream = self._stream, None
+        with self._room:
+            self._room.notify_all()
+        if stream is None:
+            return
+        try:
+            if stream.is_active():
+                stream.stop_stream()
+            stream.close()
+        finally:
+            self._pa = None
+            PortAudioSession.release()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def play_pcm_blocks(
+    blocks: Iterable[PcmBlock],
+    *,
+    output_device_index: int,
+    latency_ms: float = 40.0,
+    **options,
+) -> Optional[PlaybackStatsSnapshot]:
+    """ Plays blocks to the end (format, channels and rate from the first one) and returns the stats. """
+    player = None
+    try:
+        for block in blocks:
+            if player is None:
+                rate = block.rate or int(PortAudioSession.device_table().device(output_device_index)["defaultSampleRate"])
+                player = PcmPlayer(output_device_index, block.sample_format, block.channels, rate, latency_ms=latency_ms, **options).start()
+            player.write(block)
+        if player is not None:
+            player.drain()
+    finally:
+        if player is not None:
+            player.close()
+    return player.stats() if player is not None else None
+
+
+async def play_pcm_stream(
+    stream: Stream[PcmBlock],
+    *,
+    output_device_index: int,
+    latency_ms: float = 40.0,
+    **options,
+) -> Optional[PlaybackStatsSnapshot]:
+    """
+    Live version of play_pcm_blocks for a Stream, e.g. monitoring a capture or sending a mix to a
+    virtual cable. Writes never block the loop, a source running ahead gets trimmed instead.
+    """
+    player = None
+    try:
+        async for block, _ in stream:
+            if player is None:
+                rate = block.rate or int(PortAudioSession.device_table().device(output_device_index)["defaultSampleRate"])
+                player = PcmPlayer(output_device_index, block.sample_format, block.channels, rate, latency_ms=latency_ms, **options)
+                await asyncio.to_thread(player.start)
+            player.write(block, wait=False)
+        if player is not None:
+            await asyncio.to_thread(player.drain, 1.0)
+    finally:
+        if player is not None:
+            player.close()
+    return player.stats() if player is not None else None
+
+
+@ensure_savable
+@dataclass(slots=True)
+class DuplexStatsSnapshot(SavableObject):
+
+    """ DuplexStats at one point in time. """
+
+    callbacks: int
+    frames: int
+    input_overflows: int
+    input_underflows: int
+    output_overflows: int
+    output_underflows: int
+    errors: int                 # callbacks where the chain raised (they played silence)
+    buffer_us: float            # how long one buffer lasts, the callback has to finish well within it
+    cpu_load: float             # PortAudio's own estimate, 0-1
+    callback_max_us: float
+    callback_histogram_us: List[int]
+
+    def callback_percentile_us(self, q: float) -> float:
+        return _histogram_percentile(self.callback_histogram_us, self.callback_max_us, q)
+
+    def callback_load(self, q: float = 0.99) -> float:
+        """ Share of the buffer time the q-th fastest callback used. """
+        return self.callback_percentile_us(q) / self.buffer_us if self.buffer_us else 0.0
+
+
+class DuplexStats(_CallbackTiming):
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks = 0
+        self.frames = 0
+        self.input_overflows = 0
+        self.input_underflows = 0
+        self.output_overflows = 0
+        self.output_underflows = 0
+        self.errors = 0
+        self.last_error: Optional[BaseException] = None
+
+    def record_status(self, status: int):
+        if status & audio_backends.paInputOverflow:
+            self.input_overflows += 1
+        if status & audio_backends.paInputUnderflow:
+            self.input_underflows += 1
+        if status & audio_backends.paOutputOverflow:
+            self.output_overflows += 1
+        if status & audio_backends.paOutputUnderflow:
+            self.output_underflows += 1
+
+
+class DuplexPassthrough:
+
+    """
+    Input straight to output through a DspChain, inside the PortAudio callback (live monitoring).
+
+    The stream is opened as float32 on both sides so PortAudio does the int conversion, and the
+    callback only deinterleaves into a preallocated (channels, frames) buffer, runs the chain in
+    place, interleaves into a preallocated output buffer and hands back a cached read-only
+    memoryview of it. Nothing is allocated per callback apart from the numpy view objects, which
+    is what makes 128 frame buffers workable from python.
+
+    PyAudio opens both directions with the same channel count, and PortAudio only does duplex
+    between two devices of the same host api. If the chain raises, that buffer plays silence and
+    the error is counted in the stats. Chain parameters can be changed from any thread while it
+    runs.
+    """
+
+    def __init__(
+        self,
+        input_device_index: int,
+        output_device_index: int,
+        chain: DspProcessor = None,
+        *,
+        rate: int,
+        channels: int,
+        frames_per_buffer: int = 128,
+        input_host_api_specific_stream_info: Any = None,
+        output_host_api_specific_stream_info: Any = None,
+    ):
+        self.input_device_index = input_device_index
+        self.output_device_index = output_device_index
+        self.chain = chain
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self._input_host_api_specific_stream_info = input_host_api_specific_stream_info
+        self._output_host_api_specific_stream_info = output_host_api_specific_stream_info
+        self._stats = DuplexStats()
+        self._work = np.zeros((channels, frames_per_buffer), dtype=np.float32)
+        self._out = None
+        self._views = {}
+        self._allocate_output(frames_per_buffer)
+        self._stream = None
+        self._pa = None
+
+    def stats(self) -> DuplexStatsSnapshot:
+        stats = self._stats
+        stream = self._stream
+        return DuplexStatsSnapshot(
+            callbacks=stats.callbacks,
+            frames=stats.frames,
+            input_overflows=stats.input_overflows,
+            input_underflows=stats.input_underflows,
+            output_overflows=stats.output_overflows,
+            output_underflows=stats.output_underflows,
+            errors=stats.errors,
+            buffer_us=1e6 * self.frames_per_buffer / self.rate,
+            cpu_load=stream.get_cpu_load() if stream is not None else 0.0,
+            callback_max_us=stats.callback_max_ns / 1000,
+            callback_histogram_us=list(stats.callback_histogram),
+        )
+
+    def stats_stream(self, interval: float = 1.0) -> Stream[DuplexStatsSnapshot]:
+        return Stream.from_poll(self.stats, interval)
+
+    def _allocate_output(self, frames: int):
+        # only grows when the host hands us bigger buffers than asked for, never in steady state
+        self._out = np.zeros((frames, self.channels), dtype=np.float32)
+        self._views = {}
+
+    def start(self):
+        if self._stream is not None:
+            return self
+        if self.chain is not None:
+            self.chain.prepare(self.rate, self.channels, self.frames_per_buffer)
+        self._pa = PortAudioSession.acquire()
+        try:
+            self._stream = self._pa.open(
+                format=audio_backends.paFloat32,
+                channels=self.channels,
+                rate=self.rate,
+                input=True,
+                output=True,
+                input_device_index=self.input_device_index,
+                output_device_index=self.output_device_index,
+                frames_per_buffer=self.frames_per_buffer,
+                stream_callback=self._callback,
+                start=True,
+                input_host_api_specific_stream_info=self._input_host_api_specific_stream_info,
+                output_host_api_specific_stream_info=self._output_host_api_specific_stream_info,
+            )
+        except BaseException:
+            self._pa = None
+            PortAudioSession.release()
+            raise
+        return self
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        started = time.perf_counter_ns()
+        stats = self._stats
+        stats.callbacks += 1
+        stats.frames += frame_count
+        if status:
+            stats.record_status(status)
+        if frame_count > len(self._out):
+            self._allocate_output(frame_count)
+        out = self._out[:frame_count]
+        try:
+            source = np.frombuffer(in_data, dtype=np.float32).reshape(frame_count, self.channels) if in_data else None
+            step = self.frames_per_buffer
+            for start in range(0, frame_count, step):
+                end = min(frame_count, start + step)
+                work = self._work[:, :end - start]
+                if source is None:
+                    work.fill(0)
+                else:
+                    np.copyto(work, source[start:end].T)
+                if self.chain is not None:
+                    self.chain.process(work)
+                np.copyto(out[start:end].T, work)
+        except Exception as e:
+            out.fill(0)
+            stats.errors += 1
+            stats.last_error = e
+        view = self._views.get(frame_count)
+        if view is None:
+            view = self._views[frame_count] = memoryview(out.reshape(-1).view(np.uint8)).toreadonly()
+        stats.record_time(time.perf_counter_ns() - started)
+        return (view, audio_backends.paContinue)
+
+    def close(self):
+        stream, self._stream = self._stream, None
+        if stream is None:
+            return
+        try:
+            if stream.is_active():
+                stream.stop_stream()
+            stream.close()
+        finally:
+            self._pa = None
+            PortAudioSession.release()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
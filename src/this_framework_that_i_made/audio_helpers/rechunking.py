@@ -0,0 +1,164 @@
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, PcmStage
+from this_framework_that_i_made.generics import TftimException
+
+
+class FrameRing:
+
+    """
+    Fixed-capacity FIFO of (frames, channels) samples backed by one preallocated array.
+
+    `read` hands out a view into the ring whenever the requested frames are contiguous and only
+    copies when they wrap around the end. A view stays valid until another `capacity - n` frames
+    have been written, so consume it (or copy it) before then.
+    """
+
+    def __init__(self, capacity: int, channels: int, dtype):
+        if capacity <= 0:
+            raise TftimException(f"ring capacity must be positive, got {capacity}")
+        self.capacity = capacity
+        self.channels = channels
+        self._buf = np.zeros((capacity, channels), dtype=dtype)
+        self._read = 0
+        self._size = 0
+
+    @property
+    def dtype(self):
+        return self._buf.dtype
+
+    @property
+    def available(self) -> int:
+        return self._size
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self._size
+
+    def write(self, frames: np.ndarray) -> None:
+        n = frames.shape[0]
+        if n > self.free:
+            raise TftimException(f"ring overflow, tried to write {n} frames with {self.free} free")
+        start = (self._read + self._size) % self.capacity
+        first = min(n, self.capacity - start)
+        self._buf[start:start + first] = frames[:first]
+        if first < n:
+            self._buf[:n - first] = frames[first:]
+        self._size += n
+
+    def write_silence(self, n: int) -> None:
+        if n > self.free:
+            raise TftimException(f"ring overflow, tried to write {n} frames with {self.free} free")
+        start = (self._read + self._size) % self.capacity
+        first = min(n, self.capacity - start)
+        self._buf[start:start + first] = 0
+        self._buf[:n - first] = 0
+        self._size += n
+
+    def read(self, n: int, out: np.ndarray = None) -> np.ndarray:
+        """ Pops `n` frames, as a view when possible. `out` forces a copy into that buffer instead. """
+        if n > self._size:
+            raise TftimException(f"ring underflow, tried to read {n} frames with {self._size} available")
+        start = self._read
+        end = start + n
+        self._read = end % self.capacity
+        self._size -= n
+        if end <= self.capacity and out is None:
+            return self._buf[start:end]
+        if out is None:
+            out = np.empty((n, self.channels), dtype=self._buf.dtype)
+        first = min(n, self.capacity - start)
+        out[:first] = self._buf[start:start + first]
+        out[first:] = self._buf[:n - first]
+        return out
+
+    def discard(self, n: int) -> None:
+        n = min(n, self._size)
+        self._read = (self._read + n) % self.capacity
+        self._size -= n
+
+    def clear(self) -> None:
+        self._read = 0
+        self._size = 0
+
+
+class PcmRechunker(PcmStage):
+
+    """
+    Turns a stream of arbitrarily sized PcmBlocks into blocks of exactly `frames` frames.
+
+    The ring capacity is a multiple of `frames`, so every emitted block is contiguous in the ring
+    and comes out as a zero-copy view. Views are recycled after `ring_blocks - 1` more blocks have
+    been written, pass `copy=True` if blocks are kept around longer than that. When pts_ns is
+    known, emitted blocks are timestamped from the input block that fed them.
+    """
+
+    def __init__(self, frames: int, ring_blocks: int = 4, pad_last: bool = True, copy: bool = False):
+        if frames <= 0:
+            raise TftimException(f"frames must be positive, got {frames}")
+        self.frames = frames
+        self.ring_blocks = max(2, ring_blocks)
+        self.pad_last = pad_last
+        self.copy = copy
+        self._ring = None
+        self._template = None
+        self._next_pts_ns = None
+
+    def _setup(self, block: PcmBlock):
+        self._template = block
+        self._ring = FrameRing(self.frames * self.ring_blocks, block.channels, block.dtype)
+
+    def _emit(self, n: int) -> PcmBlock:
+        samples = self._ring.read(n)
+        if self.copy:
+            samples = samples.copy()
+        template = self._template
+        if template.channels == 1:
+            samples = samples.reshape(-1)
+        block = PcmBlock.from_array(
+            samples,
+            template.sample_format,
+            template.channels,
+            rate=template.rate,
+            pts_ns=self._next_pts_ns,
+        )
+        if self._next_pts_ns is not None and template.rate:
+            self._next_pts_ns += n * 1_000_000_000 // template.rate
+        return block
+
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        if self._ring is None:
+            self._setup(block)
+        elif block.channels != self._ring.channels or block.sample_format != self._template.sample_format:
+            raise TftimException(
+                f"rechunker expects {self._ring.channels}ch {self._template.sample_format.name}, "
+                f"got {block.channels}ch {block.sample_format.name}"
+            )
+        if block.pts_ns is not None and block.rate:
+            # the next emitted frame is whatever's already buffered, ahead of this block
+            self._next_pts_ns = block.pts_ns - self._ring.available * 1_000_000_000 // block.rate
+
+        samples = block.array.reshape(-1, block.channels)
+        offset = 0
+        while offset < samples.shape[0]:
+            n = min(self._ring.free, samples.shape[0] - offset)
+            self._ring.write(samples[offset:offset + n])
+            offset += n
+            while self._ring.available >= self.frames:
+                yield self._emit(self.frames)
+
+    def flush(self) -> Iterator[PcmBlock]:
+        if self._ring is None or not self._ring.available:
+            return
+        remaining = self._ring.available
+        if self.pad_last:
+            self._ring.write_silence(self.frames - remaining)
+            remaining = self.frames
+        yield self._emit(remaining)
+
+
+def rechunk_pcm_blocks(blocks: Iterable[PcmBlock], frames: int, pad_last: bool = True) -> Iterator[PcmBlock]:
+    """ Convenience wrapper for plain iterators. """
+    yield from PcmRechunker(frames, pad_last=pad_last).apply(blocks)
@@ -0,0 +1,307 @@
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, Hashable, List
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, SampleConverter, SampleFormat
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Spectrum analysis for visualizers and anything else that wants "how loud is each band right now".
+
+- frames are cut with a hop of fft_size * (1 - overlap), windowed and pushed through one rfft
+  call per block (or per group of streams, see SpectrumBank)
+- band aggregation is a precomputed sparse matrix stored CSR style: for every band the bins it
+  covers and their weights, applied with one gather and one np.add.reduceat
+- windows and band matrices only depend on their parameters, so they're built once and shared
+
+"""
+
+
+class BandScale(Enum):
+    LOG = "log"          # `bands` log spaced bands between fmin and fmax
+    MEL = "mel"          # `bands` triangular mel filters
+    OCTAVE = "octave"    # fractional octave bands centered on 1 kHz, `bands` per octave
+
+
+@lru_cache(maxsize=16)
+def get_window(size: int, kind: str = "hann") -> np.ndarray:
+    """ Periodic analysis window as read-only float32. """
+    if kind == "hann":
+        window = np.hanning(size + 1)[:-1]
+    elif kind == "hamming":
+        window = np.hamming(size + 1)[:-1]
+    elif kind == "blackman":
+        window = np.blackman(size + 1)[:-1]
+    elif kind == "rect":
+        window = np.ones(size)
+    else:
+        raise TftimException(f"unknown window {kind!r}")
+    window = window.astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+
+def _hz_to_mel(f):
+    return 2595.0 * np.log10(1.0 + np.asarray(f) / 700.0)
+
+
+def _mel_to_hz(m):
+    return 700.0 * (10 ** (np.asarray(m) / 2595.0) - 1.0)
+
+
+class BandMatrix:
+
+    """
+    Sparse (bins -> bands) weights. Band i uses bins `indices[starts[i]:starts[i + 1]]` with the
+    matching `weights`, the fraction of each bin inside the band (or the mel triangle), so a
+    band is the power it contains and a sine reads the same whatever the band width.
+    """
+
+    def __init__(self, indices: np.ndarray, weights: np.ndarray, starts: np.ndarray, centers: np.ndarray):
+        self.indices = indices
+        self.weights = weights
+        self.starts = starts
+        self.centers = centers  # band center frequencies in Hz
+
+    @property
+    def bands(self) -> int:
+        return len(self.starts)
+
+    def apply(self, power: np.ndarray) -> np.ndarray:
+        """ (..., bins) power -> (..., bands). """
+        gathered = power[..., self.indices]
+        gathered *= self.weights
+        return np.add.reduceat(gathered, self.starts, axis=-1)
+
+
+def _overlap_weights(freqs, df, lo, hi):
+    # the fraction of each bin's [f - df/2, f + df/2) that falls inside [lo, hi)
+    return np.clip(np.minimum(freqs + df / 2, hi) - np.maximum(freqs - df / 2, lo), 0, None) / df
+
+
+@lru_cache(maxsize=32)
+def get_band_matrix(
+    fft_size: int,
+    rate: int,
+    bands: int,
+    scale: BandScale = BandScale.LOG,
+    fmin: float = 20.0,
+    fmax: float = None,
+) -> BandMatrix:
+    fmax = min(fmax or rate / 2, rate / 2)
+    if not 0 < fmin < fmax:
+        raise TftimException(f"bad band range {fmin} - {fmax} Hz")
+    df = rate / fft_size
+    freqs = np.arange(fft_size // 2 + 1) * df
+
+    if scale == BandScale.LOG:
+        edges = np.geomspace(fmin, fmax, bands + 1)
+        ranges = list(zip(edges[:-1], edges[1:]))
+        centers = np.sqrt(edges[:-1] * edges[1:])
+    elif scale == BandScale.OCTAVE:
+        first = np.ceil(bands * np.log2(fmin / 1000.0))
+        last = np.floor(bands * np.log2(fmax / 1000.0))
+        centers = 1000.0 * 2 ** (np.arange(first, last + 1) / bands)
+        half = 2 ** (1 / (2 * bands))
+        ranges = [(c / half, min(c * half, rate / 2)) for c in centers]
+    elif scale == BandScale.MEL:
+        points = _mel_to_hz(np.linspace(_hz_to_mel(fmin), _hz_to_mel(fmax), bands + 2))
+        ranges = list(zip(points[:-2], points[2:]))
+        centers = points[1:-1]
+    else:
+        raise TftimException(f"unknown band scale {scale}")
+
+    indices, weights, starts = [], [], []
+    for (lo, hi), center in zip(ranges, centers):
+        if scale == BandScale.MEL:
+            w = np.clip(np.minimum((freqs - lo) / (center - lo), (hi - freqs) / (hi - center)), 0, None)
+            if not w.any():
+                w = _overlap_weights(freqs, df, lo, hi)
+        else:
+            w = _overlap_weights(freqs, df, lo, hi)
+        if not w.any():
+            # narrower than a bin and in between bin centers, borrow the nearest bin
+            w = np.zeros_like(freqs)
+            w[np.argmin(np.abs(freqs - center))] = 1.0
+        nonzero = np.flatnonzero(w)
+        starts.append(sum(len(i) for i in indices))
+        indices.append(nonzero)
+        weights.append(w[nonzero])
+
+    return BandMatrix(
+        np.concatenate(indices),
+        np.concatenate(weights).astype(np.float32),
+        np.array(starts),
+        np.asarray(centers, dtype=np.float32),
+    )
+
+
+def _analyze(frames: np.ndarray, window: np.ndarray, scale: float, matrix: BandMatrix) -> np.ndarray:
+    """ The batched kernel, (..., fft_size) frames -> (..., bands) power. """
+    spectrum = np.fft.rfft(frames * window, axis=-1)
+    power = np.square(spectrum.real)
+    power += np.square(spectrum.imag)
+    power *= scale
+    return matrix.apply(power.astype(np.float32, copy=False))
+
+
+class SpectrumAnalyzer:
+
+    """
+    Turns PcmBlocks into band levels, one row of `bands` float32 values per analysis frame.
+
+    Frames overlap by `overlap` (0 for back to back, 0.5 or 0.75 for smoother updates). Levels
+    are in dB relative to a full scale sine, or linear power with `db=False`. `smoothing` is the
+    time constant in seconds of an exponential average over frames, 0 disables it. Channels are
+    mixed down to one spectrum unless `per_channel`, in which case rows are (channels, bands).
+    """
+
+    def __init__(
+        self,
+        rate: int,
+        channels: int = 1,
+        fft_size: int = 2048,
+        bands: int = 32,
+        scale: BandScale = BandScale.LOG,
+        fmin: float = 20.0,
+        fmax: float = None,
+        overlap: float = 0.5,
+        smoothing: float = 0.0,
+        window: str = "hann",
+        per_channel: bool = False,
+        db: bool = True,
+        floor_db: float = -120.0,
+    ):
+        if not 0 <= overlap < 1:
+            raise TftimException(f"overlap must be in [0, 1), got {overlap}")
+        self.rate = rate
+        self.channels = channels
+        self.fft_size = fft_size
+        self.hop = max(1, int(round(fft_size * (1 - overlap))))
+        self.per_channel = per_channel
+        self.db = db
+        self.floor_db = floor_db
+        self.window = get_window(fft_size, window)
+        self.matrix = get_band_matrix(fft_size, rate, bands, scale, fmin, fmax)
+        # Parseval, a full scale sine sums up to power 1 over the bins it leaks into
+        self._scale = 4.0 / (fft_size * float(np.square(self.window, dtype=np.float64).sum()))
+        self._decay = float(np.exp(-self.hop / (rate * smoothing))) if smoothing > 0 else 0.0
+        self._smoothed = None
+        self._converter = None
+        width = channels if per_channel else 1
+        self._pending = np.zeros((0, width), dtype=np.float32)
+        self._mixdown = np.full((channels, 1), 1 / channels, dtype=np.float32)
+        self.latest = None
+
+    @property
+    def bands(self) -> int:
+        return self.matrix.bands
+
+    @property
+    def centers(self) -> np.ndarray:
+        return self.matrix.centers
+
+    def _frames(self, block: PcmBlock) -> np.ndarray:
+        """ Buffers the block and returns every complete frame as (frames, width, fft_size). """
+        if block.channels != self.channels:
+            raise TftimException(f"analyzer expects {self.channels} channels, got {block.channels}")
+        samples = block.array.reshape(-1, self.channels)
+        if block.sample_format != SampleFormat.FLOAT_32:
+            if self._converter is None or self._converter.src_format != block.sample_format:
+                self._converter = SampleConverter(block.sample_format, SampleFormat.FLOAT_32)
+            samples = self._converter.convert(samples)
+        if not self.per_channel and self.channels > 1:
+            samples = samples @ self._mixdown
+        buf = np.concatenate([self._pending, samples])
+        count = max(0, (buf.shape[0] - self.fft_size) // self.hop + 1)
+        frame_stride, channel_stride = buf.strides
+        frames = np.lib.stride_tricks.as_strided(
+            buf,
+            shape=(count, buf.shape[1], self.fft_size),
+            strides=(frame_stride * self.hop, channel_stride, frame_stride),
+            writeable=False,
+        )
+        self._pending = buf[count * self.hop:]
+        return frames
+
+    def _finish(self, power: np.ndarray) -> np.ndarray:
+        """ Smoothing and dB for (frames, width, bands) power. """
+        if not len(power):
+            return power if self.per_channel else power[:, 0]
+        if self._decay:
+            if self._smoothed is None:
+                self._smoothed = power[0].copy()
+            for frame in power:
+                self._smoothed *= self._decay
+                self._smoothed += (1 - self._decay) * frame
+                frame[:] = self._smoothed
+        if self.db:
+            with np.errstate(divide="ignore"):
+                power = 10 * np.log10(power)
+            np.maximum(power, self.floor_db, out=power)
+        if not self.per_channel:
+            power = power[:, 0]
+        self.latest = power[-1]
+        return power
+
+    def feed(self, block: PcmBlock) -> np.ndarray:
+        """ Returns the levels of every frame completed by this block, possibly none. """
+        frames = self._frames(block)
+        if not len(frames):
+            return self._finish(np.zeros(frames.shape[:2] + (self.bands,), dtype=np.float32))
+        return self._finish(_analyze(frames, self.window, self._scale, self.matrix))
+
+
+class SpectrumBank:
+
+    """
+    Runs many analyzers together. Frames from every analyzer sharing fft size, window and band
+    layout are stacked into a single rfft call and a single band aggregation.
+    """
+
+    def __init__(self):
+        self._analyzers: Dict[Hashable, SpectrumAnalyzer] = {}
+
+    def add(self, key: Hashable, rate: int, channels: int = 1, **options) -> SpectrumAnalyzer:
+        if key in self._analyzers:
+            raise TftimException(f"analyzer {key!r} already exists")
+        analyzer = self._analyzers[key] = SpectrumAnalyzer(rate, channels, **options)
+        return analyzer
+
+    def remove(self, key: Hashable):
+        self._analyzers.pop(key)
+
+    def __getitem__(self, key: Hashable) -> SpectrumAnalyzer:
+        return self._analyzers[key]
+
+    @property
+    def keys(self) -> List[Hashable]:
+        return list(self._analyzers)
+
+    def feed(self, blocks: Dict[Hashable, PcmBlock]) -> Dict[Hashable, np.ndarray]:
+        groups: Dict[tuple, list] = {}
+        results = {}
+        for key, block in blocks.items():
+            analyzer = self._analyzers[key]
+            frames = analyzer._frames(block)
+            if not len(frames):
+                results[key] = analyzer._finish(np.zeros(frames.shape[:2] + (analyzer.bands,), dtype=np.float32))
+                continue
+            group = (id(analyzer.window), id(analyzer.matrix), analyzer._scale)
+            groups.setdefault(group, []).append((key, analyzer, frames))
+
+        for members in groups.values():
+            analyzer = members[0][1]
+            stacked = np.concatenate([frames.reshape(-1, analyzer.fft_size) for _, _, frames in members])
+            power = _analyze(stacked, analyzer.window, analyzer._scale, analyzer.matrix)
+            offset = 0
+            for key, analyzer, frames in members:
+                count = frames.shape[0] * frames.shape[1]
+                shape = frames.shape[:2] + (analyzer.bands,)
+                results[key] = analyzer._finish(power[offset:offset + count].reshape(shape))
+                offset += count
+        return results
@@ -0,0 +1,540 @@
+import copy
+import itertools
+import os
+import threading
+import time
+import wave
+import weakref
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers import audio_backends
+from this_framework_that_i_made.audio_helpers.audio_standards import (
+    PYAUDIO_SAMPLE_FORMAT,
+    SAMPLE_WIDTH,
+    PcmBlock,
+    SampleConverter,
+    SampleFormat,
+)
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+An in-process stand-in for PortAudio, so capture, playback and everything downstream of them
+can be load-tested and profiled on machines without sound hardware (CI, containers).
+
+A SyntheticBackend holds VirtualDevices and hands out SyntheticPyAudio instances that answer the
+same calls PyAudio does (host apis, device info dicts, is_format_supported, open). Streams run
+the callback on their own thread like PortAudio does, with:
+- input generated from the device's source: a sine, noise, silence, a wav file or array played
+  in a loop, or any callable
+- output handed to the device's sink (or just counted)
+- time_info on a virtual stream clock, and paInputOverflow flagged when a real-time stream's
+  callback misses its deadline by more than a buffer, the way a real driver would drop audio
+  (`glitch` flags one on demand, for testing what reacts to it)
+
+Real-time streams pace callbacks on the wall clock, fast ones call back as soon as the previous
+callback returns, which makes throughput benchmarks independent of the sample rate.
+
+Devices can be plugged in, pulled, reconfigured and made default at runtime (add_device,
+remove_device, update_device, set_default), which goes out to `watch_devices` listeners the way the OS notifications do on a
+real system. Like PortAudio, a SyntheticPyAudio instance keeps the devices and defaults there
+were when it was created, a new instance (re-initializing PortAudio) sees the changes.
+
+"""
+
+Source = Union[str, np.ndarray, Callable[[int, int, int, int], np.ndarray]]
+Sink = Callable[[bytes, int], None]
+
+_PA_FORMATS = {pa_format: sample_format for sample_format, pa_format in PYAUDIO_SAMPLE_FORMAT.items()}
+
+
+@dataclass(slots=True)
+class VirtualDevice:
+
+    """
+    One synthetic endpoint. `source` is "sine", "noise", "silence", a .wav path, a (frames,
+    channels) float array, or fn(frames, channels, rate, position) -> (frames, channels) floats.
+    `sink(data, frames)` gets every buffer played to an output device.
+    """
+
+    name: str
+    input_channels: int = 2
+    output_channels: int = 0
+    rate: int = 48_000
+    source: Source = "sine"
+    frequency: float = 440.0
+    level_db: float = -12.0
+    sink: Optional[Sink] = None
+    host_api: str = "Synthetic"
+    supported_rates: Optional[Sequence[int]] = None  # None takes any rate
+    low_latency_s: float = 0.01
+    high_latency_s: float = 0.1
+    is_loopback: bool = False
+    # buffer sizes the "host" calls back with, in a loop, instead of the stream's frames_per_buffer
+    # (WASAPI and CoreAudio don't always stick to what was asked for)
+    callback_frames: Optional[Sequence[int]] = None
+
+
+class _SignalSource:
+
+    """ Float samples for one input stream, continuous across buffers. """
+
+    def __init__(self, device: VirtualDevice, channels: int, rate: int):
+        self.channels = channels
+        self.rate = rate
+        self.position = 0
+        self.amplitude = 10 ** (device.level_db / 20)
+        self.frequency = device.frequency
+        self._rng = np.random.default_rng(0)
+        self.kind = None
+        self._loop = None
+        self._fn = None
+        source = device.source
+        if callable(source):
+            self._fn = source
+        elif isinstance(source, np.ndarray):
+            self._loop = self._fit(np.asarray(source, dtype=np.float32).reshape(len(source), -1))
+        elif source in ("sine", "noise", "silence"):
+            self.kind = source
+        elif isinstance(source, (str, os.PathLike)) and os.fspath(source).lower().endswith(".wav"):
+            self._loop = self._fit(_read_wav(os.fspath(source)))
+        else:
+            raise TftimException(f"unknown synthetic source {source!r} for {device.name}")
+
+    def _fit(self, samples: np.ndarray) -> np.ndarray:
+        if not len(samples):
+            raise TftimException("synthetic source is empty")
+        # repeat or drop channels to match the stream
+        return samples[:, np.arange(self.channels) % samples.shape[1]]
+
+    def read(self, frames: int) -> np.ndarray:
+        start = self.position
+        self.position += frames
+        if self._fn is not None:
+            return np.asarray(self._fn(frames, self.channels, self.rate, start), dtype=np.float32).reshape(frames, self.channels)
+        if self._loop is not None:
+            index = np.arange(start, start + frames) % len(self._loop)
+            return self._loop[index]
+        if self.kind == "silence":
+            return np.zeros((frames, self.channels), dtype=np.float32)
+        if self.kind == "noise":
+            return (self._rng.standard_normal((frames, self.channels)) * (self.amplitude / 3)).astype(np.float32)
+        # phase from the absolute position in float64, so long runs don't drift
+        phase = np.arange(start, start + frames, dtype=np.float64) * (2 * np.pi * self.frequency / self.rate)
+        tone = (np.sin(phase) * self.amplitude).astype(np.float32)
+        return np.repeat(tone[:, None], self.channels, axis=1)
+
+
+def _read_wav(path: str) -> np.ndarray:
+    with wave.open(path, "rb") as f:
+        width, channels = f.getsampwidth(), f.getnchannels()
+        data = f.readframes(f.getnframes())
+    sample_format = {1: SampleFormat.UINT_8, 2: SampleFormat.INT_16, 3: SampleFormat.INT_24, 4: SampleFormat.INT_32}.get(width)
+    if sample_format is None:
+        raise TftimException(f"{path}: unsupported sample width {width}")
+    samples = PcmBlock(data, sample_format=sample_format, channels=channels).array.reshape(-1, channels)
+    return SampleConverter(sample_format, SampleFormat.FLOAT_32).convert(samples)
+
+
+class SyntheticStream:
+
+    """ What SyntheticPyAudio.open returns, the parts of pyaudio.Stream the audio stack uses. """
+
+    def __init__(
+        self,
+        backend: "SyntheticBackend",
+        format: int,
+        channels: int,
+        rate: int,
+        input: bool = False,
+        output: bool = False,
+        input_device_index: int = None,
+        output_device_index: int = None,
+        frames_per_buffer: int = audio_backends.paFramesPerBufferUnspecified,
+        start: bool = True,
+        stream_callback: Callable = None,
+        **ignored,
+    ):
+        if not input and not output:
+            raise ValueError("Must specify an input or output stream.")
+        sample_format = _PA_FORMATS.get(format)
+        if sample_format is None:
+            raise ValueError("Invalid sample format")
+        self._backend = backend
+        self.sample_format = sample_format
+        self.channels = channels
+        self.rate = int(rate)
+        self.frames_per_buffer = frames_per_buffer or 256
+        self.input_device = backend.device(input_device_index, is_input=True) if input else None
+        self.output_device = backend.device(output_device_index, is_input=False) if output else None
+        for device, available in ((self.input_device, "input_channels"), (self.output_device, "output_channels")):
+            if device is not None and channels > getattr(device, available):
+                raise ValueError("Invalid number of channels")
+        self._callback = stream_callback
+        self._source = _SignalSource(self.input_device, channels, self.rate) if input else None
+        self._to_format = SampleConverter(SampleFormat.FLOAT_32, sample_format)
+        self.frames_played = 0
+        self._frames = 0
+        self._busy_ns = 0
+        self._started_ns = 0
+        self._injected_status = 0
+        self._active = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        backend._streams.add(self)
+        if start:
+            self.start_stream()
+
+    def _stream_time(self) -> float:
+        if self._backend.realtime:
+            return (time.perf_counter_ns() - self._started_ns) / 1e9
+        return self._frames / self.rate
+
+    def _input_bytes(self, frames: int) -> bytes:
+        samples = self._source.read(frames)
+        encoded = self._to_format.convert(samples)
+        return PcmBlock.from_array(encoded, self.sample_format, self.channels).bytes
+
+    def _play(self, data, frames: int):
+        if data is None:
+            return
+        self.frames_played += frames
+        sink = self.output_device.sink
+        if sink is not None:
+            sink(bytes(data), frames)
+
+    def _run(self):
+        device = self.input_device or self.output_device
+        sizes = itertools.cycle(device.callback_frames or (self.frames_per_buffer,))
+        deadline = time.perf_counter_ns()
+        status = 0
+        try:
+            while not self._stop.is_set():
+                frames = next(sizes)
+                period_ns = frames * 1_000_000_000 // self.rate
+                in_data = self._input_bytes(frames) if self._source is not None else None
+                now = self._stream_time()
+                time_info = {
+                    "input_buffer_adc_time": self._frames / self.rate,
+                    "current_time": now,
+                    "output_buffer_dac_time": now + frames / self.rate,
+                }
+                status, self._injected_status = status | self._injected_status, 0
+                began = time.perf_counter_ns()
+                data, flag = self._callback(in_data, frames, time_info, status)
+                self._busy_ns += time.perf_counter_ns() - began
+                if self.output_device is not None:
+                    self._play(data, frames)
+                self._frames += frames
+                status = 0
+                if flag != audio_backends.paContinue:
+                    break
+                if self._backend.realtime:
+                    deadline += period_ns
+                    late = time.perf_counter_ns() - deadline
+                    if late > period_ns:
+                        # a real device would have overwritten the buffer we missed
+                        status = audio_backends.paInputOverflow if self._source is not None else audio_backends.paOutputUnderflow
+                        deadline = time.perf_counter_ns()
+                    elif late < 0:
+                        self._stop.wait(-late / 1e9)
+        finally:
+            self._active = False
+
+    def start_stream(self):
+        with self._lock:
+            if self._active:
+                return
+            if self._callback is None:
+                self._active = True
+                self._started_ns = time.perf_counter_ns()
+                return
+            self._stop.clear()
+            self._active = True
+            self._started_ns = time.perf_counter_ns()
+            self._thread = threading.Thread(target=self._run, name="SyntheticAudio", daemon=True)
+            self._thread.start()
+
+    def stop_stream(self):
+        with self._lock:
+            self._stop.set()
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._active = False
+
+    def close(self):
+        self.stop_stream()
+        self._backend._streams.discard(self)
+
+    def is_active(self) -> bool:
+        return self._active
+
+    def is_stopped(self) -> bool:
+        return not self._active
+
+    def get_cpu_load(self) -> float:
+        elapsed = time.perf_counter_ns() - self._started_ns
+        return self._busy_ns / elapsed if self._started_ns and elapsed else 0.0
+
+    def get_time(self) -> float:
+        return self._stream_time()
+
+    def get_input_latency(self) -> float:
+        return self.input_device.low_latency_s if self.input_device else 0.0
+
+    def get_output_latency(self) -> float:
+        return self.output_device.low_latency_s if self.output_device else 0.0
+
+    # blocking mode, for code that reads/writes instead of using a callback
+    def read(self, num_frames: int, exception_on_overflow: bool = True) -> bytes:
+        if self._source is None:
+            raise IOError("Not input stream")
+        self._pace(num_frames)
+        return self._input_bytes(num_frames)
+
+    def write(self, frames, num_frames: int = None, exception_on_underflow: bool = False):
+        if self.output_device is None:
+            raise IOError("Not output stream")
+        frame_bytes = self.channels * SAMPLE_WIDTH[self.sample_format]
+        num_frames = num_frames if num_frames is not None else len(frames) // frame_bytes
+        self._pace(num_frames)
+        self._play(frames, num_frames)
+
+    def _pace(self, frames: int):
+        self._frames += frames
+        if self._backend.realtime:
+            ahead = self._frames / self.rate - (time.perf_counter_ns() - self._started_ns) / 1e9
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class SyntheticPyAudio:
+
+    """ The PyAudio instance side: enumeration, format checks and open. """
+
+    def __init__(self, backend: "SyntheticBackend"):
+        # the device list as of now, streams still register with the real backend (glitch)
+        self._backend = copy.copy(backend)
+        self._backend.devices = list(backend.devices)
+        self._backend.host_apis = list(backend.host_apis)
+        self._backend._defaults = dict(backend._defaults)
+        self._streams = weakref.WeakSet()
+
+    def get_host_api_count(self) -> int:
+        return len(self._backend.host_apis)
+
+    def get_default_host_api_info(self) -> dict:
+        return self.get_host_api_info_by_index(0)
+
+    def get_host_api_info_by_index(self, index: int) -> dict:
+        name = self._backend.host_apis[index]
+        members = self._backend.host_api_devices(index)
+        return {
+            "index": index,
+            "structVersion": 1,
+            "type": 0,
+            "name": name,
+            "deviceCount": len(members),
+            "defaultInputDevice": self._backend.default_index(name, True),
+            "defaultOutputDevice": self._backend.default_index(name, False),
+        }
+
+    def get_device_count(self) -> int:
+        return len(self._backend.devices)
+
+    def get_device_info_by_index(self, index: int) -> dict:
+        if not 0 <= index < len(self._backend.devices):
+            raise IOError("Invalid device index")
+        device = self._backend.devices[index]
+        return {
+            "index": index,
+            "structVersion": 2,
+            "name": device.name,
+            "hostApi": self._backend.host_apis.index(device.host_api),
+            "maxInputChannels": device.input_channels,
+            "maxOutputChannels": device.output_channels,
+            "defaultLowInputLatency": device.low_latency_s,
+            "defaultLowOutputLatency": device.low_latency_s,
+            "defaultHighInputLatency": device.high_latency_s,
+            "defaultHighOutputLatency": device.high_latency_s,
+            "defaultSampleRate": float(device.rate),
+            "isLoopbackDevice": device.is_loopback,
+        }
+
+    def get_device_info_by_host_api_device_index(self, host_api_index: int, host_api_device_index: int) -> dict:
+        return self.get_device_info_by_index(self._backend.host_api_devices(host_api_index)[host_api_device_index])
+
+    def get_default_input_device_info(self) -> dict:
+        index = self.get_host_api_info_by_index(0)["defaultInputDevice"]
+        if index < 0:
+            raise IOError("No Default Input Device Available")
+        return self.get_device_info_by_index(index)
+
+    def get_default_output_device_info(self) -> dict:
+        index = self.get_host_api_info_by_index(0)["defaultOutputDevice"]
+        if index < 0:
+            raise IOError("No Default Output Device Available")
+        return self.get_device_info_by_index(index)
+
+    def get_sample_size(self, format: int) -> int:
+        if format not in _PA_FORMATS:
+            raise ValueError("Invalid sample format")
+        return SAMPLE_WIDTH[_PA_FORMATS[format]]
+
+    def is_format_supported(
+        self,
+        rate: float,
+        input_device: int = None,
+        input_channels: int = None,
+        input_format: int = None,
+        output_device: int = None,
+        output_channels: int = None,
+        output_format: int = None,
+    ) -> bool:
+        for index, channels, format, is_input in (
+            (input_device, input_channels, input_format, True),
+            (output_device, output_channels, output_format, False),
+        ):
+            if index is None:
+                continue
+            device = self._backend.device(index, is_input)
+            if format not in _PA_FORMATS:
+                raise ValueError("Invalid sample format")
+            if (channels or 0) > (device.input_channels if is_input else device.output_channels):
+                raise ValueError("Invalid number of channels")
+            if device.supported_rates is not None and int(rate) not in device.supported_rates:
+                raise ValueError("Invalid sample rate")
+        return True
+
+    def open(self, *args, **kwargs) -> SyntheticStream:
+        stream = SyntheticStream(self._backend, *args, **kwargs)
+        self._streams.add(stream)
+        return stream
+
+    def terminate(self):
+        # only what this instance opened, other instances on the backend keep theirs
+        for stream in list(self._streams):
+            stream.close()
+        self._streams.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.terminate()
+
+
+class SyntheticBackend:
+
+    """
+    A set of virtual devices, usable anywhere the pyaudio module is (audio_backends.set_backend).
+    Device indexes are positions in `devices`, host apis are the distinct `host_api` names (a host
+    api stays once it's been seen, like a real one does when its last device goes).
+    """
+
+    def __init__(self, devices: Sequence[VirtualDevice], realtime: bool = True):
+        if not devices:
+            raise TftimException("a synthetic backend needs at least one device")
+        self.devices: List[VirtualDevice] = list(devices)
+        self.realtime = realtime
+        self.host_apis: List[str] = list(dict.fromkeys(device.host_api for device in self.devices))
+        self._defaults: Dict[Tuple[str, bool], VirtualDevice] = {}
+        self._watchers: List[Callable[[], None]] = []
+        self._streams = set()
+
+    @classmethod
+    def default(cls, realtime: bool = True) -> "SyntheticBackend":
+        return cls(
+            [
+                VirtualDevice("Synthetic Sine", input_channels=2, source="sine"),
+                VirtualDevice("Synthetic Noise", input_channels=1, source="noise"),
+                VirtualDevice("Synthetic Speakers", input_channels=0, output_channels=2),
+            ],
+            realtime=realtime,
+        )
+
+    def host_api_devices(self, host_api_index: int) -> List[int]:
+        name = self.host_apis[host_api_index]
+        return [i for i, device in enumerate(self.devices) if device.host_api == name]
+
+    def default_index(self, host_api: str, is_input: bool) -> int:
+        """ The host api's default input / output, -1 if it has none. """
+        chosen = self._defaults.get((host_api, is_input))
+        # by identity, devices compare by value and a source can be an array
+        for i, device in enumerate(self.devices):
+            if device is chosen:
+                return i
+        channels = "input_channels" if is_input else "output_channels"
+        return next((i for i, device in enumerate(self.devices) if device.host_api == host_api and getattr(device, channels)), -1)
+
+    def device(self, index: Optional[int], is_input: bool) -> VirtualDevice:
+        if index is None:
+            index = self.default_index(self.host_apis[0], is_input)
+            if index < 0:
+                raise IOError(f"No Default {'Input' if is_input else 'Output'} Device Available")
+        if not 0 <= index < len(self.devices):
+            raise IOError("Invalid device index")
+        return self.devices[index]
+
+    def PyAudio(self) -> SyntheticPyAudio:
+        return SyntheticPyAudio(self)
+
+    def watch_devices(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """ The audio_backends notification hook, returns the unsubscribe. """
+        self._watchers.append(callback)
+        return lambda: self._watchers.remove(callback)
+
+    def _notify(self):
+        for callback in list(self._watchers):
+            callback()
+
+    def add_device(self, device: VirtualDevice):
+        """ Plugs a device in, at the end of the list like a hotplugged one gets. """
+        self.devices.append(device)
+        if device.host_api not in self.host_apis:
+            self.host_apis.append(device.host_api)
+        self._notify()
+
+    def remove_device(self, name: str) -> VirtualDevice:
+        """ Pulls the (first) device called `name`, everything after it moves down an index. """
+        device = next((device for device in self.devices if device.name == name), None)
+        if device is None:
+            raise TftimException(f"no synthetic device called {name!r}")
+        self.devices = [other for other in self.devices if other is not device]
+        self._notify()
+        return device
+
+    def update_device(self, name: str, **settings) -> VirtualDevice:
+        """ Changes the (first) device called `name`, e.g. its rate, like doing it in the OS sound settings. """
+        device = next((device for device in self.devices if device.name == name), None)
+        if device is None:
+            raise TftimException(f"no synthetic device called {name!r}")
+        for field_name, value in settings.items():
+            setattr(device, field_name, value)
+        self._notify()
+        return device
+
+    def glitch(self, name: str = None, status: int = None):
+        """
+        Flags the next callback of every open stream on `name` (every stream when None) with
+        `status`, by default paInputOverflow for input streams and paOutputUnderflow for output.
+        """
+        for stream in list(self._streams):
+            if name is None or any(device is not None and device.name == name for device in (stream.input_device, stream.output_device)):
+                default = audio_backends.paInputOverflow if stream.input_device is not None else audio_backends.paOutputUnderflow
+                stream._injected_status |= default if status is None else status
+
+    def set_default(self, name: str, is_input: bool):
+        """ Makes `name` its host api's default input / output. """
+        channels = "input_channels" if is_input else "output_channels"
+        device = next((device for device in self.devices if device.name == name and getattr(device, channels)), None)
+        if device is None:
+            raise TftimException(f"no synthetic {'input' if is_input else 'output'} called {name!r}")
+        self._defaults[(device.host_api, is_input)] = device
+        self._notify()
@@ -0,0 +1,189 @@
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import (
+    PcmBlock,
+    PcmSilence,
+    PcmStage,
+    SampleConverter,
+    SampleFormat,
+)
+from this_framework_that_i_made.audio_helpers.rechunking import FrameRing
+
+
+"""
+
+Gating silence out of PCM streams so everything downstream only works when there's something
+to hear. Silent spans come out as PcmSilence markers (frame count + pts, no samples).
+
+- blocks are cut into short analysis frames, and energy and zero crossing rate for all of them
+  come from two np.add.reduceat calls
+- hangover keeps the gate open for a while after the last active frame, so word endings and
+  reverb tails aren't chopped
+- pre-roll holds back the last few ms while the gate is closed and releases them as audio when
+  it opens, so onsets aren't clipped either. Silence markers are delayed by that much, audio isn't
+
+"""
+
+
+_LONG_AGO = 1 << 30
+
+
+class VoiceActivityGate(PcmStage):
+
+    """
+    Energy gate with optional zero-crossing check. A frame is active when its level is above
+    `threshold_db` (dBFS, mean over channels) and, if `max_zero_crossing_rate` is set, it doesn't
+    cross zero more often than that fraction of samples, which rejects hiss and fan noise that
+    sneaks over the threshold. Leave the zcr check off for music/loopback.
+    """
+
+    def __init__(
+        self,
+        threshold_db: float = -50.0,
+        max_zero_crossing_rate: float = None,
+        frame_ms: float = 10.0,
+        hangover_ms: float = 300.0,
+        pre_roll_ms: float = 100.0,
+    ):
+        self.threshold = 10 ** (threshold_db / 10)
+        self.max_zero_crossing_rate = max_zero_crossing_rate
+        self.frame_ms = frame_ms
+        self.hangover_ms = hangover_ms
+        self.pre_roll_ms = pre_roll_ms
+
+        self.frames_in = 0
+        self.frames_active = 0
+        self._template = None
+        self._converter = None
+        self._frame_len = None
+        self._hangover_frames = None
+        self._since_active = _LONG_AGO  # analysis frames since the last active one
+        self._pre_roll = None           # closed audio held back in case the gate opens
+        self._pre_roll_end_ns = None    # pts right after the last held back frame
+
+    @property
+    def active_ratio(self) -> float:
+        return self.frames_active / self.frames_in if self.frames_in else 0.0
+
+    def _setup(self, block: PcmBlock):
+        rate = block.rate or 48_000
+        self._template = block
+        self._frame_len = max(1, int(rate * self.frame_ms / 1000))
+        self._hangover_frames = int(self.hangover_ms / self.frame_ms)
+        capacity = max(1, int(rate * self.pre_roll_ms / 1000))
+        self._pre_roll = FrameRing(capacity, block.channels, block.dtype)
+        self._converter = SampleConverter(block.sample_format, SampleFormat.FLOAT_32)
+
+    def _open_mask(self, samples: np.ndarray) -> np.ndarray:
+        """ Per sample gate state for (frames, channels) samples. """
+        n = samples.shape[0]
+        floats = samples if samples.dtype == np.float32 else self._converter.convert(samples)
+        starts = np.arange(0, n, self._frame_len)
+        lengths = np.diff(np.append(starts, n))
+        energy = np.add.reduceat(np.einsum("nc,nc->n", floats, floats), starts) / (lengths * samples.shape[1])
+        active = energy > self.threshold
+        if self.max_zero_crossing_rate is not None and n > 1:
+            signs = np.signbit(floats[:, 0])
+            crossings = np.empty(n, dtype=np.int32)
+            crossings[0] = 0
+            np.not_equal(signs[1:], signs[:-1], out=crossings[1:])
+            active &= np.add.reduceat(crossings, starts) <= self.max_zero_crossing_rate * lengths
+
+        index = np.arange(len(starts))
+        last = np.maximum.accumulate(np.where(active, index, -1 - self._since_active))
+        self._since_active = index[-1] - last[-1]
+        return np.repeat(index - last <= self._hangover_frames, lengths)
+
+    def _pts(self, block: PcmBlock, offset: int):
+        if block.pts_ns is None or not block.rate:
+            return None
+        return block.pts_ns + offset * 1_000_000_000 // block.rate
+
+    def _silence(self, frames: int, pts_ns) -> PcmSilence:
+        template = self._template
+        return PcmSilence(frames, template.sample_format, template.channels, rate=template.rate, pts_ns=pts_ns)
+
+    def _audio(self, samples: np.ndarray, pts_ns) -> PcmBlock:
+        template = self._template
+        if template.channels == 1:
+            samples = samples.reshape(-1)
+        return PcmBlock.from_array(samples, template.sample_format, template.channels, rate=template.rate, pts_ns=pts_ns)
+
+    def _hold(self, samples: np.ndarray, pts_ns) -> List[PcmBlock]:
+        """ Pushes closed audio into the pre-roll, whatever falls out the back becomes silence. """
+        ring = self._pre_roll
+        n = samples.shape[0]
+        excess = max(0, ring.available + n - ring.capacity)
+        out = []
+        if excess:
+            rate = self._template.rate
+            start_ns = None
+            if pts_ns is not None and rate:
+                start_ns = pts_ns - ring.available * 1_000_000_000 // rate
+            out.append(self._silence(excess, start_ns))
+            dropped = min(excess, ring.available)
+            ring.discard(dropped)
+            samples = samples[excess - dropped:]
+        ring.write(samples)
+        if pts_ns is not None and self._template.rate:
+            self._pre_roll_end_ns = pts_ns + n * 1_000_000_000 // self._template.rate
+        return out
+
+    def _release(self, samples: np.ndarray, pts_ns) -> PcmBlock:
+        """ Audio for an open run, with any held back pre-roll in front of it. """
+        ring = self._pre_roll
+        if ring.available:
+            rate = self._template.rate
+            if pts_ns is not None and rate:
+                pts_ns -= ring.available * 1_000_000_000 // rate
+            held = ring.read(ring.available, out=np.empty((ring.available, ring.channels), dtype=ring.dtype))
+            samples = np.concatenate([held, samples])
+        return self._audio(samples, pts_ns)
+
+    def process(self, block: PcmBlock) -> Iterator[PcmBlock]:
+        if self._template is None:
+            self._setup(block)
+        n = block.frames
+        if not n:
+            return
+        self.frames_in += n
+        if isinstance(block, PcmSilence):
+            yield from self._hold_silence(block)
+            return
+
+        samples = block.array.reshape(-1, block.channels)
+        mask = self._open_mask(samples)
+        edges = np.flatnonzero(mask[1:] != mask[:-1]) + 1
+        bounds = [0, *edges.tolist(), n]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            pts_ns = self._pts(block, start)
+            if mask[start]:
+                self.frames_active += end - start
+                yield self._release(samples[start:end], pts_ns)
+            else:
+                yield from self._hold(samples[start:end], pts_ns)
+
+    def _hold_silence(self, block: PcmSilence) -> Iterator[PcmBlock]:
+        # already silent upstream, pass it on behind whatever pre-roll is still held back
+        ring = self._pre_roll
+        if ring.available:
+            yield self._silence(ring.available, self._pts(block, -ring.available))
+            ring.clear()
+        self._since_active = _LONG_AGO
+        yield block
+
+    def flush(self) -> Iterator[PcmBlock]:
+        ring = self._pre_roll
+        if ring is not None and ring.available:
+            start_ns = None
+            if self._pre_roll_end_ns is not None and self._template.rate:
+                start_ns = self._pre_roll_end_ns - ring.available * 1_000_000_000 // self._template.rate
+            yield self._silence(ring.available, start_ns)
+            ring.clear()
+
+
+def gate_pcm_blocks(blocks: Iterable[PcmBlock], threshold_db: float = -50.0, **options) -> Iterator[PcmBlock]:
+    """ Convenience wrapper for plain iterators. """
+    yield from VoiceActivityGate(threshold_db, **options).apply(blocks)
@@ -0,0 +1,248 @@
+from enum import Enum
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.volume_helpers import VolumeController
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Volume ramps and fades for any number of VolumeControllers from one timer thread, instead of a
+sleep loop per session calling increment_volume.
+
+Every ramp is a row in a set of parallel arrays (start/end, start time, duration, shape, range),
+so a tick works out every target value at once in numpy. The value is then quantized to the
+controller's step, and only rows whose quantized value moved get a set call, the backend calls
+(COM round trips on Windows) are the expensive part. A finished ramp always lands exactly on its
+target and drops out of the arrays.
+
+Shapes:
+- LINEAR: straight line in the controller's units
+- DB: straight line in dB, which is what sounds even. Endpoints are in dB already (their range
+  is negative) so that's linear for them, sessions are 0-1 amplitude and get converted, with
+  DB_FLOOR standing in for 0
+- S_CURVE: raised cosine in the controller's units, no jump in speed at either end
+
+`tick(now)` is public, with a FakeVolumeBackend and made up times a test drives it without
+the thread.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+DB_FLOOR = -60.0
+
+
+class RampShape(Enum):
+    LINEAR = 0
+    DB = 1
+    S_CURVE = 2
+
+
+def _init_com():
+    # the timer thread makes the set calls, COM wants every thread that does to be initialized
+    try:
+        import comtypes
+    except ImportError:
+        return
+    comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+
+
+class VolumeAutomation:
+
+    """
+    Schedules ramps on controllers, `start()` runs the timer thread (`with` does start/stop).
+    A new ramp on a controller that's already ramping takes over from where the old one got to.
+    """
+
+    _FIELDS = ("_a0", "_a1", "_target", "_t0", "_duration", "_s_curve", "_exp", "_lo", "_hi", "_step", "_last_q", "_last")
+
+    def __init__(self, interval_s: float = 0.01, clock: Callable[[], float] = time.monotonic):
+        self.interval_s = interval_s
+        self.clock = clock
+        self.set_calls = 0
+        self._lock = threading.Lock()
+        self._controllers: List[VolumeController] = []
+        self._count = 0
+        self._allocate(16)
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _allocate(self, capacity: int):
+        old = {name: getattr(self, name, None) for name in self._FIELDS}
+        for name in self._FIELDS:
+            dtype = np.int64 if name == "_last_q" else bool if name in ("_s_curve", "_exp") else np.float64
+            array = np.zeros(capacity, dtype=dtype)
+            if old[name] is not None:
+                array[:self._count] = old[name][:self._count]
+            setattr(self, name, array)
+
+    def ramp(
+        self,
+        controller: VolumeController,
+        target: float,
+        duration_s: float,
+        shape: RampShape = RampShape.LINEAR,
+        start_time: float = None,
+    ):
+        """ From wherever the controller is now to `target` (its units, clamped to its range). """
+        volume_range = controller.range
+        if volume_range.step <= 0:
+            raise TftimException(f"can't ramp a controller with step {volume_range.step}")
+        target = min(max(target, volume_range.min), volume_range.max)
+        start_time = self.clock() if start_time is None else start_time
+        with self._lock:
+            row = self._row_of(controller)
+            if row is None:
+                # one read to start from, a ramp taking over starts from what was last set
+                start = controller.get_volume()
+                if self._count == len(self._a0):
+                    self._allocate(2 * len(self._a0))
+                row = self._count
+                self._count += 1
+                self._controllers.append(controller)
+                self._last[row] = start
+            else:
+                start = self._last[row]
+            exp = shape == RampShape.DB and volume_range.min >= 0
+            self._a0[row], self._a1[row] = (self._to_db(start), self._to_db(target)) if exp else (start, target)
+            self._target[row] = target
+            self._t0[row] = start_time
+            self._duration[row] = max(duration_s, 1e-9)
+            self._s_curve[row] = shape == RampShape.S_CURVE
+            self._exp[row] = exp
+            self._lo[row], self._hi[row], self._step[row] = volume_range.min, volume_range.max, volume_range.step
+            self._last_q[row] = round((start - volume_range.min) / volume_range.step)
+            self._idle.clear()
+        self._wake.set()
+
+    def fade_to(self, controllers: List[VolumeController], target: float, duration_s: float, shape: RampShape = RampShape.DB):
+        """ The same ramp on several controllers, starting together. """
+        start_time = self.clock()
+        for controller in controllers:
+            self.ramp(controller, target, duration_s, shape, start_time)
+
+    def cancel(self, controller: VolumeController) -> bool:
+        """ Stops it where it is. """
+        with self._lock:
+            row = self._row_of(controller)
+            if row is None:
+                return False
+            keep = np.ones(self._count, dtype=bool)
+            keep[row] = False
+            self._compact(keep)
+            return True
+
+    def is_ramping(self, controller: VolumeController) -> bool:
+        with self._lock:
+            return self._row_of(controller) is not None
+
+    @property
+    def active(self) -> int:
+        return self._count
+
+    def _row_of(self, controller: VolumeController) -> Optional[int]:
+        return next((i for i, other in enumerate(self._controllers) if other is controller), None)
+
+    @staticmethod
+    def _to_db(value: float) -> float:
+        return 20 * np.log10(value) if value > 10 ** (DB_FLOOR / 20) else DB_FLOOR
+
+    def _compact(self, keep: np.ndarray):
+        count = int(keep.sum())
+        for name in self._FIELDS:
+            array = getattr(self, name)
+            array[:count] = array[:self._count][keep]
+        self._controllers = [controller for controller, kept in zip(self._controllers, keep) if kept]
+        self._count = count
+        if not count:
+            self._idle.set()
+
+    def tick(self, now: float = None) -> int:
+        """ Moves every ramp to `now`, returns how many set calls that took. """
+        now = self.clock() if now is None else now
+        with self._lock:
+            n = self._count
+            if not n:
+                return 0
+            t = np.clip((now - self._t0[:n]) / self._duration[:n], 0.0, 1.0)
+            shaped = np.where(self._s_curve[:n], 0.5 - 0.5 * np.cos(np.pi * t), t)
+            position = self._a0[:n] + (self._a1[:n] - self._a0[:n]) * shaped
+            values = np.where(self._exp[:n], np.power(10.0, position / 20), position)
+            lo, step = self._lo[:n], self._step[:n]
+            q = np.rint((values - lo) / step).astype(np.int64)
+            done = t >= 1.0
+            issued = np.where(done, self._target[:n], np.clip(lo + q * step, lo, self._hi[:n]))
+            moved = np.where(done, issued != self._last[:n], q != self._last_q[:n])
+
+            failed = np.zeros(n, dtype=bool)
+            calls = 0
+            for row in np.flatnonzero(moved):
+                try:
+                    self._controllers[row].set_volume(float(issued[row]))
+                except Exception:
+                    # usually the session went away with its app
+                    logger.warning("dropping the ramp on %r, set_volume failed", self._controllers[row], exc_info=True)
+                    failed[row] = True
+                    continue
+                calls += 1
+            self._last_q[:n] = np.where(moved, q, self._last_q[:n])
+            self._last[:n] = np.where(moved & ~failed, issued, self._last[:n])
+            self.set_calls += calls
+            finished = done | failed
+            if finished.any():
+                self._compact(~finished)
+            return calls
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Until no ramp is left, False on timeout. """
+        return self._idle.wait(timeout)
+
+    def start(self) -> "VolumeAutomation":
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="volume-automation", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Ramps in progress stay where they got to. """
+        if self._thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        _init_com()
+        next_tick = self.clock()
+        while not self._stopping.is_set():
+            if not self._count:
+                self._wake.wait()
+                self._wake.clear()
+                next_tick = self.clock()
+                continue
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("volume automation tick failed")
+            next_tick += self.interval_s
+            delay = next_tick - self.clock()
+            if delay < 0:
+                # fell behind, skip the missed ticks rather than bunching them up
+                next_tick, delay = self.clock(), 0
+            self._stopping.wait(delay)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,120 +1,261 @@
 
 from abc import ABC, abstractmethod
-from typing import Optional
-
-# TODO: will conflict when running on non-windows. need to handle. Can separate this module to import conditionally.
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+from collections import Counter
 from ctypes import cast, POINTER
-from comtypes import CLSCTX_ALL
+from dataclasses import dataclass
+from typing import Optional
 
 from this_framework_that_i_made.generics import SavableObject, TftimException, ensure_savable
 
 
+"""
+
+Volume and mute for endpoints and app sessions. Every get/set on Windows is a COM round trip,
+so they all go through a VolumeBackend (one per target) and the controller keeps them to a
+minimum: the range never changes for the life of a target and is read once, `read_state` gets
+volume and mute in one pass for anything that polls.
+
+pycaw (and comtypes) only get imported when a Windows backend is actually created, and
+FakeVolumeBackend keeps everything in memory and counts calls, so the controller side can be
+tested and benchmarked anywhere.
+
+"""
+
+
+def _pycaw():
+    try:
+        from pycaw import pycaw
+    except ImportError as e:
+        raise TftimException("pycaw isn't installed (Windows only), FakeVolumeBackend works everywhere") from e
+    return pycaw
+
+
 @ensure_savable
-class VolumeController(SavableObject, ABC):
+@dataclass(slots=True)
+class VolumeRange(SavableObject):
+    min: float
+    max: float
+    step: float
+
+
+@ensure_savable
+@dataclass(slots=True)
+class VolumeState(SavableObject):
+
+    """ One read of a target. """
 
-    # @classmethod
-    # @abstractmethod
-    # def from_audio_endpoint(cls, audio_endpoint):
-    #     ...
+    volume: float
+    is_muted: bool
+    range: VolumeRange
 
-    # @classmethod
-    # @abstractmethod
-    # def from_app(cls, app):
-    #     ...
+    @property
+    def percent(self) -> float:
+        return (self.volume - self.range.min) / (self.range.max - self.range.min)
+
+    @property
+    def is_max_volume(self) -> bool:
+        return self.volume >= self.range.max
+
+    @property
+    def is_min_volume(self) -> bool:
+        return self.volume <= self.range.min
+
+
+class VolumeBackend(ABC):
+
+    """ The calls a VolumeController makes, one COM round trip each on Windows. """
 
     @abstractmethod
-    def get_range(self):
+    def get_range(self) -> VolumeRange:
         ...
 
     @abstractmethod
-    def get_volume(self):
+    def get_volume(self) -> float:
         ...
 
-    def get_percent(self):
-        range_values = self.get_range()
-        return (self.get_volume() - range_values["min"]) / (range_values["max"] - range_values["min"])
+    @abstractmethod
+    def set_volume(self, value: float):
+        ...
 
     @abstractmethod
-    def set_volume(self, value):
+    def get_mute(self) -> bool:
+        ...
+
+    @abstractmethod
+    def set_mute(self, muted: bool):
         ...
 
+
+class SessionVolumeBackend(VolumeBackend):
+
+    """ An app's audio session (ISimpleAudioVolume), 0 to 1 scalar. """
+
+    RANGE = VolumeRange(0, 1, 0.01)
+
+    def __init__(self, simple_audio_volume):
+        self.simple_audio_volume = simple_audio_volume
+
+    def get_range(self) -> VolumeRange:
+        return self.RANGE
+
+    def get_volume(self) -> float:
+        # TODO: not sure why this has so much accuracy, causes issues with SetMasterVolume
+        return round(self.simple_audio_volume.GetMasterVolume(), 3)
+
+    def set_volume(self, value: float):
+        self.simple_audio_volume.SetMasterVolume(value, None)
+
+    def get_mute(self) -> bool:
+        return self.simple_audio_volume.GetMute() == 1
+
+    def set_mute(self, muted: bool):
+        self.simple_audio_volume.SetMute(int(muted), None)
+
+
+class EndpointVolumeBackend(VolumeBackend):
+
+    """ A device endpoint (IAudioEndpointVolume), in dB. """
+
+    def __init__(self, volume_interface):
+        self.volume_interface = volume_interface
+
+    def get_range(self) -> VolumeRange:
+        return VolumeRange(*self.volume_interface.GetVolumeRange())
+
+    def get_volume(self) -> float:
+        return self.volume_interface.GetMasterVolumeLevel()
+
+    def set_volume(self, value: float):
+        self.volume_interface.SetMasterVolumeLevel(value, None)
+
+    def get_mute(self) -> bool:
+        return self.volume_interface.GetMute() == 1
+
+    def set_mute(self, muted: bool):
+        self.volume_interface.SetMute(int(muted), None)
+
+
+class FakeVolumeBackend(VolumeBackend):
+
+    """ In memory, `calls` counts what would have been COM round trips. """
+
+    def __init__(self, volume_range: VolumeRange = SessionVolumeBackend.RANGE, volume: float = None, muted: bool = False):
+        self.volume_range = volume_range
+        self.volume = volume_range.max if volume is None else volume
+        self.muted = muted
+        self.calls = Counter()
+
+    def get_range(self) -> VolumeRange:
+        self.calls["get_range"] += 1
+        return self.volume_range
+
+    def get_volume(self) -> float:
+        self.calls["get_volume"] += 1
+        return self.volume
+
+    def set_volume(self, value: float):
+        self.calls["set_volume"] += 1
+        # the real ones fail with E_INVALIDARG
+        if not self.volume_range.min <= value <= self.volume_range.max:
+            raise TftimException(f"volume {value} is outside {self.volume_range}")
+        self.volume = value
+
+    def get_mute(self) -> bool:
+        self.calls["get_mute"] += 1
+        return self.muted
+
+    def set_mute(self, muted: bool):
+        self.calls["set_mute"] += 1
+        self.muted = muted
+
+
+@ensure_savable
+class VolumeController(SavableObject):
+
+    """ Volume and mute of one endpoint or session through its VolumeBackend. """
+
+    def __init__(self, backend: VolumeBackend):
+        self.backend = backend
+        self._range: Optional[VolumeRange] = None
+
+    @property
+    def range(self) -> VolumeRange:
+        # fixed for the life of the target, one call per controller
+        if self._range is None:
+            self._range = self.backend.get_range()
+        return self._range
+
+    def get_range(self):
+        return {"min": self.range.min, "max": self.range.max, "step": self.range.step}
+
+    def get_volume(self):
+        return self.backend.get_volume()
+
+    def read_state(self) -> VolumeState:
+        """ Volume, mute and range in one pass (two calls, the range is cached). """
+        return VolumeState(self.backend.get_volume(), self.backend.get_mute(), self.range)
+
+    def get_percent(self):
+        return self.read_state().percent
+
+    def set_volume(self, value):
+        self.backend.set_volume(value)
+
     def set_max_volume(self):
-        self.set_volume(self.get_range()["max"])
+        self.set_volume(self.range.max)
 
     def set_min_volume(self):
-        self.set_volume(self.get_range()["min"])
+        self.set_volume(self.range.min)
 
     def is_max_volume(self):
-        return self.get_volume() >= self.get_range()["max"]
+        return self.get_volume() >= self.range.max
 
     def is_min_volume(self):
-        return self.get_volume() <= self.get_range()["min"]
+        return self.get_volume() <= self.range.min
 
-    def increment_volume(self):
-        range_values = self.get_range()
-        curr_volume = self.get_volume()
-        if (value := curr_volume + range_values["step"]) <= range_values["max"]:
+    def increment_volume(self, curr_volume: float = None):
+        """ One step up if there's room, `curr_volume` saves the read when it's already known. """
+        curr_volume = self.get_volume() if curr_volume is None else curr_volume
+        if (value := curr_volume + self.range.step) <= self.range.max:
             self.set_volume(value)
             return value
         return curr_volume
 
-    def decrement_volume(self):
-        range_values = self.get_range()
-        curr_volume = self.get_volume()
-        if (value := curr_volume - range_values["step"]) >= range_values["min"]:
+    def decrement_volume(self, curr_volume: float = None):
+        curr_volume = self.get_volume() if curr_volume is None else curr_volume
+        if (value := curr_volume - self.range.step) >= self.range.min:
             self.set_volume(value)
             return value
         return curr_volume
 
-    @abstractmethod
     def is_muted(self):
-        ...
+        return self.backend.get_mute()
 
-    @abstractmethod
     def mute(self):
-        ...
+        self.backend.set_mute(True)
 
-    @abstractmethod
     def unmute(self):
-        ...
+        self.backend.set_mute(False)
 
     def as_dict(self):
+        state = self.read_state()
         return {
             "range": self.get_range(),
-            "volume": self.get_volume(),
-            "percent": self.get_percent(),
-            "is_muted": self.is_muted(),
+            "volume": state.volume,
+            "percent": state.percent,
+            "is_muted": state.is_muted,
         }
 
 
 class ProcessVolumeController(VolumeController):
 
     def __init__(self, audio_session):
+        super().__init__(SessionVolumeBackend(audio_session.SimpleAudioVolume))
         self.audio_session = audio_session
         self.process_id = self.audio_session.ProcessId
         self.process = self.audio_session.Process
         self.process_name = self.process.name() if self.process else None
 
-    def get_range(self):
-        return {"min": 0, "max": 1, "step": 0.01}
-    
-    def get_volume(self):
-        # TODO: not sure why this has so much accuracy, causes issues with SetMasterVolume
-        return round(self.audio_session.SimpleAudioVolume.GetMasterVolume(), 3)
-
-    def set_volume(self, value):
-        self.audio_session.SimpleAudioVolume.SetMasterVolume(value, None)
-
-    def is_muted(self):
-        return self.audio_session.SimpleAudioVolume.GetMute() == 1
-
-    def mute(self):
-        self.audio_session.SimpleAudioVolume.SetMute(1, None)
-
-    def unmute(self):
-        self.audio_session.SimpleAudioVolume.SetMute(0, None)
-
     def as_dict(self):
         return {
             "process_id": self.process_id,
@@ -128,29 +269,12 @@ class ProcessVolumeController(VolumeController):
 
 
 class DeviceVolumeController(VolumeController):
-    
+
     def __init__(self, device, volume_interface):
+        super().__init__(EndpointVolumeBackend(volume_interface))
         self.device = device
         self.volume_interface = volume_interface
 
-    def get_range(self):
-        return dict(zip(["min", "max", "step"], self.volume_interface.GetVolumeRange()))
-
-    def get_volume(self):
-        return self.volume_interface.GetMasterVolumeLevel()
-
-    def set_volume(self, value):
-        self.volume_interface.SetMasterVolumeLevel(value, None)
-
-    def is_muted(self):
-        return self.volume_interface.GetMute() == 1
-
-    def mute(self):
-        self.volume_interface.SetMute(1, None)
-
-    def unmute(self):
-        self.volume_interface.SetMute(0, None)
-    
     def as_dict(self):
         return {
             "device_name": self.device.FriendlyName,
@@ -163,7 +287,7 @@ class WindowVolumeControllerFactory:
     # ---- DEVICE STUFF --------------------------------------------------------
     @staticmethod
     def get_devices():
-        return AudioUtilities.GetAllDevices()
+        return _pycaw().AudioUtilities.GetAllDevices()
 
     @classmethod
     def get_device_by_name(cls, target_name):
@@ -175,19 +299,22 @@ class WindowVolumeControllerFactory:
 
     @classmethod
     def get_volume_controller_by_audio_endpoint_name(cls, target_name):
+        from comtypes import CLSCTX_ALL
+        IAudioEndpointVolume = _pycaw().IAudioEndpointVolume
         device = cls.get_device_by_name(target_name)
         interface = device._dev.Activate(
             IAudioEndpointVolume._iid_, CLSCTX_ALL, None
         )
         return DeviceVolumeController(device, cast(interface, POINTER(IAudioEndpointVolume)))
-    
+
     # ---- APP STUFF --------------------------------------------------------
     @staticmethod
     def get_app_sessions():
-        return AudioUtilities.GetAllSessions()
-    
+        return _pycaw().AudioUtilities.GetAllSessions()
+
+    @staticmethod
     def get_process_volume_controller_by_pid(pid) -> Optional[VolumeController]:
-        if (session := AudioUtilities.GetProcessSession(pid)) is not None:
+        if (session := _pycaw().AudioUtilities.GetProcessSession(pid)) is not None:
             return ProcessVolumeController(session)
 
     @classmethod
@@ -8,6 +8,9 @@ import comtypes
 from comtypes import CLSCTX_ALL, GUID, HRESULT, COMMETHOD, IUnknown
 from comtypes.client import CreateObject
 
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, SampleFormat
+from this_framework_that_i_made.streams import now_ns
+
 try:
     import sounddevice as sd  # used for targeted WASAPI loopback by name
 except Exception:  # pragma: no cover - optional at import time
@@ -450,6 +453,27 @@ def read_loopback_blocks(
     yield from _read_default_loopback_blocks()
 
 
+_LOOPBACK_SAMPLE_FORMAT = {"f32": SampleFormat.FLOAT_32, "s16": SampleFormat.INT_16}
+
+
+def read_loopback_pcm_blocks(device_name: str | None = None, block_ms: int = 20):
+    """
+    Same capture as read_loopback_blocks, wrapped as PcmBlocks.
+
+    Packets are whatever GetBuffer returned, so sizes vary. Each block views the WASAPI buffer,
+    which is released as soon as the next block is requested. Copy it (e.g. via PcmRechunker)
+    before moving on.
+    """
+    for header, pcm in read_loopback_blocks(device_name, block_ms=block_ms):
+        yield PcmBlock.from_array(
+            pcm,
+            _LOOPBACK_SAMPLE_FORMAT[header["fmt"]],
+            header["ch"],
+            rate=header["fs"],
+            pts_ns=now_ns() - pcm.shape[0] * 1_000_000_000 // header["fs"],
+        )
+
+
 # ---- Optional: context-managed wrapper ----
 class LoopbackStream:
     """Context manager + iterator for desktop audio blocks."""
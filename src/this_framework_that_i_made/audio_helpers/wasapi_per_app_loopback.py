@@ -9,6 +9,9 @@ import comtypes
 from comtypes import IUnknown, GUID, HRESULT, COMMETHOD, STDMETHOD, HRESULT
 from comtypes.client import CreateObject
 
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, SampleConverter, SampleFormat
+from this_framework_that_i_made.streams import now_ns
+
 if platform.system() != "Windows":
     raise OSError("per_app_loopback is Windows-only (WASAPI Process Loopback).")
 
@@ -300,6 +303,9 @@ class PerAppLoopback:
         self._client = None
         self._cap = None
         self._event = None
+        # the mix format is float32, packets are converted into one reused int16 buffer
+        self._converter = SampleConverter(SampleFormat.FLOAT_32, SampleFormat.INT_16)
+        self._pcm16 = np.empty(0, dtype=np.int16)
 
     def __enter__(self):
         # 1) Build activation params blob
@@ -405,10 +411,11 @@ class PerAppLoopback:
                 # Convert to int16 for convenience. Keep float32 if you prefer.
                 fptr = ctypes.cast(ppData, ctypes.POINTER(ctypes.c_float))
                 nsamp = nf * self.channels
-                arr = np.ctypeslib.as_array(fptr, shape=(nsamp,)).astype(np.float32)
-                pcm16 = np.clip(arr, -1.0, 1.0)
-                pcm16 = (pcm16 * 32767.0).astype(np.int16)
-                out.extend(pcm16.tobytes())
+                arr = np.ctypeslib.as_array(fptr, shape=(nsamp,))  # view of the WASAPI buffer
+                if self._pcm16.size < nsamp:
+                    self._pcm16 = np.empty(nsamp, dtype=np.int16)
+                pcm16 = self._converter.convert(arr, out=self._pcm16[:nsamp])
+                out += pcm16.data
 
                 self._cap.ReleaseBuffer(nf)
                 frames_accum += nf
@@ -419,3 +426,11 @@ class PerAppLoopback:
             else:
                 # No frames; continue. You could yield silence for fixed pacing if needed.
                 continue
+
+    def pcm_blocks(self):
+        """ Same packets as iterating, as int16 PcmBlocks (variable sizes, see PcmRechunker). """
+        for chunk in self:
+            block = PcmBlock(chunk, SampleFormat.INT_16, self.channels, rate=self.sample_rate)
+            # the packet was just drained, so its first frame is one packet duration old
+            block.pts_ns = now_ns() - block.frames * 1_000_000_000 // self.sample_rate
+            yield block
@@ -0,0 +1,222 @@
+import os
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, SampleConverter, SampleFormat
+from this_framework_that_i_made.generics import TftimException
+
+
+"""
+
+Waveform overviews for long recordings, so drawing a few hours of audio doesn't mean reading
+a few hours of samples.
+
+Level 0 holds min, max and rms per channel for every `base_frames` frames, level n for every
+`base_frames << n`, each level built from pairs of the one below as soon as both halves are in.
+Entries are float16 (6 bytes per channel), the whole pyramid is about 12 / base_frames bytes per
+sample, under 1% of the recording with the default 512.
+
+A query picks the coarsest level whose entries are still narrower than a pixel, so every pixel
+merges one to two entries whatever the zoom, plus the few not yet merged ones at the very end.
+
+"""
+
+ENTRY_DTYPE = np.float16
+_MIN, _MAX, _RMS = 0, 1, 2
+
+
+def _summarize(samples: np.ndarray, bucket: int) -> np.ndarray:
+    """ (n * bucket, channels) float32 -> (n, channels, 3) min/max/rms. """
+    # planar first, reducing over the contiguous last axis is an order of magnitude faster
+    buckets = np.ascontiguousarray(samples.T, dtype=np.float32).reshape(samples.shape[1], -1, bucket)
+    out = np.empty((buckets.shape[1], samples.shape[1], 3), dtype=np.float32)
+    out[..., _MIN] = buckets.min(axis=2).T
+    out[..., _MAX] = buckets.max(axis=2).T
+    out[..., _RMS] = np.sqrt(np.einsum("cnb,cnb->nc", buckets, buckets) / bucket)
+    return out
+
+
+def _combine_pairs(entries: np.ndarray) -> np.ndarray:
+    """ (2n, channels, 3) -> (n, channels, 3), neighbours merged. """
+    pairs = entries.astype(np.float32).reshape(-1, 2, *entries.shape[1:])
+    first, second = pairs[:, 0], pairs[:, 1]
+    out = np.empty(first.shape, dtype=np.float32)
+    np.minimum(first[..., _MIN], second[..., _MIN], out=out[..., _MIN])
+    np.maximum(first[..., _MAX], second[..., _MAX], out=out[..., _MAX])
+    out[..., _RMS] = np.sqrt((np.square(first[..., _RMS]) + np.square(second[..., _RMS])) / 2)
+    return out
+
+
+class WaveformOverview:
+
+    """
+    Min/max/rms pyramid of a recording, fed block by block. Positions are in frames from the
+    first one fed, `overview` returns per pixel levels for any frame range.
+    """
+
+    def __init__(self, channels: int, rate: int = None, base_frames: int = 512):
+        if base_frames < 1:
+            raise TftimException(f"base_frames must be positive, got {base_frames}")
+        self.channels = channels
+        self.rate = rate
+        self.base_frames = base_frames
+        self.frames = 0
+        self._levels: List[np.ndarray] = [np.empty((0, channels, 3), dtype=ENTRY_DTYPE)]
+        self._counts: List[int] = [0]
+        self._pending = np.empty((base_frames, channels), dtype=np.float32)
+        self._fill = 0
+        self._converter = None
+
+    @property
+    def levels(self) -> int:
+        return len(self._levels)
+
+    def level(self, n: int) -> np.ndarray:
+        """ The complete entries of level `n` as (entries, channels, 3) min/max/rms. """
+        return self._levels[n][:self._counts[n]]
+
+    def feed(self, block: PcmBlock):
+        if block.channels != self.channels:
+            raise TftimException(f"overview has {self.channels} channels, got {block.channels}")
+        samples = block.array.reshape(-1, block.channels)
+        if block.sample_format != SampleFormat.FLOAT_32:
+            if self._converter is None or self._converter.src_format != block.sample_format:
+                self._converter = SampleConverter(block.sample_format, SampleFormat.FLOAT_32)
+            samples = self._converter.convert(samples)
+        self.add(samples)
+
+    def add(self, samples: np.ndarray):
+        """ Appends (frames, channels) float samples. """
+        n = samples.shape[0]
+        base = self.base_frames
+        if self._fill:
+            take = min(n, base - self._fill)
+            self._pending[self._fill:self._fill + take] = samples[:take]
+            self._fill += take
+            samples = samples[take:]
+            if self._fill == base:
+                self._append(0, _summarize(self._pending, base))
+                self._fill = 0
+        whole = samples.shape[0] // base * base
+        if whole:
+            self._append(0, _summarize(samples[:whole], base))
+        rest = samples.shape[0] - whole
+        if rest:
+            self._pending[:rest] = samples[whole:]
+            self._fill = rest
+        self.frames += n
+        self._cascade()
+
+    def _append(self, level: int, entries: np.ndarray):
+        array, count = self._levels[level], self._counts[level]
+        if count + len(entries) > len(array):
+            grown = np.empty((max(2 * len(array), count + len(entries), 64), self.channels, 3), dtype=ENTRY_DTYPE)
+            grown[:count] = array[:count]
+            self._levels[level] = array = grown
+        array[count:count + len(entries)] = entries
+        self._counts[level] = count + len(entries)
+
+    def _cascade(self):
+        level = 0
+        while True:
+            merged = 2 * self._counts[level + 1] if level + 1 < len(self._levels) else 0
+            pairs = (self._counts[level] - merged) // 2
+            if not pairs:
+                return
+            if level + 1 == len(self._levels):
+                self._levels.append(np.empty((0, self.channels, 3), dtype=ENTRY_DTYPE))
+                self._counts.append(0)
+            self._append(level + 1, _combine_pairs(self._levels[level][merged:merged + 2 * pairs]))
+            level += 1
+
+    def _entries(self, level: int, start: int, end: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Entries covering [start, end) as float32 values plus their start and end frames. """
+        size = self.base_frames << level
+        first = start // size
+        last = min(self._counts[level], -(-end // size))
+        values = [self._levels[level][first:last].astype(np.float32)]
+        starts = [np.arange(first, max(first, last), dtype=np.int64) * size]
+        ends = [starts[0] + size]
+
+        # the end of the recording that hasn't made it up to this level yet
+        position = self._counts[level] * size
+        tail_values, tail_starts, tail_ends = [], [], []
+        for lower in range(level - 1, -1, -1):
+            lower_size = self.base_frames << lower
+            for i in range(position // lower_size, self._counts[lower]):
+                tail_values.append(self._levels[lower][i].astype(np.float32))
+                tail_starts.append(position)
+                tail_ends.append(position + lower_size)
+                position += lower_size
+        if self._fill:
+            tail_values.append(_summarize(self._pending[:self._fill], self._fill)[0])
+            tail_starts.append(position)
+            tail_ends.append(position + self._fill)
+        if tail_values:
+            tail_starts, tail_ends = np.array(tail_starts), np.array(tail_ends)
+            keep = (tail_ends > start) & (tail_starts < end)
+            values.append(np.array(tail_values)[keep].reshape(-1, self.channels, 3))
+            starts.append(tail_starts[keep])
+            ends.append(tail_ends[keep])
+        return np.concatenate(values), np.concatenate(starts), np.concatenate(ends)
+
+    def overview(self, pixels: int, start: int = 0, end: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (pixels, channels) min, max and rms of frames [start, end), split into equal pixels. """
+        end = self.frames if end is None else min(end, self.frames)
+        start = max(0, start)
+        if pixels <= 0 or end <= start:
+            empty = np.zeros((max(pixels, 0), self.channels), dtype=np.float32)
+            return empty, empty.copy(), empty.copy()
+
+        frames_per_pixel = (end - start) / pixels
+        level = min(len(self._levels) - 1, max(0, int(frames_per_pixel // self.base_frames).bit_length() - 1))
+        values, starts, ends = self._entries(level, start, end)
+
+        edges = start + (end - start) * np.arange(pixels + 1, dtype=np.float64) / pixels
+        lo = np.minimum(np.searchsorted(ends, edges[:-1], side="right"), len(values) - 1)
+        hi = np.maximum(np.searchsorted(starts, edges[1:], side="left"), lo + 1)
+        # reduceat over interleaved (lo, hi) pairs, every other result is a pixel. A padding row
+        # keeps hi == len(values) a valid index
+        bounds = np.empty(2 * pixels, dtype=np.intp)
+        bounds[0::2] = lo
+        bounds[1::2] = hi
+        padded = np.concatenate([values, values[:1]])
+        mins = np.minimum.reduceat(padded[..., _MIN], bounds)[0::2]
+        maxs = np.maximum.reduceat(padded[..., _MAX], bounds)[0::2]
+        weights = np.append(ends - starts, 0).astype(np.float32)[:, None]
+        energy = np.add.reduceat(np.square(padded[..., _RMS]) * weights, bounds)[0::2]
+        rms = np.sqrt(energy / np.add.reduceat(weights, bounds)[0::2])
+        return mins, maxs, rms
+
+    def save(self, path: Union[str, os.PathLike]):
+        """ Writes everything, including the partial last bucket, to an .npz (atomically). """
+        path = os.fspath(path)
+        arrays: Dict[str, np.ndarray] = {f"level{i}": self.level(i) for i in range(len(self._levels))}
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez(
+                f,
+                channels=self.channels,
+                rate=self.rate or 0,
+                base_frames=self.base_frames,
+                frames=self.frames,
+                pending=self._pending[:self._fill],
+                **arrays,
+            )
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "WaveformOverview":
+        with np.load(os.fspath(path)) as data:
+            overview = cls(int(data["channels"]), int(data["rate"]) or None, int(data["base_frames"]))
+            overview.frames = int(data["frames"])
+            levels = sorted((name for name in data.files if name.startswith("level")), key=lambda name: int(name[5:]))
+            overview._levels = [np.array(data[name], dtype=ENTRY_DTYPE) for name in levels]
+            overview._counts = [len(level) for level in overview._levels]
+            pending = data["pending"]
+        if not overview._levels:
+            overview._levels, overview._counts = [np.empty((0, overview.channels, 3), dtype=ENTRY_DTYPE)], [0]
+        overview._fill = len(pending)
+        overview._pending[:overview._fill] = pending
+        return overview
@@ -23,6 +23,11 @@ class Distribution(SavableObject):
             version=metadata.version,
         )
 
+    @classmethod
+    def from_data(cls, data: Dict):
+        """ From `PythonRuntimeEnv.get_distribution_data` (a snapshot), there's no metadata object then. """
+        return cls(metadata=None, name=data["name"], requires=data["requires"], version=data["version"])
+
     def __str__(self):
         name = self.name
         requires = self.requires
@@ -43,3 +48,11 @@ class PythonRuntimeEnv(SavableObject):
     @staticmethod
     def _get_distributions():
         return [Distribution.create_instance(metadata) for metadata in importlib.metadata.distributions()]
+
+    @staticmethod
+    def get_distribution_data() -> List[Dict]:
+        """ Plain name / requires / version per distribution, what a snapshot keeps. """
+        return [
+            {"name": metadata.name, "requires": metadata.requires, "version": metadata.version}
+            for metadata in importlib.metadata.distributions()
+        ]
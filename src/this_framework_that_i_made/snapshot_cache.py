@@ -0,0 +1,235 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import zlib
+
+from .generics import TftimException
+
+
+"""
+
+Startup enumeration from the last run. Listing PortAudio devices (initializing PortAudio), mss
+monitors and installed distributions takes from tens of milliseconds to seconds, and on the
+same boot of the same machine the answer is nearly always what it was last time.
+
+A SnapshotCache keeps the plain data each of those is built from (PortAudio's info dicts, mss'
+monitor dicts, name/version/requires per distribution) in one zlib'd JSON file, keyed by the
+boot ID and a fingerprint of the machine and interpreter. `start()` rebuilds the objects from
+the file right away, then a background thread collects everything fresh and swaps in (and
+rewrites the file for) only the sections that came out different. A key mismatch, a missing
+or unreadable file just means a cold start: `get` waits for the first collect.
+
+PortAudio's part is served by seeding PortAudioSession with the cached device table, so
+AudioSystem and everything under it reads it as if it had scanned. The revalidating scan
+replaces it, under a new generation, only if something changed, and the enumeration cache
+and device watchers pick that up like any hotplug.
+
+Windows (pygetwindow) aren't in here: they change constantly, their handles mean nothing once
+the window closes, and listing them is cheap anyway.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def boot_id() -> str:
+    """ Changes on every boot. """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        import psutil
+        return str(int(psutil.boot_time()))
+    except ImportError:
+        # monotonic counts from boot on Windows and macOS, rounding eats the jitter
+        return str(round(time.time() - time.monotonic(), -1))
+
+
+def hardware_fingerprint() -> str:
+    """ Machine and interpreter, so a file copied to another box (or venv) doesn't match. """
+    parts = [platform.node(), platform.system(), platform.release(), platform.machine(), str(os.cpu_count()), sys.prefix, sys.version]
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def default_path() -> str:
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "this_framework_that_i_made", "startup_snapshot.json.z")
+
+
+def _plain(data: Any) -> Any:
+    # what it'll look like read back from the file (tuples -> lists and so on), for comparing
+    return json.loads(json.dumps(data))
+
+
+@dataclass(slots=True)
+class SnapshotSource:
+    name: str
+    # fresh plain (json) data, the slow part
+    collect: Callable[[], Any]
+    # plain data -> what `SnapshotCache.get` hands out
+    restore: Callable[[Any], Any]
+
+
+def _collect_audio():
+    from .audio_helpers.pyaudio_helper import PortAudioSession
+    PortAudioSession.revalidate()
+    table = PortAudioSession.device_table()
+    return {"host_apis": table.host_apis, "devices": table.devices}
+
+
+def _restore_audio(data):
+    from .audio import AudioSystem
+    from .audio_helpers.pyaudio_helper import PortAudioSession
+    # a no-op once PortAudio has been scanned, which is also when it's already this data
+    PortAudioSession.seed(data["host_apis"], data["devices"])
+    return AudioSystem()
+
+
+def _collect_monitors():
+    from .video_helpers.monitors import Monitor
+    return Monitor.get_monitor_data()
+
+
+def _restore_monitors(data):
+    from .video_helpers.monitors import Monitor
+    return Monitor.from_monitor_data(data)
+
+
+def _collect_distributions():
+    from .python import PythonRuntimeEnv
+    return PythonRuntimeEnv.get_distribution_data()
+
+
+def _restore_distributions(data):
+    from .python import Distribution
+    return [Distribution.from_data(d) for d in data]
+
+
+AUDIO = SnapshotSource("audio", _collect_audio, _restore_audio)
+MONITORS = SnapshotSource("monitors", _collect_monitors, _restore_monitors)
+DISTRIBUTIONS = SnapshotSource("distributions", _collect_distributions, _restore_distributions)
+DEFAULT_SOURCES = (AUDIO, MONITORS, DISTRIBUTIONS)
+
+
+class SnapshotCache:
+
+    """
+    `start()` once at startup, then `get(name)` for the objects: the cached ones immediately,
+    the fresh ones after revalidation if anything differed. `on_change` listeners hear about
+    every section that was swapped in (on the revalidation thread).
+    """
+
+    def __init__(self, path: str = None, sources: Sequence[SnapshotSource] = DEFAULT_SOURCES, key: str = None):
+        self.path = path or default_path()
+        self.sources: Dict[str, SnapshotSource] = {source.name: source for source in sources}
+        self.key = key or f"{boot_id()}/{hardware_fingerprint()}"
+        self.cached: List[str] = []  # sections served from the file
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = {}
+        self._values: Dict[str, Any] = {}
+        self._ready = {name: threading.Event() for name in self.sources}
+        self._listeners: List[Callable[[str, Any], None]] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, revalidate: bool = True) -> "SnapshotCache":
+        for name, data in self._read().items():
+            source = self.sources.get(name)
+            if source is None:
+                continue
+            try:
+                value = source.restore(data)
+            except Exception:
+                logger.exception("couldn't restore the %s snapshot", name)
+                continue
+            with self._lock:
+                self._data[name], self._values[name] = data, value
+            self.cached.append(name)
+            self._ready[name].set()
+        logger.debug("snapshot %s: served %s from cache", self.path, self.cached)
+        if revalidate:
+            self._thread = threading.Thread(target=self.revalidate, name="snapshot-revalidate", daemon=True)
+            self._thread.start()
+        return self
+
+    def get(self, name: str, timeout: float = None) -> Any:
+        """ None if collecting it failed. """
+        if name not in self._ready:
+            raise TftimException(f"no snapshot source called {name!r}")
+        if not self._ready[name].wait(timeout):
+            raise TftimException(f"{name} isn't in the snapshot yet")
+        return self._values[name]
+
+    def on_change(self, listener: Callable[[str, Any], None]):
+        self._listeners.append(listener)
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Until revalidation is done, False on timeout. """
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def revalidate(self) -> List[str]:
+        """ Collects everything fresh, swaps in what changed and rewrites the file. Returns the changed names. """
+        changed = []
+        for name, source in self.sources.items():
+            try:
+                data = _plain(source.collect())
+                if name in self._data and data == self._data[name]:
+                    continue
+                value = source.restore(data)
+            except Exception:
+                logger.exception("couldn't collect %s", name)
+                if not self._ready[name].is_set():
+                    self._values[name] = None
+                    self._ready[name].set()
+                continue
+            with self._lock:
+                self._data[name], self._values[name] = data, value
+            self._ready[name].set()
+            changed.append(name)
+            for listener in list(self._listeners):
+                listener(name, value)
+        if changed:
+            logger.debug("snapshot %s: %s changed", self.path, changed)
+            self._write()
+        return changed
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = json.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, zlib.error):
+            logger.warning("unreadable snapshot %s, starting cold", self.path)
+            return {}
+        if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("key") != self.key:
+            logger.debug("snapshot %s is from another boot or machine, starting cold", self.path)
+            return {}
+        return snapshot.get("sections", {})
+
+    def _write(self):
+        with self._lock:
+            snapshot = {"version": SNAPSHOT_VERSION, "key": self.key, "sections": dict(self._data)}
+            payload = zlib.compress(json.dumps(snapshot, separators=(",", ":")).encode(), 6)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                f.write(payload)
+            os.replace(temp, self.path)
+        except OSError:
+            # only costs the next startup its head start
+            logger.warning("couldn't write snapshot %s", self.path, exc_info=True)
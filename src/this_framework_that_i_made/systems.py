@@ -270,8 +270,6 @@ class WindowsSystem(OperatingSystem):
             return ("loop-back" in s) or ("loopback" in s)
 
         def endpoint_visible(ep) -> bool:
-            if ep.hostapi_name != preferred_hostapi:
-                return False
             if any(ep.name.startswith(p) for p in excluded_prefixes):
                 return False
             if not include_loopback and is_loopback(ep.name):
@@ -280,10 +278,12 @@ class WindowsSystem(OperatingSystem):
                 return False
             return True
 
-        return [
-            dev for dev in self.audio_system.audio_devices
-            if any(endpoint_visible(ep) for ep in dev.endpoints)
-        ]
+        visible = {
+            id(self.audio_system.device_of(ep))
+            for ep in self.audio_system.endpoints_by_host_api(preferred_hostapi)
+            if endpoint_visible(ep)
+        }
+        return [dev for dev in self.audio_system.audio_devices if id(dev) in visible]
 
     @property
     def windows(self) -> List[MsftWindow]:
@@ -80,35 +80,38 @@ class Monitor(RectangleMixin, PlaneObject, SavableObject):
                 frame = np.frombuffer(img.rgb, dtype=np.uint8).reshape(img.height, img.width, 3)
                 yield (self.monitor_data, time.time(), frame)
 
-    @classmethod
-    def get_monitors(cls) -> List["Monitor"]:
+    @staticmethod
+    def get_monitor_data() -> List[dict]:
+        """ mss' monitor dicts, copied so we don't mutate its internal ones. """
         with mss.mss() as probe:  # just to list monitors
             # real monitors start at index 1; index 0 is the virtual desktop union
-            mons = probe.monitors[1:]
+            return [dict(m) for m in probe.monitors[1:]]
 
-            # 1) primary = monitor containing (0,0)
-            origin_candidates = [
-                i for i, m in enumerate(mons)
-                if (m["left"] <= 0 < m["left"] + m["width"]
-                    and m["top"] <= 0 < m["top"] + m["height"])
-            ]
+    @classmethod
+    def get_monitors(cls) -> List["Monitor"]:
+        return cls.from_monitor_data(cls.get_monitor_data())
 
-            if origin_candidates:
-                primary_idx = origin_candidates[0]
+    @classmethod
+    def from_monitor_data(cls, mons: List[dict]) -> List["Monitor"]:
+        # 1) primary = monitor containing (0,0)
+        origin_candidates = [
+            i for i, m in enumerate(mons)
+            if (m["left"] <= 0 < m["left"] + m["width"]
+                and m["top"] <= 0 < m["top"] + m["height"])
+        ]
+
+        if origin_candidates:
+            primary_idx = origin_candidates[0]
+        else:
+            # 2) fallback: backend-provided flag
+            flagged = [i for i, m in enumerate(mons) if m.get("primary")]
+            if flagged:
+                primary_idx = flagged[0]
             else:
-                # 2) fallback: backend-provided flag
-                flagged = [i for i, m in enumerate(mons) if m.get("primary")]
-                if flagged:
-                    primary_idx = flagged[0]
-                else:
-                    # 3) last resort: first real monitor (if any)
-                    primary_idx = 0 if mons else -1
-
-            result: List["Monitor"] = []
-            for i, m in enumerate(mons):
-                d = dict(m)  # copy so we don't mutate mss' internal dict
-                result.append(cls(d, is_primary=(i == primary_idx)))
-            return result
+                # 3) last resort: first real monitor (if any)
+                primary_idx = 0 if mons else -1
+
+        return [cls(dict(m), is_primary=(i == primary_idx)) for i, m in enumerate(mons)]
 
     def is_false(self):
         return self.width <= 1 and self.height <= 1
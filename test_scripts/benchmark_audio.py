@@ -0,0 +1,188 @@
+import time
+
+import numpy as np
+
+from this_framework_that_i_made.audio_helpers import audio_backends
+from this_framework_that_i_made.audio_helpers.audio_standards import PcmBlock, SampleFormat
+from this_framework_that_i_made.audio_helpers.lossless import Compressor, PcmCodec
+from this_framework_that_i_made.audio_helpers.metering import MeterBank
+from this_framework_that_i_made.audio_helpers.pyaudio_helper import get_pcm_blocks
+from this_framework_that_i_made.audio_helpers.mixing import AudioMixer
+from this_framework_that_i_made.audio_helpers.resampling import PcmResampler, ResamplerQuality
+from this_framework_that_i_made.audio_helpers.spectrum import SpectrumBank
+from this_framework_that_i_made.audio_helpers.synthetic_audio import SyntheticBackend, VirtualDevice
+from this_framework_that_i_made.audio_helpers.volume_automation import VolumeAutomation
+from this_framework_that_i_made.audio_helpers.volume_helpers import FakeVolumeBackend, VolumeController, VolumeRange
+
+
+def _sine_frames(rate, seconds, freqs=(1000.0, 3000.0), amplitude=0.5):
+    t = np.arange(int(rate * seconds)) / rate
+    return (amplitude * np.stack([np.sin(2 * np.pi * f * t) for f in freqs], axis=1)).astype(np.float32)
+
+
+def _iter_blocks(frames, rate, block_frames):
+    for i in range(0, len(frames), block_frames):
+        yield PcmBlock.from_array(frames[i:i + block_frames], SampleFormat.FLOAT_32, rate=rate)
+
+
+def benchmark_resampler(in_rate=44_100, out_rate=48_000, seconds=10.0, block_frames=1024):
+    """ Realtime factor (higher is cheaper) and SNR against an ideal sine for each quality preset. """
+    source = _sine_frames(in_rate, seconds)
+    print(f"resampling {seconds}s of stereo {in_rate} -> {out_rate} Hz in {block_frames}-frame blocks")
+    for quality in ResamplerQuality:
+        resampler = PcmResampler(in_rate, out_rate, channels=2, quality=quality)
+        start = time.perf_counter()
+        out = np.concatenate([b.array for b in resampler.apply(_iter_blocks(source, in_rate, block_frames))])
+        elapsed = time.perf_counter() - start
+        ideal = _sine_frames(out_rate, len(out) / out_rate)[:len(out)]
+        err = (out - ideal)[256:-256]
+        snr = 10 * np.log10(np.mean(ideal ** 2) / np.mean(err ** 2))
+        print(f"  {quality.name:<6} {seconds / elapsed:8.1f}x realtime  {100 * elapsed / seconds:5.2f}% of a core  snr {snr:6.1f} dB")
+
+
+def benchmark_mixer(inputs=8, rate=48_000, seconds=10.0, block_frames=480):
+    """ CPU share of one core spent mixing `inputs` stereo int16 streams in realtime. """
+    mixer = AudioMixer(rate=rate, channels=2, block_frames=block_frames)
+    source = (_sine_frames(rate, block_frames / rate) * 32767).astype(np.int16)
+    for i in range(inputs):
+        mixer.add_input(i, channels=2, gain=1 / inputs)
+    blocks = int(seconds * rate / block_frames)
+    start = time.perf_counter()
+    for n in range(blocks):
+        pts_ns = n * block_frames * 1_000_000_000 // rate
+        for i in range(inputs):
+            mixer.push(i, PcmBlock.from_array(source, SampleFormat.INT_16, rate=rate, pts_ns=pts_ns))
+        while mixer.ready():
+            mixer.pull()
+    elapsed = time.perf_counter() - start
+    print(f"mixing {inputs} stereo inputs at {rate} Hz: {100 * elapsed / seconds:.2f}% of a core")
+
+
+def benchmark_meter_bank(streams=24, rate=48_000, seconds=10.0, block_frames=480):
+    """ CPU share of one core spent metering `streams` stereo int16 streams in one bank. """
+    bank = MeterBank()
+    source = (_sine_frames(rate, block_frames / rate) * 32767).astype(np.int16)
+    for i in range(streams):
+        bank.add(i, rate, 2)
+    blocks = {i: PcmBlock.from_array(source, SampleFormat.INT_16, rate=rate) for i in range(streams)}
+    start = time.perf_counter()
+    for _ in range(int(seconds * rate / block_frames)):
+        bank.measure(blocks)
+    elapsed = time.perf_counter() - start
+    print(f"metering {streams} stereo streams at {rate} Hz: {100 * elapsed / seconds:.2f}% of a core")
+
+
+def benchmark_spectrum_bank(streams=16, rate=48_000, seconds=10.0, block_frames=480):
+    """ CPU share of one core spent on 64 band spectra of `streams` stereo streams, 75% overlap. """
+    bank = SpectrumBank()
+    source = (_sine_frames(rate, block_frames / rate) * 32767).astype(np.int16)
+    for i in range(streams):
+        bank.add(i, rate, channels=2, bands=64, overlap=0.75, smoothing=0.1)
+    blocks = {i: PcmBlock.from_array(source, SampleFormat.INT_16, rate=rate) for i in range(streams)}
+    start = time.perf_counter()
+    for _ in range(int(seconds * rate / block_frames)):
+        bank.feed(blocks)
+    elapsed = time.perf_counter() - start
+    print(f"spectrum of {streams} stereo streams at {rate} Hz: {100 * elapsed / seconds:.2f}% of a core")
+
+
+def benchmark_lossless(rate=48_000, seconds=10.0, block_frames=4800):
+    """ Compression ratio against encode / decode speed (MB/s of raw PCM) for every compressor. """
+    floats = _sine_frames(rate, seconds, amplitude=0.3)
+    floats += np.random.default_rng(0).standard_normal(floats.shape).astype(np.float32) * 1e-3
+    sources = {
+        "int16": (SampleFormat.INT_16, (floats * 32767).astype(np.int16)),
+        "float32 from int16": (SampleFormat.FLOAT_32, (np.rint(floats * 32767) / 32768).astype(np.float32)),
+        "float32": (SampleFormat.FLOAT_32, floats),
+    }
+    for name, (sample_format, samples) in sources.items():
+        blocks = [PcmBlock.from_array(samples[i:i + block_frames], sample_format, rate=rate) for i in range(0, len(samples), block_frames)]
+        raw = samples.nbytes / 1e6
+        for compressor, level in ((Compressor.ZLIB, 1), (Compressor.ZLIB, 6), (Compressor.BZ2, 9), (Compressor.LZMA, 1)):
+            codec = PcmCodec(compressor, level)
+            start = time.perf_counter()
+            frames = [codec.encode(block) for block in blocks]
+            encoded = time.perf_counter() - start
+            start = time.perf_counter()
+            for frame in frames:
+                PcmCodec.decode(frame)
+            decoded = time.perf_counter() - start
+            ratio = sum(len(frame) for frame in frames) / samples.nbytes
+            print(
+                f"{name:>18} {compressor.name.lower():>4}-{level}: ratio {ratio:.3f}, "
+                f"encode {raw / encoded:.0f} MB/s, decode {raw / decoded:.0f} MB/s"
+            )
+
+
+def benchmark_synthetic_capture(rate=48_000, seconds=60.0, frames_per_buffer=480):
+    """ get_pcm_blocks end to end (callback thread, queue, PcmBlocks) on a device as fast as it goes. """
+    audio_backends.set_backend(SyntheticBackend([VirtualDevice("Noise", rate=rate, source="noise")], realtime=False))
+    try:
+        for sample_format in (SampleFormat.INT_16, SampleFormat.FLOAT_32):
+            frames = 0
+            start = time.perf_counter()
+            # a fast device outruns any consumer, a queue for the whole run keeps every block
+            queue_size = int(rate * seconds / frames_per_buffer) + 1
+            with get_pcm_blocks(input_device_index=0, sample_format=sample_format, frames_per_buffer=frames_per_buffer, queue_size=queue_size) as blocks:
+                for block in blocks:
+                    frames += block.frames
+                    if frames >= rate * seconds:
+                        break
+                stats = blocks.stats()
+            elapsed = time.perf_counter() - start
+            print(
+                f"capture {sample_format.name.lower()}: {frames / rate / elapsed:.0f}x real time, "
+                f"callback p99 {stats.callback_percentile_us(0.99):.0f} us, {stats.dropped_blocks} dropped"
+            )
+    finally:
+        audio_backends.set_backend(None)
+
+
+def benchmark_volume_polling(sessions=32, ticks=5_000):
+    """ Backend calls (COM round trips on Windows) and Python overhead of polling every session each tick. """
+    # an endpoint-like dB range, steps that add up exactly so every tick sets something
+    backends = [FakeVolumeBackend(VolumeRange(-64.0, 0.0, 0.5)) for _ in range(sessions)]
+    controllers = [VolumeController(backend) for backend in backends]
+    start = time.perf_counter()
+    for _ in range(ticks):
+        for controller in controllers:
+            state = controller.read_state()
+            if not state.is_max_volume:
+                controller.increment_volume(state.volume)
+            else:
+                controller.set_min_volume()
+    elapsed = time.perf_counter() - start
+    calls = sum(sum(backend.calls.values()) for backend in backends)
+    print(f"volume polling: {calls / (ticks * sessions):.2f} calls per session per tick, {elapsed / ticks * 1e6:.0f} us per tick for {sessions}")
+
+
+def benchmark_volume_automation(sessions=256, seconds=2.0, interval_s=0.01):
+    """ Cost of one automation tick with `sessions` dB fades running, and the set calls it made. """
+    controllers = [VolumeController(FakeVolumeBackend(VolumeRange(-64.0, 0.0, 0.5), volume=0.0)) for _ in range(sessions)]
+    automation = VolumeAutomation()
+    automation.fade_to(controllers, -64.0, seconds)
+    start_time = automation.clock()
+    ticks = int(seconds / interval_s) + 1
+    start = time.perf_counter()
+    for i in range(ticks):
+        automation.tick(start_time + i * interval_s)
+    elapsed = time.perf_counter() - start
+    print(
+        f"volume automation: {elapsed / ticks * 1e6:.0f} us per tick for {sessions} ramps, "
+        f"{automation.set_calls / sessions:.0f} set calls per ramp over {ticks} ticks"
+    )
+
+
+def main():
+    benchmark_resampler()
+    benchmark_mixer()
+    benchmark_meter_bank()
+    benchmark_spectrum_bank()
+    benchmark_lossless()
+    benchmark_synthetic_capture()
+    benchmark_volume_polling()
+    benchmark_volume_automation()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,904 @@
+import asyncio
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from this_framework_that_i_made.audio import AudioEndpointType, AudioSystem, DeviceChangeKind
+from this_framework_that_i_made.audio_helpers import audio_backends, pyaudio_helper
+from this_framework_that_i_made.audio_helpers.audio_standards import (
+    PcmBlock,
+    PcmSilence,
+    SampleConverter,
+    SampleFormat,
+    pack_int24,
+    shared_converter,
+    unpack_int24,
+)
+from this_framework_that_i_made.audio_helpers.dsp import Biquad, BiquadType, DspChain, Gain, Limiter, _simulate, biquad_coefficients
+from this_framework_that_i_made.audio_helpers.lossless import (
+    Compressor,
+    CompressedPcmWriter,
+    FrameDecoder,
+    PcmCodec,
+    read_compressed,
+)
+from this_framework_that_i_made.audio_helpers.metering import LevelMeter, MeterBank
+from this_framework_that_i_made.audio_helpers.mixing import AudioMixer
+from this_framework_that_i_made.audio_helpers.pcm_archive import PcmArchive, PcmArchiveWriter
+from this_framework_that_i_made.audio_helpers.rechunking import PcmRechunker
+from this_framework_that_i_made.audio_helpers.resampling import PcmResampler
+from this_framework_that_i_made.audio_helpers.spectrum import BandScale, SpectrumAnalyzer, SpectrumBank
+from this_framework_that_i_made.audio_helpers.synthetic_audio import SyntheticBackend, VirtualDevice
+from this_framework_that_i_made.audio_helpers.voice_activity import VoiceActivityGate
+from this_framework_that_i_made.audio_helpers.volume_automation import RampShape, VolumeAutomation
+from this_framework_that_i_made.audio_helpers.volume_helpers import FakeVolumeBackend, VolumeController, VolumeRange
+from this_framework_that_i_made.audio_helpers.waveform_overview import WaveformOverview
+from this_framework_that_i_made.generics import TftimException
+from this_framework_that_i_made.snapshot_cache import AUDIO, SnapshotCache, SnapshotSource
+
+
+def test_int24_round_trip():
+    samples = np.array([0, 1, -1, 2**23 - 1, -(2**23), 123456, -654321], dtype=np.int32)
+    packed = pack_int24(samples)
+    assert packed.size == samples.size * 3
+    assert np.array_equal(unpack_int24(packed.tobytes()), samples)
+
+
+def test_int24_pcm_block():
+    frames = np.array([[1, -1], [2**23 - 1, -(2**23)], [4660, -4660]], dtype=np.int32)
+    block = PcmBlock(pack_int24(frames).tobytes(), SampleFormat.INT_24, channels=2)
+    assert block.frames == 3
+    assert np.array_equal(block.array, frames)
+    assert PcmBlock.from_array(frames, SampleFormat.INT_24).bytes == block.bytes
+
+
+def test_sample_conversion_round_trips():
+    int_formats = [SampleFormat.UINT_8, SampleFormat.INT_16, SampleFormat.INT_24, SampleFormat.INT_32]
+    source = np.array([-1.0, -0.5, 0.0, 0.25, 0.999], dtype=np.float32)
+    for fmt in int_formats:
+        ints = SampleConverter(SampleFormat.FLOAT_32, fmt).convert(source)
+        back = SampleConverter(fmt, SampleFormat.FLOAT_32).convert(ints)
+        assert np.allclose(back, source, atol=1 / 64), fmt
+        for other in int_formats:
+            widened = SampleConverter(fmt, other).convert(ints)
+            assert np.allclose(SampleConverter(other, SampleFormat.FLOAT_32).convert(widened), back, atol=1 / 64)
+
+    # narrowing rounds to nearest instead of flooring, negatives included, and saturates at full scale
+    int24 = np.array([-129 * 256 - 127, -3, 127, -(2**23), 2**23 - 1], dtype=np.int32)
+    assert SampleConverter(SampleFormat.INT_24, SampleFormat.INT_16).convert(int24).tolist() == [-129, 0, 0, -32768, 32767]
+    negative = np.array([-1000, -1, -32767], dtype=np.int16)
+    widened = SampleConverter(SampleFormat.INT_16, SampleFormat.INT_32).convert(negative)
+    narrow = SampleConverter(SampleFormat.INT_32, SampleFormat.INT_16)
+    # a quarter LSB under comes back as the same value, a bare shift would give one less
+    assert np.array_equal(narrow.convert(widened), negative) and np.array_equal(narrow.convert(widened - 2**14), negative)
+    assert SampleConverter(SampleFormat.INT_16, SampleFormat.UINT_8).convert(np.array([-200, -100], dtype=np.int16)).tolist() == [127, 128]
+
+
+def test_conversion_into_preallocated_buffer():
+    block = PcmBlock(np.array([[0.5, -2.0], [1.5, 0.0]], dtype=np.float32).tobytes(), SampleFormat.FLOAT_32, 2)
+    out = np.empty((2, 2), dtype=np.int16)
+    converted = block.convert(SampleFormat.INT_16, out=out)
+    assert converted.array is out
+    assert out.tolist() == [[16384, -32768], [32767, 0]]
+    dithered = block.convert(SampleFormat.INT_16, dither=True).array
+    assert np.all(np.abs(dithered.astype(np.int32) - out) <= 1)
+    # blocks share one converter (and its scratch) per format pair
+    assert shared_converter(SampleFormat.FLOAT_32, SampleFormat.UINT_8) is shared_converter(SampleFormat.FLOAT_32, SampleFormat.UINT_8)
+
+    silence_out = np.full((3, 2), 7, dtype=np.uint8)
+    silence = PcmSilence(3, SampleFormat.INT_16, 2).convert(SampleFormat.UINT_8, out=silence_out)
+    assert silence.array is silence_out and (silence_out == 128).all()
+
+
+def test_resampler_is_block_size_independent():
+    rng = np.random.default_rng(1)
+    frames = rng.uniform(-0.5, 0.5, size=(4410, 2)).astype(np.float32)
+    whole = PcmBlock.from_array(frames, SampleFormat.FLOAT_32, rate=44_100, pts_ns=0)
+    one_shot = np.concatenate([b.array for b in PcmResampler(44_100, 48_000, 2).apply([whole])])
+
+    pieces, i = [], 0
+    for size in rng.integers(1, 700, size=100):
+        pieces.append(PcmBlock.from_array(frames[i:i + size], SampleFormat.FLOAT_32, rate=44_100))
+        i += size
+    streamed = list(PcmResampler(44_100, 48_000, 2).apply(pieces))
+    assert one_shot.shape == (4800, 2)
+    assert np.allclose(np.concatenate([b.array for b in streamed]), one_shot, atol=1e-6)
+    assert all(b.rate == 48_000 for b in streamed)
+
+
+def test_rechunker_emits_fixed_size_views():
+    samples = np.arange(2 * 1000, dtype=np.int16).reshape(-1, 2)
+    blocks, i = [], 0
+    for size in [1, 7, 300, 64, 128, 500]:
+        blocks.append(PcmBlock.from_array(samples[i:i + size], SampleFormat.INT_16, rate=1000, pts_ns=i * 1_000_000))
+        i += size
+    rechunker = PcmRechunker(128)
+    out = []
+    for block in blocks:
+        for chunk in rechunker.process(block):
+            assert chunk.array.base is not None  # a view into the ring, not a copy
+            out.append((chunk.pts_ns, chunk.array.copy()))
+    out += [(chunk.pts_ns, chunk.array.copy()) for chunk in rechunker.flush()]
+    assert [a.shape for _, a in out] == [(128, 2)] * 8
+    assert np.array_equal(np.concatenate([a for _, a in out])[:1000], samples)
+    assert [pts for pts, _ in out] == [n * 128_000_000 for n in range(8)]
+
+
+def test_mixer_aligns_inputs_on_pts():
+    mixer = AudioMixer(rate=1000, channels=2, block_frames=10, limiter=False)
+    mixer.add_input("mic", channels=1, gain=0.5)
+    mixer.add_input("loopback", channels=2, channel_map=[1, 0])
+    ones = np.ones(10, dtype=np.float32)
+    stereo = np.tile(np.array([0.1, 0.2], dtype=np.float32), (10, 1))
+    mixer.push("mic", PcmBlock.from_array(ones, SampleFormat.FLOAT_32, rate=1000, pts_ns=0))
+    # the loopback starts 5 ms later, so its first 5 frames in the mix are silence
+    mixer.push("loopback", PcmBlock.from_array(stereo, SampleFormat.FLOAT_32, rate=1000, pts_ns=5_000_000))
+    assert mixer.ready()
+    out = mixer.pull().array
+    assert np.allclose(out[:5], [0.5, 0.5])
+    assert np.allclose(out[5:], [0.7, 0.6])
+
+    # silence at another rate needs no resampler of its own, 3 x 15 frames at 1500 Hz is 30 here
+    mixer = AudioMixer(rate=1000, channels=1, block_frames=10, limiter=False)
+    mixer.add_input("mic", channels=1)
+    for _ in range(3):
+        mixer.push("mic", PcmSilence(15, SampleFormat.INT_16, 1, rate=1500))
+    assert mixer._inputs["mic"].resampler is None
+    assert mixer._inputs["mic"].ring.available == 30
+
+    # once there is one, silence goes through it, or the audio after it would land late and be dropped
+    mixer = AudioMixer(rate=48_000, channels=1, max_latency_ms=1000, limiter=False)
+    mixer.add_input("mic", channels=1)
+    tone = np.full(4410, 0.25, dtype=np.float32)
+    mixer.push("mic", PcmBlock.from_array(tone, SampleFormat.FLOAT_32, rate=44_100, pts_ns=0))
+    mixer.push("mic", PcmSilence(4410, SampleFormat.FLOAT_32, 1, rate=44_100, pts_ns=100_000_000))
+    for pts_ns in (200_000_000, 300_000_000):
+        mixer.push("mic", PcmBlock.from_array(tone, SampleFormat.FLOAT_32, rate=44_100, pts_ns=pts_ns))
+    mic = mixer._inputs["mic"]
+    # 400 ms at 48 kHz, less what's still in the resampler's filter
+    assert mic.dropped_frames == 0 and 19_200 - 16 <= mic.ring.available <= 19_200
+    out = np.concatenate([mixer.pull().array.reshape(-1) for _ in range(40)])
+    assert np.allclose(out[200:4600], 0.25, atol=1e-3) and np.allclose(out[5000:9400], 0, atol=1e-3)
+    assert np.allclose(out[9800:19000], 0.25, atol=1e-3)
+
+
+def test_meter_reads_sine_levels():
+    rate = 48_000
+    t = np.arange(rate * 5) / rate
+    sine = (0.1 * np.sin(2 * np.pi * 1000 * t)).astype(np.float32)
+    frames = np.stack([sine, sine], axis=1)
+    meter = LevelMeter(rate, 2)
+    bank = MeterBank()
+    bank.add("sine", rate, 2)
+    for start in range(0, frames.shape[0], 480):
+        block = PcmBlock.from_array(frames[start:start + 480], SampleFormat.FLOAT_32, rate=rate)
+        reading = meter.measure(block)
+        batched = bank.measure({"sine": block})["sine"]
+    # a 1 kHz sine at -20 dBFS in both channels is -20 LUFS
+    assert abs(reading.integrated_lufs + 20) < 0.05
+    assert abs(reading.momentary_lufs + 20) < 0.05
+    assert np.allclose(reading.peak_db, -20, atol=0.01)
+    assert np.allclose(reading.rms_db, -23.01, atol=0.1)
+    assert reading.integrated_lufs == batched.integrated_lufs
+    assert np.array_equal(reading.true_peak_db, batched.true_peak_db)
+
+    # samples of this one never hit the crest, the true peak still has to find it
+    quarter = np.sin(2 * np.pi * np.arange(4800) / 4 + np.pi / 4).astype(np.float32)
+    reading = LevelMeter(rate, 1).measure(PcmBlock.from_array(quarter, SampleFormat.FLOAT_32, rate=rate))
+    assert abs(reading.peak_db[0] + 3.01) < 0.01
+    assert reading.true_peak_db[0] > -0.5
+
+
+def test_spectrum_bands():
+    rate = 48_000
+    t = np.arange(rate) / rate
+    sine = np.sin(2 * np.pi * 1000 * t).astype(np.float32)
+    analyzer = SpectrumAnalyzer(rate, fft_size=2048, bands=3, scale=BandScale.OCTAVE, overlap=0.75)
+    bank = SpectrumBank()
+    bank.add("sine", rate, fft_size=2048, bands=3, scale=BandScale.OCTAVE, overlap=0.75)
+    rows = []
+    for start in range(0, rate, 480):
+        block = PcmBlock.from_array(sine[start:start + 480], SampleFormat.FLOAT_32, rate=rate)
+        levels = analyzer.feed(block)
+        assert np.array_equal(levels, bank.feed({"sine": block})["sine"])
+        rows.append(levels)
+    levels = np.concatenate(rows)
+    assert levels.dtype == np.float32 and levels.shape == ((rate - 2048) // 512 + 1, analyzer.bands)
+    # a full scale sine reads 0 dB in its third octave band, and nothing much anywhere else
+    band = np.argmin(np.abs(analyzer.centers - 1000))
+    assert np.allclose(levels[:, band], 0, atol=0.01)
+    assert np.delete(levels[-1], [band - 1, band, band + 1]).max() < -60
+
+
+def test_archive_round_trip_and_index():
+    rate = 48_000
+    frames = (np.random.default_rng(0).standard_normal((rate * 2, 2)) * 3000).astype(np.int16)
+    start_ns = 1_000_000_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "capture.wav")
+        with PcmArchiveWriter(path) as writer:
+            for offset in range(0, frames.shape[0], 480):
+                # half a second of capture clock goes missing after the first second
+                pts_ns = start_ns + offset * 1_000_000_000 // rate + (500_000_000 if offset >= rate else 0)
+                writer.write(PcmBlock.from_array(frames[offset:offset + 480], SampleFormat.INT_16, rate=rate, pts_ns=pts_ns))
+
+        archive = PcmArchive(path)
+        assert archive.frames == frames.shape[0] and archive.rate == rate and archive.channels == 2
+        assert archive.index.tolist() == [[start_ns, 0, rate], [start_ns + 1_500_000_000, rate, rate]]
+        assert isinstance(archive.samples, np.memmap) and np.array_equal(archive.samples, frames)
+
+        second = archive.slice(start_ns + 1_500_000_000, start_ns + 1_600_000_000)
+        assert np.array_equal(second, frames[rate:rate + 4800])
+        blocks = list(archive.blocks(frames_per_block=rate // 2))
+        assert [block.pts_ns for block in blocks][1:3] == [start_ns + 500_000_000, start_ns + 1_500_000_000]
+        archive.close()
+        del second, blocks
+
+
+def test_voice_gate_and_sparse_archive():
+    rate = 48_000
+    noise = np.random.default_rng(0).standard_normal(rate * 3) * 3
+    noise[rate:rate + rate // 2] += 10000 * np.sin(2 * np.pi * 440 * np.arange(rate // 2) / rate)
+    samples = noise.astype(np.int16)
+    gate = VoiceActivityGate(threshold_db=-50, hangover_ms=300, pre_roll_ms=100)
+    gated = []
+    for start in range(0, samples.size, 480):
+        block = PcmBlock.from_array(samples[start:start + 480], SampleFormat.INT_16, rate=rate, pts_ns=start * 1_000_000_000 // rate)
+        gated.extend(gate.process(block))
+    gated.extend(gate.flush())
+
+    # every frame comes out exactly once, in order, and only the tone plus pre-roll and hangover is audio
+    offsets = np.cumsum([0] + [block.frames for block in gated])
+    assert offsets[-1] == samples.size
+    assert [block.pts_ns for block in gated] == [int(o) * 1_000_000_000 // rate for o in offsets[:-1]]
+    audio = [(o, o + b.frames) for o, b in zip(offsets, gated) if not isinstance(b, PcmSilence)]
+    assert audio[0][0] == rate - rate // 10 and audio[-1][1] == rate + rate // 2 + rate * 3 // 10
+    replayed = np.concatenate([block.array for block in gated])
+    assert np.array_equal(replayed[audio[0][0]:audio[-1][1]], samples[audio[0][0]:audio[-1][1]])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "gated.wav")
+        with PcmArchiveWriter(path, sparse=True) as writer:
+            for block in gated:
+                writer.write(block)
+        archive = PcmArchive(path)
+        assert archive.frames == audio[-1][1] - audio[0][0]
+        assert archive.index[:, 1].tolist() == [-1, 0, -1]
+        blocks = list(archive.blocks())
+        assert np.array_equal(np.concatenate([block.array for block in blocks]), replayed)
+        archive.close()
+        del blocks
+
+
+def test_lossless_round_trip():
+    rate = 48_000
+    t = np.arange(4800) / rate
+    noise = np.random.default_rng(0).standard_normal((4800, 2)) * 0.01
+    floats = (0.3 * np.sin(2 * np.pi * 440 * t)[:, None] + noise).astype(np.float32)
+    blocks = [
+        PcmBlock.from_array(floats, SampleFormat.FLOAT_32, rate=rate, pts_ns=123),
+        PcmBlock.from_array((np.rint(floats * 32767) / 32768).astype(np.float32), SampleFormat.FLOAT_32, rate=rate),
+        PcmBlock.from_array(np.array([[np.nan, np.inf], [-0.0, 1e-40]], dtype=np.float32), SampleFormat.FLOAT_32),
+        PcmBlock.from_array(np.array([[32767, -32768], [-32768, 32767]] * 50, dtype=np.int16), SampleFormat.INT_16),
+        PcmSilence(480, SampleFormat.INT_16, 2, rate=rate, pts_ns=-5),
+    ]
+    for sample_format in (SampleFormat.INT_16, SampleFormat.INT_24, SampleFormat.INT_32, SampleFormat.UINT_8):
+        samples = SampleConverter(SampleFormat.FLOAT_32, sample_format).convert(floats)
+        blocks.append(PcmBlock.from_array(samples, sample_format, channels=2, rate=rate, pts_ns=0))
+        blocks.append(PcmBlock.from_array(samples[:, 0].copy(), sample_format, rate=rate))
+
+    def same(a, b):
+        def fields(block):
+            return type(block), block.sample_format, block.channels, block.frames, block.rate, block.pts_ns, block.bytes
+        return fields(a) == fields(b)
+
+    for compressor in Compressor:
+        codec = PcmCodec(compressor, level=1)
+        for block in blocks:
+            assert same(PcmCodec.decode(codec.encode(block)), block), (compressor, block)
+
+    stream = io.BytesIO()
+    writer = CompressedPcmWriter(stream)
+    list(writer.apply(blocks))
+    assert writer.ratio < 0.8
+    stream.seek(0)
+    assert all(same(a, b) for a, b in zip(read_compressed(stream), blocks))
+    decoder = FrameDecoder()
+    data = stream.getvalue()
+    decoded = []
+    for start in range(0, len(data), 1000):
+        decoded.extend(decoder.feed(data[start:start + 1000]))
+    assert len(decoded) == len(blocks) and all(same(a, b) for a, b in zip(decoded, blocks))
+
+
+def test_waveform_overview():
+    rate = 48_000
+    rng = np.random.default_rng(0)
+    samples = (rng.standard_normal((rate * 20 + 123, 2)) * 3000).astype(np.int16)
+    samples[rate * 5:rate * 6] //= 100
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "overview.wav")
+        with PcmArchiveWriter(path, overview=True) as writer:
+            start = 0
+            for size in rng.integers(1, 3000, size=1000):
+                writer.write(PcmBlock.from_array(samples[start:start + size], SampleFormat.INT_16, rate=rate, pts_ns=0))
+                start += size
+                if start >= len(samples):
+                    break
+        archive = PcmArchive(path)
+        saved = archive.overview()
+        assert saved.frames == len(samples) and os.path.exists(path + ".overview.npz")
+        os.remove(path + ".overview.npz")
+        rebuilt = archive.overview()
+        archive.close()
+
+    # fed in one go it's the same pyramid as from the writer's odd-sized blocks
+    whole = WaveformOverview(2, rate)
+    whole.feed(PcmBlock.from_array(samples, SampleFormat.INT_16, rate=rate))
+    floats = samples / 32768
+    for pixels, first, last in ((1000, 0, None), (7, rate, 3 * rate), (300, len(samples) - 1000, None)):
+        mins, maxs, rms = saved.overview(pixels, first, last)
+        for other in (rebuilt, whole):
+            assert all(np.array_equal(a, b) for a, b in zip((mins, maxs, rms), other.overview(pixels, first, last)))
+        # every pixel holds at least the extremes of the frames it covers
+        edges = np.linspace(first, last or len(samples), pixels + 1).astype(int)
+        for i in range(pixels):
+            chunk = floats[edges[i]:max(edges[i + 1], edges[i] + 1)]
+            assert (mins[i] <= chunk.min(axis=0) + 1e-3).all() and (maxs[i] >= chunk.max(axis=0) - 1e-3).all()
+    _, _, rms = saved.overview(100)
+    assert np.allclose(rms[[0, 99]], 3000 / 32768, rtol=0.02) and (rms[26:29] < 0.01).all()
+
+
+def test_dsp_chain_in_place():
+    rate, block = 48_000, 128
+    rng = np.random.default_rng(5)
+    signal = (rng.standard_normal((2, 20 * block)) * 0.5).astype(np.float32)
+
+    # the block matmul biquad matches the direct form loop
+    band = Biquad(BiquadType.PEAKING, 1000, q=1.0, gain_db=6.0)
+    chain = DspChain([Gain(-3), band])
+    chain.prepare(rate, 2, block)
+    x = signal.copy()
+    for start in range(0, x.shape[1], block):
+        chain.process(x[:, start:start + block])
+    b, a = biquad_coefficients(BiquadType.PEAKING, rate, 1000, 1.0, 6.0)
+    gain = np.float32(10 ** (-3 / 20))
+    expected = _simulate([v / a[0] for v in b], [v / a[0] for v in a], (signal[1] * gain).tolist(), [0.0, 0.0], [0.0, 0.0])
+    assert np.allclose(x[1], expected, atol=1e-4)
+
+    # nothing gets past the limiter, and it lets go at the release rate once the peaks stop
+    limiter = Limiter(threshold_db=-6.0, release_db_per_s=60.0)
+    limiter.prepare(rate, 2, block)
+    loud = signal * 4
+    for start in range(0, loud.shape[1], block):
+        limiter.process(loud[:, start:start + block])
+    assert np.abs(loud).max() <= 10 ** (-6 / 20) * 1.0001
+    reduction = limiter.gain_reduction_db
+    quiet = np.zeros((2, block), dtype=np.float32)
+    limiter.process(quiet)
+    assert np.isclose(limiter.gain_reduction_db, max(0.0, reduction - 60.0 * block / rate), atol=1e-3)
+
+
+def test_synthetic_backend_capture_and_playback():
+    played = []
+    backend = SyntheticBackend(
+        [
+            VirtualDevice("Tone", input_channels=2, rate=16_000, frequency=1000.0, level_db=-6.0, supported_rates=(16_000, 48_000)),
+            VirtualDevice("Sink", input_channels=0, output_channels=2, rate=16_000, sink=lambda data, frames: played.append(frames)),
+        ],
+        realtime=False,
+    )
+    audio_backends.set_backend(backend)
+    try:
+        capabilities = pyaudio_helper.PortAudioSession.capabilities(0)
+        assert capabilities.rates == [16_000, 48_000] and SampleFormat.INT_24 in capabilities.sample_formats
+
+        # as fast as the consumer takes it, continuous across buffers
+        frames = []
+        with pyaudio_helper.get_pcm_blocks(input_device_index=0, sample_format=SampleFormat.FLOAT_32, frames_per_buffer=500, drop_oldest_on_full=False) as blocks:
+            for block in blocks:
+                frames.append(block.array.reshape(-1, 2))
+                if len(frames) == 32:
+                    break
+        samples = np.concatenate(frames)[:, 0]
+        spectrum = np.abs(np.fft.rfft(samples))
+        assert np.argmax(spectrum) == 1000 * len(samples) // 16_000
+        assert np.isclose(samples.max(), 10 ** (-6 / 20), atol=1e-3)
+
+        block = PcmBlock.from_array(np.zeros((1600, 2), dtype=np.int16), SampleFormat.INT_16, 2, rate=16_000)
+        stats = pyaudio_helper.play_pcm_blocks([block] * 5, output_device_index=1, latency_ms=20)
+        assert stats.frames == sum(played) and sum(played) >= 8000
+
+        # every instance has its own device list and streams, like separate PortAudio inits
+        first, second = backend.PyAudio(), backend.PyAudio()
+        backend.add_device(VirtualDevice("Headset"))
+        assert first.get_device_count() == 2 and backend.PyAudio().get_device_count() == 3
+        options = dict(format=audio_backends.paInt16, channels=1, rate=16_000, input=True, input_device_index=0)
+        kept = second.open(**options, stream_callback=lambda *args: (None, audio_backends.paContinue))
+        closed = first.open(**options, stream_callback=lambda *args: (None, audio_backends.paContinue))
+        first.terminate()
+        assert kept.is_active() and not closed.is_active()
+        second.terminate()
+    finally:
+        audio_backends.set_backend(None)
+
+
+def _ramp(frames, channels, rate, position):
+    # every sample is its frame number, so a gap or a repeat anywhere shows
+    return np.repeat((np.arange(position, position + frames) / 2 ** 20)[:, None], channels, axis=1)
+
+
+def _assert_unbroken(blocks, rate):
+    samples = np.concatenate([block.array for block in blocks])
+    assert np.array_equal(samples * 2 ** 20, np.arange(len(samples)))
+    steps = np.diff([block.pts_ns for block in blocks]) - np.array([block.frames for block in blocks[:-1]]) * 1_000_000_000 // rate
+    assert np.abs(steps).max() <= 1
+
+
+def test_capture_session_add_and_remove():
+    rate = 16_000
+    backend = SyntheticBackend([VirtualDevice(f"Mic {i}", input_channels=1, rate=rate, source=_ramp) for i in range(3)])
+    audio_backends.set_backend(backend)
+    blocks = {"a": [], "b": [], "c": []}
+    try:
+        # scanned before the session holds PortAudio open, after that it keeps serving this table
+        pyaudio_helper.PortAudioSession.device_table()
+        with pyaudio_helper.CaptureSession() as capture:
+
+            def collect(seconds):
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    for key, got in capture.read(0.02).items():
+                        blocks[key].extend(got)
+
+            options = dict(sample_format=SampleFormat.FLOAT_32, frames_per_buffer=160)
+            capture.add("a", 0, **options)
+            capture.add("b", 1, **options)
+            collect(0.1)
+            capture.add("c", 2, **options)
+            collect(0.1)
+            capture.remove("a")
+            removed_at = len(blocks["a"])
+            collect(0.1)
+            assert capture.keys == ["b", "c"]
+        for key, got in capture.read(0).items():
+            blocks[key].extend(got)
+    finally:
+        audio_backends.set_backend(None)
+
+    # b ran through both changes without a gap, on its own clock; c started from scratch
+    assert not capture.errors and capture.dropped_blocks == 0
+    assert len(blocks["b"]) > len(blocks["c"]) > 0 and len(blocks["a"]) <= removed_at + 1
+    for key in blocks:
+        _assert_unbroken(blocks[key], rate)
+
+
+def test_pcm_stream_pts_from_time_info():
+    rate = 16_000
+    backend = SyntheticBackend([VirtualDevice("Mic", input_channels=1, rate=rate, source=_ramp)])
+    audio_backends.set_backend(backend)
+    stats = pyaudio_helper.CaptureStats()
+
+    async def run():
+        blocks = []
+        stream = pyaudio_helper.pcm_stream(input_device_index=0, sample_format=SampleFormat.FLOAT_32, frames_per_buffer=160, stats=stats)
+        async for block, timestamp in stream:
+            assert timestamp.pts_ns == block.pts_ns
+            blocks.append(block)
+            if len(blocks) == 5:
+                break
+        return blocks
+
+    try:
+        blocks = asyncio.run(run())
+    finally:
+        audio_backends.set_backend(None)
+
+    # spaced by the stream clock's input_buffer_adc_time, not by when they arrived
+    _assert_unbroken(blocks, rate)
+    assert all(block.frames == 160 for block in blocks)
+    # every callback is timed, including the last one
+    assert stats.callbacks >= 5 and sum(stats.callback_histogram) == stats.callbacks
+
+
+def test_capture_stats_counters_and_stream():
+    # not real-time: callbacks come as fast as they can, so the queue fills and nothing overflows by itself
+    backend = SyntheticBackend([VirtualDevice("Mic", input_channels=1, rate=16_000)], realtime=False)
+    audio_backends.set_backend(backend)
+
+    async def first(stream):
+        async for snapshot, _ in stream:
+            return snapshot
+
+    try:
+        with pyaudio_helper.get_pcm_blocks(input_device_index=0, frames_per_buffer=160, queue_size=4) as blocks:
+            next(iter(blocks))
+            for _ in range(3):
+                backend.glitch("Mic")
+                time.sleep(0.01)
+            snapshot = blocks.stats()
+            emitted = asyncio.run(first(blocks.stats_stream(0.01)))
+    finally:
+        audio_backends.set_backend(None)
+
+    assert snapshot.input_overflows == 3 and snapshot.input_underflows == 0 and snapshot.errors == 0
+    assert snapshot.queue_high_water == 4 and snapshot.dropped_blocks > 0
+    assert snapshot.frames_per_buffer == 160 and snapshot.callbacks > snapshot.dropped_blocks
+    assert emitted.input_overflows == 3 and emitted.callbacks >= snapshot.callbacks
+
+
+def test_pcm_player_varying_callback_sizes():
+    played = []
+    backend = SyntheticBackend(
+        [
+            VirtualDevice(
+                "Speakers", input_channels=0, output_channels=1, rate=16_000, callback_frames=(64, 128, 32, 200),
+                sink=lambda data, frames: played.append(np.frombuffer(data, dtype=np.int16).copy()),
+            ),
+        ],
+        realtime=False,
+    )
+    audio_backends.set_backend(backend)
+    samples = np.arange(1, 1001, dtype=np.int16)
+    try:
+        blocks = [PcmBlock.from_array(samples[i:i + 100], SampleFormat.INT_16, 1, rate=16_000) for i in range(0, 1000, 100)]
+        pyaudio_helper.play_pcm_blocks(blocks, output_device_index=0, frames_per_buffer=64, adaptive=False)
+    finally:
+        audio_backends.set_backend(None)
+
+    # callbacks bigger than the buffer asked for play what's next, not a copy of an earlier one
+    assert {len(buffer) for buffer in played} == {64, 128, 32, 200}
+    out = np.concatenate(played)
+    assert np.array_equal(out[out != 0], samples)
+
+
+def test_pcm_player_jitter_buffer():
+    rate = 16_000
+    played = []
+    backend = SyntheticBackend(
+        [
+            VirtualDevice(
+                "Speakers", input_channels=0, output_channels=1, rate=rate,
+                sink=lambda data, frames: played.append(np.frombuffer(data, dtype=np.int16).copy()),
+            ),
+        ],
+    )
+    audio_backends.set_backend(backend)
+    samples = np.arange(1, 20_001, dtype=np.int16)
+
+    def block(start, frames):
+        return PcmBlock.from_array(samples[start:start + frames], SampleFormat.INT_16, 1, rate=rate)
+
+    try:
+        player = pyaudio_helper.PcmPlayer(0, SampleFormat.INT_16, 1, rate, latency_ms=40, frames_per_buffer=160, recovery_s=0.05)
+        with player:
+            # nothing plays until the 40 ms target is buffered, and waiting for it isn't an underrun
+            player.write(block(0, 320), wait=False)
+            time.sleep(0.05)
+            assert player.stats().callbacks > 0 and player.stats().underruns == 0 and player.buffered_ms == 20
+            assert not np.concatenate(played).any()
+
+            # primed, played, then run dry: one underrun, and the target grows by half
+            player.write(block(320, 320))
+            time.sleep(0.1)
+            assert player.stats().underruns == 1 and player.target_latency_ms == 60
+
+            # every 50 ms played without one brings it a buffer back, down to where it started
+            player.write(block(640, 4800))
+            assert player.target_latency_ms == 40
+            player.drain()
+            assert player.stats().underruns == 1
+
+            # a live source running ahead gets its oldest frames dropped down to twice the target
+            player.write(block(5440, 4000), wait=False)
+            assert player.stats().dropped_frames == 4000 - 1280
+            player.drain()
+    finally:
+        audio_backends.set_backend(None)
+
+    out = np.concatenate(played)
+    assert np.array_equal(out[out != 0], np.concatenate([samples[:5440], samples[5440 + 2720:9440]]))
+
+
+def test_capture_buffer_grows_on_overflow():
+    backend = SyntheticBackend([VirtualDevice("Mic", input_channels=1, rate=16_000, low_latency_s=0.01)])
+    audio_backends.set_backend(backend)
+    try:
+        pyaudio_helper.PortAudioSession.device_table()
+        with pyaudio_helper.CaptureSession() as capture:
+            capture.HEALTH_CHECK_S = 0.02
+            capture.add("mic", 0, max_frames_per_buffer=1024)
+            sizes = [capture.stats("mic").frames_per_buffer]
+            # every overflow the health check sees doubles the buffer, up to the maximum
+            for _ in range(3):
+                backend.glitch("Mic")
+                deadline = time.monotonic() + 2
+                while capture.stats("mic").input_overflows == len(sizes) - 1 and time.monotonic() < deadline:
+                    time.sleep(0.005)
+                time.sleep(0.1)
+                sizes.append(capture.stats("mic").frames_per_buffer)
+            assert sizes == [256, 512, 1024, 1024]
+            assert capture.keys == ["mic"] and not capture.errors and capture.read(1.0)["mic"][-1].frames == 1024
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_port_audio_session_refcount_table_and_capabilities():
+    session = pyaudio_helper.PortAudioSession
+    backend = SyntheticBackend([VirtualDevice("Microphone"), VirtualDevice("Speakers", input_channels=0, output_channels=2)])
+    constructed = []
+    make_pyaudio = backend.PyAudio
+    backend.PyAudio = lambda: constructed.append(1) or make_pyaudio()
+    audio_backends.set_backend(backend)
+    try:
+        # one PyAudio for everything: scan, enumeration, printing, from any number of AudioSystems
+        system = AudioSystem()
+        for _ in range(3):
+            assert len(system.audio_devices) == 2 and len(AudioSystem().audio_endpoints) == 2
+            str(system), str(AudioSystem())
+        assert len(constructed) == 1 and not session.in_use()
+
+        # refcounted, terminated on the last release only
+        pa = session.acquire()
+        assert session.acquire() is pa and len(constructed) == 2
+        session.release()
+        assert session.in_use() and session._pa is pa
+        session.release()
+        assert not session.in_use() and session._pa is None
+        session.release()  # one too many is only logged
+        assert session._refs == 0
+
+        # the table is cached, a refresh that finds nothing new keeps its generation
+        table = session.device_table()
+        assert session.device_table() is table and table.device(1)["name"] == "Speakers"
+        assert session.device_table(refresh=True).generation == table.generation
+
+        # capabilities are probed once and published, the rescan below forgets them
+        capabilities = session.capabilities(0)
+        probes = len(constructed)
+        assert session.capabilities(0) is capabilities and len(constructed) == probes
+
+        # invalidated while a stream holds PortAudio: the old table until it's let go
+        backend.devices.append(VirtualDevice("Headset"))
+        session.invalidate()
+        with session.session():
+            assert session.device_table() is table
+        fresh = session.device_table()
+        assert fresh.generation == table.generation + 1 and fresh.device(2)["name"] == "Headset"
+        assert session.capabilities(0) is not capabilities
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_audio_system_enumeration_is_cached():
+    backend = SyntheticBackend([VirtualDevice("Microphone"), VirtualDevice("Speakers", input_channels=0, output_channels=2)])
+    audio_backends.set_backend(backend)
+    try:
+        system = AudioSystem()
+        devices = system.audio_devices
+        assert [d.name for d in devices] == ["Microphone", "Speakers"]
+        # no rescan and the same objects on every read, from any AudioSystem
+        generation = pyaudio_helper.PortAudioSession.device_table().generation
+        assert AudioSystem().audio_devices[1] is devices[1] and system.audio_endpoints[0] is devices[0].audio_endpoints[0]
+        assert pyaudio_helper.PortAudioSession.device_table().generation == generation
+
+        # hotplug: a device shows up in front, the others keep their objects under new indexes
+        speakers = devices[1].audio_endpoints[0]
+        backend.devices.insert(0, VirtualDevice("Headset", output_channels=2))
+        pyaudio_helper.PortAudioSession.invalidate()
+        devices = system.audio_devices
+        assert [d.name for d in devices] == ["Headset", "Microphone", "Speakers"]
+        assert devices[2].audio_endpoints[0] is speakers and speakers.index == 2
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_endpoint_grouping_and_lookups():
+    full = "Speakers (Realtek High Definition Audio)"
+    backend = SyntheticBackend(
+        [
+            # MME first, cut to 31 chars, then the full names from the other host apis
+            VirtualDevice(full[:31], input_channels=0, output_channels=2, host_api="MME"),
+            VirtualDevice("Microphone (Realtek High Definition Audio)"[:31], host_api="MME"),
+            VirtualDevice("Microphone (Realtek High Definition Audio 2)"[:31], host_api="MME"),
+            VirtualDevice(full, input_channels=0, output_channels=2, host_api="Windows WASAPI"),
+            VirtualDevice(full + " [Loopback]", host_api="Windows WASAPI", is_loopback=True),
+            VirtualDevice("Microphone (Realtek High Definition Audio)", host_api="Windows WASAPI"),
+            VirtualDevice("Microphone (Realtek High Definition Audio 2)", host_api="Windows WASAPI"),
+            VirtualDevice("Mic", host_api="Windows WASAPI"),
+        ]
+    )
+    audio_backends.set_backend(backend)
+    try:
+        system = AudioSystem()
+        names = [d.name for d in system.audio_devices]
+        # the shared MME prefix can't be told apart, it stays on its own
+        assert names == [full, "Microphone (Realtek High Defini", "Microphone (Realtek High Definition Audio)", "Microphone (Realtek High Definition Audio 2)", "Mic"]
+        speakers = system.device_by_name(full)
+        assert [e.index for e in speakers.audio_endpoints] == [0, 3, 4]
+        assert system.device_by_name(full + " [Loopback]") is speakers and system.device_by_name(full[:31]) is speakers
+        assert system.device_of(system.endpoint_by_index(4)) is speakers
+        assert [e.index for e in system.endpoints_by_host_api("MME")] == [0, 1, 2]
+        assert [e.index for e in system.endpoints_by_type(AudioEndpointType.OUTPUT)] == [0, 3]
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_device_watcher_follows_hotplug():
+    backend = SyntheticBackend.default(realtime=False)
+    audio_backends.set_backend(backend)
+
+    async def run():
+        changes = aiter(AudioSystem().watch(poll_interval_s=60))
+        first = asyncio.ensure_future(anext(changes))
+        while not backend._watchers:
+            await asyncio.sleep(0)
+
+        backend.add_device(VirtualDevice("USB Mic", input_channels=1))
+        added, _ = await asyncio.wait_for(first, 5)
+        assert added.kind == DeviceChangeKind.ADDED and added.device_name == "USB Mic"
+
+        backend.set_default("USB Mic", is_input=True)
+        default, _ = await asyncio.wait_for(anext(changes), 5)
+        assert default.kind == DeviceChangeKind.DEFAULT_CHANGED and default.direction == AudioEndpointType.INPUT
+        assert default.endpoint is added.endpoint and default.host_api_name == "Synthetic"
+
+        # everything after it shifts down an index, only the removal is a change
+        backend.remove_device("Synthetic Sine")
+        removed, _ = await asyncio.wait_for(anext(changes), 5)
+        assert removed.kind == DeviceChangeKind.REMOVED and removed.device_name == "Synthetic Sine"
+        backend.remove_device("Synthetic Noise")
+        removed, _ = await asyncio.wait_for(anext(changes), 5)
+        assert removed.device_name == "Synthetic Noise"
+
+        # a second identical headset is its own endpoint, not the first one again
+        backend.add_device(VirtualDevice("USB Headset", output_channels=2))
+        first_headset, _ = await asyncio.wait_for(anext(changes), 5)
+        backend.add_device(VirtualDevice("USB Headset", output_channels=2))
+        second_headset, _ = await asyncio.wait_for(anext(changes), 5)
+        assert second_headset.kind == DeviceChangeKind.ADDED and second_headset.endpoint is not first_headset.endpoint
+
+        # and a new default rate is a change to the same endpoint, not a remove and an add
+        backend.update_device("USB Headset", rate=44_100)
+        changed, _ = await asyncio.wait_for(anext(changes), 5)
+        assert changed.kind == DeviceChangeKind.CHANGED and changed.fields == ["defaultSampleRate"]
+        assert changed.endpoint is first_headset.endpoint and changed.endpoint.default_sample_rate == 44_100
+
+        await changes.aclose()
+        assert not backend._watchers
+
+    try:
+        asyncio.run(run())
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_snapshot_cache_serves_then_revalidates():
+    backend = SyntheticBackend([VirtualDevice("Microphone"), VirtualDevice("Speakers", input_channels=0, output_channels=2)])
+    audio_backends.set_backend(backend)
+    collected = []
+    counter = SnapshotSource("count", lambda: collected.append(1) or len(backend.devices), lambda n: n)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.json.z")
+            cold = SnapshotCache(path, [AUDIO, counter], key="boot-1").start()
+            assert cold.wait(5) and cold.cached == [] and os.path.exists(path)
+            assert cold.get("count") == 2 and len(collected) == 1
+
+            # next "process": served straight from the file, PortAudio seeded instead of scanned
+            pyaudio_helper.PortAudioSession._table = None
+            warm = SnapshotCache(path, [AUDIO, counter], key="boot-1").start(revalidate=False)
+            assert warm.cached == ["audio", "count"] and warm.get("count") == 2 and len(collected) == 1
+            assert [d.name for d in warm.get("audio").audio_devices] == ["Microphone", "Speakers"]
+            generation = pyaudio_helper.PortAudioSession.device_table().generation
+            assert warm.revalidate() == []
+            assert pyaudio_helper.PortAudioSession.device_table().generation == generation
+
+            swapped = []
+            warm.on_change(lambda name, value: swapped.append(name))
+            backend.add_device(VirtualDevice("Headset", output_channels=2))
+            assert warm.revalidate() == ["audio", "count"] == swapped
+            assert warm.get("count") == 3 and "Headset" in [d.name for d in AudioSystem().audio_devices]
+
+            # another boot, the file doesn't count
+            other = SnapshotCache(path, [AUDIO, counter], key="boot-2").start(revalidate=False)
+            assert other.cached == []
+            try:
+                other.get("count", timeout=0)
+                assert False, "nothing to serve before revalidating"
+            except TftimException:
+                pass
+    finally:
+        audio_backends.set_backend(None)
+
+
+def test_volume_controller_round_trips():
+    backend = FakeVolumeBackend(VolumeRange(-10.0, 0.0, 0.5), volume=-1.0)
+    controller = VolumeController(backend)
+    for _ in range(5):
+        state = controller.read_state()
+        if not state.is_max_volume:
+            controller.increment_volume(state.volume)
+        else:
+            controller.set_min_volume()
+    # the range once, then a volume + mute read and a set per tick
+    assert backend.calls == {"get_range": 1, "get_volume": 5, "get_mute": 5, "set_volume": 5}
+    assert backend.volume == -9.0 and controller.get_range() == {"min": -10.0, "max": 0.0, "step": 0.5}
+    controller.mute()
+    assert controller.as_dict()["is_muted"] and controller.as_dict()["percent"] == 0.1
+
+
+def test_volume_automation_ramps():
+    automation = VolumeAutomation()
+    linear, db, s_curve = (VolumeController(FakeVolumeBackend(volume=1.0)) for _ in range(3))
+    endpoint = VolumeController(FakeVolumeBackend(VolumeRange(-64.0, 0.0, 0.5), volume=0.0))
+    automation.ramp(linear, 0.0, 1.0, RampShape.LINEAR, start_time=0.0)
+    automation.ramp(db, 0.01, 1.0, RampShape.DB, start_time=0.0)
+    automation.ramp(s_curve, 0.0, 1.0, RampShape.S_CURVE, start_time=0.0)
+    automation.ramp(endpoint, -40.0, 1.0, RampShape.DB, start_time=0.0)
+
+    assert automation.tick(0.0) == 0  # nothing moved a step yet
+    automation.tick(0.25)
+    assert linear.backend.volume == 0.75 and s_curve.backend.volume == 0.85
+    automation.tick(0.5)
+    # halfway in dB from 0 to -40 dB is -20 dB, on a session and on an endpoint
+    assert db.backend.volume == 0.1 and endpoint.backend.volume == -20.0 and s_curve.backend.volume == 0.5
+    # the same quantized values again, no calls
+    calls = sum(c.backend.calls["set_volume"] for c in (linear, db, s_curve, endpoint))
+    assert automation.tick(0.501) == 0
+    automation.tick(1.5)
+    assert (linear.backend.volume, db.backend.volume, s_curve.backend.volume, endpoint.backend.volume) == (0.0, 0.01, 0.0, -40.0)
+    assert sum(c.backend.calls["set_volume"] for c in (linear, db, s_curve, endpoint)) == calls + 4
+    assert automation.active == 0 and automation.wait(0)
+
+    # a new ramp takes over from where the old one got to, cancel leaves it there
+    automation.ramp(linear, 1.0, 1.0, start_time=2.0)
+    automation.tick(2.5)
+    automation.ramp(linear, 0.0, 1.0, start_time=2.5)
+    automation.tick(3.0)
+    assert linear.backend.volume == 0.25 and linear.backend.calls["get_volume"] == 2
+    assert automation.cancel(linear) and not automation.is_ramping(linear)
+
+    # on the timer thread
+    with VolumeAutomation(interval_s=0.005) as threaded:
+        threaded.fade_to([linear, s_curve], 0.6, 0.05)
+        assert threaded.wait(2)
+    assert linear.backend.volume == s_curve.backend.volume == 0.6
+
+
+def main():
+    test_int24_round_trip()
+    test_int24_pcm_block()
+    test_sample_conversion_round_trips()
+    test_conversion_into_preallocated_buffer()
+    test_resampler_is_block_size_independent()
+    test_rechunker_emits_fixed_size_views()
+    test_mixer_aligns_inputs_on_pts()
+    test_meter_reads_sine_levels()
+    test_spectrum_bands()
+    test_archive_round_trip_and_index()
+    test_voice_gate_and_sparse_archive()
+    test_lossless_round_trip()
+    test_waveform_overview()
+    test_dsp_chain_in_place()
+    test_synthetic_backend_capture_and_playback()
+    test_capture_session_add_and_remove()
+    test_pcm_stream_pts_from_time_info()
+    test_capture_stats_counters_and_stream()
+    test_pcm_player_varying_callback_sizes()
+    test_pcm_player_jitter_buffer()
+    test_capture_buffer_grows_on_overflow()
+    test_port_audio_session_refcount_table_and_capabilities()
+    test_audio_system_enumeration_is_cached()
+    test_endpoint_grouping_and_lookups()
+    test_device_watcher_follows_hotplug()
+    test_snapshot_cache_serves_then_revalidates()
+    test_volume_controller_round_trips()
+    test_volume_automation_ramps()
+
+
+if __name__ == "__main__":
+    main()
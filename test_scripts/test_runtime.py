@@ -18,16 +18,16 @@ def test_processes():
     process = next(p for p in processes if "zen" in (p.name or "").lower())
     print(process)
     
+    # one controller per session, their ranges are read once
+    controllers = [(p, p.volume_controller) for p in processes if p.pid != 0]
     while True:
-        for p in processes:
-            if p.pid == 0:
-                continue
-            controller = p.volume_controller
-            if not controller.is_max_volume():
-                controller.increment_volume()
+        for p, controller in controllers:
+            state = controller.read_state()
+            if not state.is_max_volume:
+                controller.increment_volume(state.volume)
             else:
                 controller.set_min_volume()
-            print(f"{p.name} {controller.get_volume()} {controller.get_range()}")
+            print(f"{p.name} {state.volume} {state.range}")
         time.sleep(.02)
 
 